@@ -10,11 +10,18 @@ import arrus.session
 import arrus.utils.imaging
 import arrus.utils.us4r
 import queue
+import argparse
 import numpy as np
 import arrus.ops.tgc
 import arrus.medium
 from collections import deque
-import pickle
+# Shared modules (swe_utils/, one copy for all the script directories)
+import os
+import sys
+SWE_UTILS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'swe_utils')
+if(SWE_UTILS_DIR not in sys.path):
+    sys.path.append(SWE_UTILS_DIR)
+from SWE_utils_rf import RfRecorder
 
 from arrus.ops.us4r import (
     Scheme,
@@ -40,7 +47,7 @@ arrus.add_log_file("swe_test.log", arrus.logging.TRACE)
 
 datafile = "rfdata_hv50_push500.npy"
 
-def main():
+def main(args):
     # Here starts communication with the device.
     medium = arrus.medium.Medium(name="water", speed_of_sound=1490)
     with arrus.Session("us4r.prototxt", medium=medium) as sess:
@@ -120,20 +127,19 @@ def main():
         seq = TxRxSequence(ops=push_sequence+imaging_sequence, sri=1)   # push + imaging
         
         # Declare the complete scheme to execute on the devices.
-        q = deque(maxlen=1)
-        mq = deque(maxlen=1)
+        # With --record N the first N frames are streamed to data2.rf, metadata in sidecar files (read with
+        # SWE_utils_rf.open_recording). The session runs until the display is closed, so the recording is capped.
+        recorder = RfRecorder("data2", max_frames=args.record) if args.record > 0 else None
+        steps = [RemapToLogicalOrder()]
+        if(recorder is not None):
+            steps.append(Lambda(recorder.record, recorder.set_metadata))
+        steps += [Squeeze(), SelectFrames([2]), Squeeze()]
         scheme = Scheme(
             # Run the provided sequence.
             tx_rx_sequence=seq,
             # Processing pipeline to perform on the GPU device.
             processing=Pipeline(
-                steps=(
-                    RemapToLogicalOrder(),
-                    Lambda(lambda data: (q.append(data.get()), data)[1], lambda metadata: (mq.append(metadata), metadata)[1]),
-                    Squeeze(),
-                    SelectFrames([2]),
-                    Squeeze(), 
-                ),
+                steps=tuple(steps),
                 placement="/GPU:0"
             )
         )
@@ -151,8 +157,9 @@ def main():
         # The below function blocks current thread until the window is closed.
         display.start(buffer)
         
-        # Save last data to the file at the end
-        pickle.dump({"data":np.stack(q), "metadata": mq[0]}, open("data2.pkl", "wb"))
+        # Write the remaining frames
+        if(recorder is not None):
+            print("Recorded {} frames to data2.rf".format(recorder.close()))
 
         
         print("Display closed, stopping the script.")
@@ -162,4 +169,7 @@ def main():
 
 
 if __name__ == "__main__":
-    main()
+    parser = argparse.ArgumentParser(description="Plane wave acquisition with a push, live display.")
+    parser.add_argument("--record", dest="record", type=int, default=0,
+                        help="number of frames to record to data2.rf (0 - no recording)")
+    main(parser.parse_args())
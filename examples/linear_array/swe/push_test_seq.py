@@ -9,7 +9,13 @@ import numpy as np
 import arrus.ops.tgc
 import arrus.medium
 from collections import deque
-import pickle
+# Shared modules (swe_utils/, one copy for all the script directories)
+import os
+import sys
+SWE_UTILS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'swe_utils')
+if(SWE_UTILS_DIR not in sys.path):
+    sys.path.append(SWE_UTILS_DIR)
+from SWE_utils_rf import RfRecorder
 import time
 
 from arrus.ops.us4r import (
@@ -181,8 +187,9 @@ def main():
         #sess.run()
         #data = buffer.get()[0]
         sess.stop_scheme()
-        # Save last data to the file at the end
-        pickle.dump({"data":data, "metadata": metadata}, open(datafile + ".pkl", "wb"))
+        # Save the data: datafile.rf, metadata in sidecar files (read with SWE_utils_rf.open_recording)
+        with RfRecorder(datafile, metadata=metadata) as recorder:
+            recorder.append(data)
 
         print("Display closed, stopping the script.")
 
@@ -4,6 +4,8 @@ import cupy as cp
 import cupyx.scipy as cx
 import matplotlib.pyplot as plt
 import pickle
+import functools
+import threading
 
 import arrus
 import arrus.session
@@ -25,6 +27,17 @@ from arrus.devices.us4r import Us4RDTO
 from arrus.utils.imaging import *
 
 from scipy.signal import firwin, butter, buttord, freqz
+from cupyx.scipy import ndimage
+
+# SWE operations, adapted to arrus pipelines below
+# (swe_utils/SWE_utils_ops.py, the one copy shared by the script directories)
+import os
+import sys
+SWE_UTILS_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if(SWE_UTILS_DIR not in sys.path):
+    sys.path.append(SWE_UTILS_DIR)
+import SWE_utils_ops
+from SWE_utils_ops import *
 
 
 ## Probe definition ############################################
@@ -88,39 +101,55 @@ def plotSWSmap(data, px_size=0.1, tick_grid_size=[5, 5], sws_disp_range=[0, 5]):
     
     
 # TXPB Adapter Class ##############################################
+# PWI sequence of the TXPB data, the device and the raw sequence built by the arrus kernel (slow), memoized on the
+# sequence parameters so that re-preparing a pipeline reuses them. angles: tuple
+@functools.lru_cache(maxsize=16)
+def txpb_pwi_sequence(angles, center_frequency, n_periods, speed_of_sound, n_samples, fs):
+    seq = PwiSequence(
+        angles=np.asarray(angles),
+        pulse=Pulse(center_frequency=center_frequency, n_periods=n_periods, inverse=False),
+        downsampling_factor=1,
+        speed_of_sound=speed_of_sound,
+        rx_sample_range=(0, n_samples),
+        pri=100e-6 # This value is not used by the imaging code.
+    )
+    probe = ProbeDTO(PROBE_MODEL)
+    device = Us4RDTO(probe=probe, sampling_frequency=fs)
+    kernel_context = arrus.kernels.kernel.KernelExecutionContext(
+        device=device, medium=None, op=seq, custom={})
+    raw_seq = arrus.kernels.get_kernel(type(seq))(kernel_context)
+    return seq, device, raw_seq
+
+
 class TxpbAdapter(arrus.utils.imaging.Operation):
+    # metadata_sink: export of the output metadata on prepare(): None - no export, a file path (pickled there) or a
+    # callable taking the metadata. The export runs on a background thread (self.export_thread) and does not delay
+    # prepare().
 
-    def __init__(self, n_push, n_pwi, n_samples, angles, center_frequency, n_periods, speed_of_sound):
+    def __init__(self, n_push, n_pwi, n_samples, angles, center_frequency, n_periods, speed_of_sound, metadata_sink=None):
         self.n_push = n_push
         self.n_pwi = n_pwi
         self.n_samples = n_samples
         self.angles = angles
+        self.center_frequency = center_frequency
+        self.n_periods = n_periods
         self.pulse = Pulse(center_frequency=center_frequency, n_periods=n_periods,
                            inverse=False)
         self.speed_of_sound = speed_of_sound
+        self.metadata_sink = metadata_sink
+        self.export_thread = None
         self.output = None
 
     def prepare(self, const_metadata):
         N_CHANNELS = 128
         FS = 65e6
         self.output = cp.zeros((1, self.n_pwi, self.n_samples, N_CHANNELS), dtype=np.int16)
+        # Module/channel/swap mapping of the whole buffer, applied by process() with a single take
+        self.gather = cp.asarray(txpb_gather_index(self.n_push, self.n_pwi, self.n_samples))
         # Modify metadata structures so they are corresponding to the
         # the specific of the data produced by txpb.
-        seq = PwiSequence(
-            angles=self.angles,
-            pulse=self.pulse,
-            downsampling_factor=1,
-            speed_of_sound=self.speed_of_sound,
-            rx_sample_range=(0, self.n_samples),
-            pri=100e-6 # This value is not used by the imaging code.
-        )
-        #print(seq)
-        probe = ProbeDTO(PROBE_MODEL)
-        device = Us4RDTO(probe=probe, sampling_frequency=FS)
-        kernel_context = arrus.kernels.kernel.KernelExecutionContext(
-            device=device, medium=None, op=seq, custom={})
-        raw_seq = arrus.kernels.get_kernel(type(seq))(kernel_context)
-        #print(device)
+        seq, device, raw_seq = txpb_pwi_sequence(tuple(float(a) for a in np.ravel(self.angles)), self.center_frequency,
+                                                 self.n_periods, self.speed_of_sound, self.n_samples, FS)
         context = FrameAcquisitionContext(
             device,
             sequence=seq,
@@ -135,31 +164,24 @@ class TxpbAdapter(arrus.utils.imaging.Operation):
                                    data_desc=data_description,
                                    is_iq_data=False,
                                    dtype=np.int16)
-        pickle.dump(out_metadata, open("out_metadata.pkl", "wb"))
+        self.export_metadata(out_metadata)
         return out_metadata
 
-    def process(self, data):
-        module_n_samples = self.n_samples*self.n_push+self.n_samples*self.n_pwi*2
-        us4oem0_data = data[:module_n_samples, :]
-        us4oem1_data = data[module_n_samples:, :]
-
-        # Strip out push data
-        us4oem0_data = us4oem0_data[self.n_push*self.n_samples:, :]
-        us4oem0_data = us4oem0_data.reshape((self.n_pwi, 2, self.n_samples, 32))
-        us4oem1_data = us4oem1_data[self.n_push*self.n_samples:, :]
-        us4oem1_data = us4oem1_data.reshape((self.n_pwi, 2, self.n_samples, 32))
+    def export_metadata(self, out_metadata):
+        sink = self.metadata_sink
+        if(sink is None):
+            return
+        if(not callable(sink)):
+            path = sink
+            def sink(metadata):
+                with open(path, "wb") as f:
+                    pickle.dump(metadata, f)
+        self.export_thread = threading.Thread(target=sink, args=(out_metadata,))
+        self.export_thread.start()
 
-        for i in range(self.n_pwi):
-            self.output[0, i, :,   0:32] = us4oem0_data[i, 0, :, :]
-            self.output[0, i, :,  32:64] = us4oem1_data[i, 0, :, ::-1]
-            self.output[0, i, :,  64:96] = us4oem0_data[i, 1, :, :]
-            self.output[0, i, :, 96:128] = us4oem1_data[i, 1, :, ::-1]
-            # swap data centers of the second module
-            self.output[0, i, :, [15, 16]] = self.output[0, i, :, [16, 15]]
-            self.output[0, i, :, [47, 48]] = self.output[0, i, :, [48, 47]]
-            self.output[0, i, :, [79, 80]] = self.output[0, i, :, [80, 79]]
-            self.output[0, i, :, [111, 112]] = self.output[0, i, :, [112, 111]]
-        return self.output
+    def process(self, data):
+        # Reorder the data of both modules into [1, frame, sample, channel] (see txpb_gather_index)
+        return cp.take(data, self.gather, out=self.output)
 
 def compute_linear_tgc(tgc_start, tgc_slope, sample_range, c):
     start_sample, end_sample = sample_range
@@ -173,212 +195,55 @@ def compute_linear_tgc(tgc_start, tgc_slope, sample_range, c):
     return tgc_start + distance*tgc_slope
     
     
-# Operation classes ###############################################  
-    
-class AngleCompounding(Operation):
+## Operation classes ##########################################
+# The ops of SWE_utils_ops on cupy, prepare() takes the arrus const_metadata and returns the output metadata
+
+class AngleCompounding(with_default_pkgs(SWE_utils_ops.AngleCompounding, cp, ndimage)):
     # Expected input data format: 3D array [frame, x, z]
     # Output data format: 3D array [frame, x, z]
-    
-    def __init__(self, nAngles, num_pkg=None, filter_pkg=None, **kwargs):
-        self.nAngles = nAngles
-        
-        self.xp = num_pkg
-        self.filter_pkg = filter_pkg
-        self.kwargs = kwargs
-        
-    def set_pkgs(self, num_pkg, filter_pkg, **kwargs):
-        self.xp = num_pkg
-        self.filter_pkg = filter_pkg        
-    
     def prepare(self, const_metadata: arrus.metadata.ConstMetadata):
-        # Create a kernel for the convolution
-        self.kernel  = cp.ones(self.nAngles) / self.nAngles
-        
         # Metadata
         input_shape = np.asarray(const_metadata.input_shape)
+        super().prepare(n_frames=int(input_shape[0]))
+        
         output_shape = input_shape - np.array([2*self.nAngles-2, 0, 0])
         
         return const_metadata.copy(input_shape=tuple(output_shape))
-        
-    def process(self, data): 
-        # Perform the convolution 
-        data = cx.ndimage.convolve1d(data, self.kernel, axis=0)
-        # Crop the output data
-        data = data[self.nAngles-1:-self.nAngles+1,:, :]
-        return data    
     
     
-class GenerateBmode():
-    
-    def __init__(self):
-        pass
-    
-    def prepare(self):
-        pass    
-    
-    def plotHistogram(self, data):
-        data_cpu = data.get()
-        data_cpu = np.abs(data_cpu).flatten()
-        plt.hist(data_cpu, bins=128)
-        return
-    
-    def displayBmode(self, frame, dB_range):
-        frame = frame.get()
-        frame = np.squeeze(frame)
-        norm = plt.Normalize(dB_range[0], dB_range[1], True)
-        frame_dim = frame.shape
-        if(frame_dim[1] > frame_dim[0] ):
-            frame = np.transpose(frame, [1,0])
-
-        fig, ax0 = plt.subplots(1, 1, figsize=(8, 4))
-        ax0.imshow(np.abs(frame), cmap='gray', norm=norm)
-        ax0.set_title('Bmode [dB]')
-        return
-
-    def process(self, data):
-        data = cp.squeeze(data)
-        # Envelope detection
-        data = cp.abs(data)
-        # Log compression
-        data[data==0] = 10**-10
-        data = 20 * cp.log10(data)
-        return data    
-
-class ShearwaveDetection(Operation):
+class ShearwaveDetection(with_default_pkgs(SWE_utils_ops.ShearwaveDetection, cp, ndimage)):
     # Expected input data format: 3D array [frame, x, z]
     # Output data format: 3D array [z, x, frame]
-    def __init__(self, mode='kasai', packet_size=4, z_gate=4, fc=4.4e6, num_pkg=None, filter_pkg=None, **kwargs):
-        # Capture params
-        self.packet_size = packet_size
-        self.mode = mode
-        self.z_gate = z_gate 
-        self.fc = fc
-        self.xp = num_pkg
-        self.filter_pkg = filter_pkg
-        self.kwargs = kwargs 
-        
-    def set_pkgs(self, num_pkg, filter_pkg, **kwargs):
-        self.xp = num_pkg
-        self.filter_pkg = filter_pkg            
-    
     def prepare(self, const_metadata: arrus.metadata.ConstMetadata):
         #self.fc = _get_unique_pulse(const_metadata.context.sequence).center_frequency
-        self.c  = const_metadata.context.sequence.speed_of_sound
-        self.frame_pri = const_metadata.context.sequence.pri * 2
-        self.fs = const_metadata.data_description.sampling_frequency
+        c = const_metadata.context.sequence.speed_of_sound
+        frame_pri = const_metadata.context.sequence.pri * 2
+        fs = const_metadata.data_description.sampling_frequency
         
         # Metadata
         input_shape  = const_metadata.input_shape
-        output_shape = (input_shape[2]-1, input_shape[1], input_shape[0]-1)
+        super().prepare(c, frame_pri, fs, input_shape=input_shape)
+        output_shape = (len(range(0, input_shape[2]-1, self.z_stride)), input_shape[1], input_shape[0]-1)
         
         return const_metadata.copy(input_shape=output_shape, dtype=cp.float32)
-
-    def process(self, data):   
-        # Rearrange data
-        data = cp.moveaxis(data, [0,1], [2,1])
-        
-        # Shear wave detection
-        P0 = data[:-1,:,:-1] * cp.conj(data[:-1,:,1:])
-        P0 = cx.ndimage.convolve1d(P0, cp.ones(self.packet_size), axis=2)
-        P0 = cx.ndimage.convolve1d(P0, cp.ones((self.z_gate)), axis=0)
-        f_d = cp.angle(P0) / (2*cp.pi)
-        
-        if(self.mode=='loupas'):
-            P1 = data[:-1,:,:] * cp.conj(data[1:,:,:])
-            P1 = cx.ndimage.convolve1d(P1, cp.ones(self.packet_size), axis=2)
-            P1 = cx.ndimage.convolve1d(P1, cp.ones((self.z_gate)), axis=0)
-            # Estimated centeral frequency map
-            fc_shift = cp.abs(cp.angle(P1) / (2*cp.pi/self.fs))
-            fc_shift = fc_shift[:, :, 1:]
-            fc_shift[fc_shift == 0] = 1e-9
-            # Displacement
-            ddata = self.c * f_d / (2*fc_shift*self.frame_pri)
-        else:    
-            ddata = self.c * f_d / (2*self.fc*self.frame_pri )  
-        
-        return ddata
-            
-
-class ShearwaveMotionDataFiltering(Operation):
+    
+    
+class ShearwaveSNR(with_default_pkgs(SWE_utils_ops.ShearwaveSNR, cp, ndimage)):
+    # Expected input data format: 3D array [z, x, frame]
+    # Output data format: 2D array [z, x], SNR [dB] (passthrough=True: the input, unchanged)
+    def prepare(self, const_metadata: arrus.metadata.ConstMetadata):
+        input_shape = const_metadata.input_shape
+        super().prepare(input_shape)
+        if(self.passthrough):
+            return const_metadata.copy()
+        return const_metadata.copy(input_shape=tuple(input_shape[:2]))
+    
+    
+class ShearwaveMotionDataFiltering(with_default_pkgs(SWE_utils_ops.ShearwaveMotionDataFiltering, cp, ndimage)):
     # Expected data format:  3D array [z, x, frame], float32
     # Output data format: 2x 3D array [2, z, x, frame]
-    def __init__(self, sws_range, f_range, k_range, num_pkg=None, filter_pkg=None, **kwargs):
-        self.sws_range = sws_range
-        self.f_range   = f_range
-        self.k_range   = k_range
-        
-        self.xp = num_pkg
-        self.filter_pkg = filter_pkg
-        self.kwargs = kwargs 
-
-    def set_pkgs(self, num_pkg, filter_pkg, **kwargs):
-        self.xp = num_pkg
-        self.filter_pkg = filter_pkg    
-        
     def prepare(self, const_metadata: arrus.metadata.ConstMetadata):
-     
-        self.fs = 1/(const_metadata.context.sequence.pri * 2)
-        
-        # Get input data shape
-        self.data_shape = const_metadata.input_shape
-         
-        # Obtain buffer sizes
-        def nextpow2(x):
-            return int(np.ceil(np.log2(x)))
-        
-        self.nZ, self.nX, self.nFrames = self.data_shape
-        nX_padded = 2**nextpow2(self.nX)
-        nFrames_padded = 2**nextpow2(self.nFrames)
-        self.kX = [nX_padded, nFrames_padded]
-        
-        ## Create masks for filtering
-        # Basic directional mask
-        mask = np.ones(self.kX)
-        mask[:int(np.floor(self.kX[0]/2)), :int(np.floor(self.kX[1]/2))] = 0
-        mask[int(np.floor(self.kX[0]/2)):, int(np.floor(self.kX[1]/2)):] = 0
-
-        # Add filtering ranges
-        vmin = self.sws_range[0]
-        vmax = self.sws_range[1]
-
-        # Precalc values
-        w_s_max = np.ceil(self.f_range[1] * self.kX[1] / self.fs)
-        w_s_min = np.ceil(self.f_range[0] * self.kX[1] / self.fs)
-        k_s_max = np.ceil(self.k_range * self.kX[0]/2)
-
-        # Experimantal filter functions parameters
-        a_w1 = 2;
-        a_w2 = 0.2;
-        a_k  = 0.1;
-        a_v1 = 10;
-        a_v2 = 4; 
-
-        mask_f = mask;
-        for w in range(self.kX[1]):
-            for k in range(self.kX[0]):
-                w_s = np.abs(w - self.kX[1] / 2)
-                k_s = np.abs(k - self.kX[0] / 2)
-                if(k_s == 0):
-                    k_s = 1e-6;
-
-                v = np.abs(w_s / k_s)
-
-                # Calc filter coefficients
-                fw1 = 1 / (1 + np.exp(-a_w1 * (w_s - w_s_min)))
-                fw2 = 1 - 1 / (1 + np.exp(-a_w2 * (w_s - w_s_max)))
-                fw = min(fw1, fw2)
-
-                fk = 1 - 1 / (1 + np.exp(-a_k * (k_s - k_s_max)))
-
-                fv1 = 1 / (1 + np.exp(-a_v1 * (v - vmin)))
-                fv2 = 1 - 1 / (1 + np.exp(-a_v2 * (v - vmax)))
-                fv = min(fv1, fv2)
-
-                mask_f[k, w] = mask_f[k, w] * fw * fk * fv
-
-        mask_f[int(np.floor(self.kX[0]/2)), int(np.floor(self.kX[1]/2))] = 0;
-        self.mask_RL = cp.asarray(mask_f)
-        self.mask_LR = cp.asarray(np.flipud(mask_f))
+        super().prepare(const_metadata.input_shape, 1/(const_metadata.context.sequence.pri * 2))
         
         #self.plotFilterMasks()
         
@@ -388,251 +253,76 @@ class ShearwaveMotionDataFiltering(Operation):
         
         return const_metadata.copy(input_shape=output_shape)
     
-    def process(self, data):
-        # Perform the 2-D FFT
-        X = cx.fft.fft2(data, s=self.kX, axes=(1, 2), overwrite_x=True)
-        X = cx.fft.fftshift(X)        
-        
-        # Filtering in k-omega space
-        X1 = X * self.mask_RL
-        X2 = X * self.mask_LR
-        # Perform the Inverse 2-D FFT
-        X1 = cx.fft.fftshift(X1)
-        X2 = cx.fft.fftshift(X2)
-        X1 = cp.real(cx.fft.ifft2(X1, axes=(1, 2), overwrite_x=True))
-        X2 = cp.real(cx.fft.ifft2(X2, axes=(1, 2), overwrite_x=True))
-        X1 = X1[:, 0:self.nX, 0:self.nFrames] # L->R
-        X2 = X2[:, 0:self.nX, 0:self.nFrames] # R->L
-        
-        # Pack data
-        X1 = X1[np.newaxis, ...]
-        X2 = X2[np.newaxis, ...]
-        X1 = cp.real(X1)
-        X2 = cp.real(X2)
-        
-        # Debug memory
-        #mempool = cp.get_default_memory_pool()
-        #pinned_mempool = cp.get_default_pinned_memory_pool()    
-        #print("DIRFILT:Mempool used bytes [MB]: {:f}".format(mempool.used_bytes()/1024/1024))
-        #print("DIRFILT:Mempool total bytes [MB]: {:f}".format(mempool.total_bytes()/1024/1024))
-
-        
-        return cp.concatenate((X1, X2), axis=0)
-        
-        
-    def plotFilterMasks(self):
-        mask_RL_cpu = self.mask_RL.get()
-        mask_LR_cpu = self.mask_LR.get()
-        fig, (ax0, ax1) = plt.subplots(1, 2, figsize=(7, 3))
-        ax0.imshow(np.squeeze(mask_RL_cpu),   cmap='gray', aspect=0.5)
-        ax1.imshow(np.squeeze(mask_LR_cpu),   cmap='gray', aspect=0.5)
-        return
-     
-        
-              
-class SWS_Estimation(Operation):
-    # Expected data format: 2x 3D array [2, z, x, frame]
-    # Output format: 4D data: 2x 3D array: SWS: 3D array [dataset, z, x], SWS_r: 3D array [dataset, z, x]. Arrays concat'd along axis=0
-    # For example: [SWV/r, LR/RL, z, x]
-
-    def __init__(self, x_range, z_clip, frames_range, d, fri, interp_factor=5, interp_order=2, px_pitch=0.1e-3, sws_range=[0.5, 4.0],
-                num_pkg=None, filter_pkg=None, **kwargs):
-        # Params capture
-        self.x_range = x_range # for example [[0, 200], [250, 400]], so x_ranges for LR and RL datasets: [[xL_LR, xR_LR], [xL_RL, xR_RL]]
-        self.frames_range = frames_range # for example [0, 99]
-        self.z_clip = z_clip # for example [10, 30] - how many pixels to clip from top and bottom
-        self.d = d
-        self.interp_factor = interp_factor
-        self.interp_order = interp_order
-        self.px_pitch = px_pitch
-        self.sws_range = sws_range
-        self.FRI = fri
-        
-        self.xp = num_pkg
-        self.filter_pkg = filter_pkg
-        self.kwargs = kwargs 
-    
-    def set_pkgs(self, num_pkg, filter_pkg, **kwargs):
-        self.xp = num_pkg
-        self.filter_pkg = filter_pkg       
     
+class SWS_Estimation(with_default_pkgs(SWE_utils_ops.SWS_Estimation, cp, ndimage)):
+    # Expected data format: 2x 3D array [2, z, x, frame]
+    # Output format: 4D data: [SWV/r, LR/RL, z, x], [n_d, SWV/r, LR/RL, z, x] if d is a list of separations
     def prepare(self, const_metadata: arrus.metadata.ConstMetadata):
-        
-        # Get input data shape
-        data_shape = const_metadata.input_shape
-        self.out_dim = [data_shape[1], data_shape[2], data_shape[3]] # of one sub-dataset
-        
-        # Process column ranges 
-        self.xL = [0, 0]
-        self.xR = [0, 0]       
-        
-        # LR
-        self.xL[0] = self.x_range[0][0] - int(np.ceil(self.d/2)) 
-        self.xR[0] = self.x_range[0][1] + int(np.ceil(self.d/2)) 
-        if(self.xL[0] < 0):
-            self.xL[0] = 0;
-
-        if(self.xR[0] > self.out_dim[1]):
-            self.xR[0] = self.out_dim[1] 
-            
-        # RL
-        self.xL[1] = self.x_range[1][0] - int(np.ceil(self.d/2)) 
-        self.xR[1] = self.x_range[1][1] + int(np.ceil(self.d/2)) 
-        if(self.xL[1] < 0):
-            self.xL[1] = 0;
-
-        if(self.xR[1] > self.out_dim[1]):
-            self.xR[1] = self.out_dim[1]             
-            
-        # Get window function
-        N = (self.frames_range[1] - self.frames_range[0]) * self.interp_factor
-        w = sp.signal.windows.tukey(N, alpha=0.2, sym=True)
-        self.w = cp.asarray(w)
-        
-        # Other
-        self.ds = self.px_pitch * self.d
+        super().prepare(const_metadata.input_shape)
         
         ## Metadata -update output dimensions
         input_shape  = const_metadata.input_shape
         output_shape = (2, 2, input_shape[1], input_shape[2])
+        if(self.multi_d):
+            output_shape = (len(self.d_list),) + output_shape
         
         return const_metadata.copy(input_shape=output_shape)
     
     
-    def process(self, data):
-        
-        # Create output buffer
-        SWV = cp.zeros((2, 2, self.out_dim[0], self.out_dim[1]))  #[SWV/r, LR/RL,  z, x]
-        
-        # Process each sub-dataset (LR, and RL independently)
-        for i in range(2):
-            # Unpack data
-            ddata = cp.squeeze(data[i])
-        
-            # Crop data
-            ddata = ddata[self.z_clip[0]:-self.z_clip[1], self.xL[i]:self.xR[i], self.frames_range[0]:self.frames_range[1]]
-            ddata[cp.isnan(ddata)]=0
-        
-            # Data interpolation along slow-time dimension
-            ynew = cx.ndimage.zoom(input=ddata, zoom=(1, 1, self.interp_factor), output=data.dtype, order=self.interp_order)
-        
-            # DC offset cancellation
-            m = cp.mean(ynew, axis=2)
-            ynew = cp.transpose(ynew, [2,0,1])
-            ynew = cp.subtract(ynew, m)
-            ynew = cp.transpose(ynew, [1,2,0])
-        
-            # Apply window function
-            ynew = ynew * self.w
-
-            # Find normalization values
-            txa = ynew[:, 0:ynew.shape[1]-self.d, :]
-            txb = ynew[:, self.d:ynew.shape[1], :]
-            Rxa = cp.sum(txa * txa, axis=2)
-            Rxb = cp.sum(txb * txb, axis=2)
-
-            # Compute the FFT along the slow-time dim
-            X = cx.fft.rfft(ynew, axis=2, overwrite_x=True)
-
-            # Correlation in frequency domain and back to time-domain
-            Xa = X[:, 0:X.shape[1]-self.d, :]
-            Xb = X[:, self.d:X.shape[1], :]
-            c = cp.real(cx.fft.irfft(Xa * cp.conj(Xb), axis=2, overwrite_x=True))
-
-            # Shift zero
-            c = cp.concatenate((c[:, :, c.shape[2]//2:], c[:, :, :c.shape[2]//2]), axis=2)
-
-            # Normalize the correlation values
-            c = cp.transpose(c,[2, 0, 1])
-            c = c / (cp.sqrt(Rxa) * cp.sqrt(Rxb))
-            c = cp.transpose(c, [1,2,0])
-
-            ## SWS estimation post-processing
-            # find lag of max correlation
-            r = cp.amax(c, axis=2)
-            rmax_idx = cp.argmax(c, axis=2)
-
-            # Zero shift
-            rmax_idx = cp.abs(rmax_idx - c.shape[2]//2)
-            rmax_idx[rmax_idx==0] = 1 
-
-            # Calc SWS
-            dt = self.FRI * rmax_idx / self.interp_factor
-            sws_map = self.ds / dt
-
-            # Limit the values
-            sws_map = cp.clip(sws_map, self.sws_range[0], self.sws_range[1]) 
-            
-            # Aggregate the results
-            SWV[0, i, self.z_clip[0]:-self.z_clip[1], int(cp.ceil(self.xL[i] + self.d/2)) : int(cp.ceil(self.xR[i]-self.d/2))] = sws_map
-            SWV[1, i, self.z_clip[0]:-self.z_clip[1], int(cp.ceil(self.xL[i] + self.d/2)) : int(cp.ceil(self.xR[i]-self.d/2))] = r
-            
-            # Debug memory
-            #mempool = cp.get_default_memory_pool()
-            #pinned_mempool = cp.get_default_pinned_memory_pool()    
-            #print("SWS:Mempool used bytes [MB]: {:f}".format(mempool.used_bytes()/1024/1024))
-            #print("SWS:Mempool total bytes [MB]: {:f}".format(mempool.total_bytes()/1024/1024))
-
-        return SWV    
-        
-                 
-class SWS_Compounding(Operation):
-    # Input data format: 4D data: 2x 3D array: SWS: 3D array [dataset, z, x], SWS_r: 3D array [dataset, z, x]. Arrays concat'd along axis=0
-    # For example: [SWV/r, LR/RL, z, x]
-    # Output data format: 3D data: 2x 2D array: SWS: 3D array [z, x], SWS_r: 3D array [z, x]. Arrays concat'd along axis=0
-    # For example: [SWV/r, z, x]
-    def __init__(self, num_pkg=None, filter_pkg=None, **kwargs):
-        self.xp = num_pkg
-        self.filter_pkg = filter_pkg
-        self.kwargs = kwargs 
-    
+class SWS_Compounding(with_default_pkgs(SWE_utils_ops.SWS_Compounding, cp, ndimage)):
+    # Input data format: 4D data: [SWV/r, direction, z, x]
+    # Output data format: 3D data: [SWV/r, z, x], [SWV/r/conf, z, x] with confidence=True
     def prepare(self, const_metadata: arrus.metadata.ConstMetadata):
         ## Metadata -update output dimensions
         input_shape  = const_metadata.input_shape
-        output_shape = (2, input_shape[2], input_shape[3])
+        self.alloc_buffers(input_shape[2], input_shape[3], cp.float32)
+        output_shape = (self.out.shape[0], input_shape[2], input_shape[3])
         return const_metadata.copy(input_shape=output_shape)
     
-    def set_pkgs(self, num_pkg, filter_pkg, **kwargs):
-        self.xp = num_pkg
-        self.filter_pkg = filter_pkg       
-    
-    def process(self, data):
-        # Unpack data
-        SWS   = cp.squeeze(data[0])
-        SWS_r = cp.squeeze(data[1])
-        
-        # Weighted average
-        SWScr = cp.squeeze(cp.sum(SWS_r, axis=0))
-        SWScr[SWScr==0] = 10e-6
-        SWSc = SWS * SWS_r / SWScr
-        SWSc = cp.sum(SWSc, axis=0)
- 
-        # Pack data
-        SWSc  = SWSc[np.newaxis, ...]
-        SWScr = SWScr[np.newaxis, ...]
-        return np.concatenate((SWSc, SWScr), axis=0) 
-    
     
-class MedianFiltering(Operation):
+class MedianFiltering(with_default_pkgs(SWE_utils_ops.MedianFiltering, cp, ndimage)):
     # Expected data format: 3D data: 2x 2D array: SWS: 3D array [z, x], SWS_r: 3D array [z, x]. Arrays concat'd along axis=0
-    def __init__(self, kernel_size, num_pkg=None, filter_pkg=None, **kwargs):
-        self.kernel_size=kernel_size
-        self.xp = num_pkg
-        self.filter_pkg = filter_pkg
-        self.kwargs = kwargs 
-        
-    def set_pkgs(self, num_pkg, filter_pkg, **kwargs):
-        self.xp = num_pkg
-        self.filter_pkg = filter_pkg            
-    
     def prepare(self, const_metadata: arrus.metadata.ConstMetadata):
+        super().prepare()
         return const_metadata.copy() 
     
+    
+# Runs on the outputs of Pipeline.process (not a pipeline step)
+ResultPacking = with_default_pkgs(SWE_utils_ops.ResultPacking, cp, ndimage)
+    
+    
+class GenerateBmode():
+    
+    def __init__(self):
+        pass
+    
+    def prepare(self):
+        pass    
+    
+    def plotHistogram(self, data):
+        data_cpu = data.get()
+        data_cpu = np.abs(data_cpu).flatten()
+        plt.hist(data_cpu, bins=128)
+        return
+    
+    def displayBmode(self, frame, dB_range):
+        frame = frame.get()
+        frame = np.squeeze(frame)
+        norm = plt.Normalize(dB_range[0], dB_range[1], True)
+        frame_dim = frame.shape
+        if(frame_dim[1] > frame_dim[0] ):
+            frame = np.transpose(frame, [1,0])
+
+        fig, ax0 = plt.subplots(1, 1, figsize=(8, 4))
+        ax0.imshow(np.abs(frame), cmap='gray', norm=norm)
+        ax0.set_title('Bmode [dB]')
+        return
+
     def process(self, data):
-        # Unpack data
-        image = cp.squeeze(data[0])
-        #Filter image
-        image = cx.ndimage.median_filter(image, size=(self.kernel_size, self.kernel_size))
-        # Pack data
-        data[0, :, :] = image
-        return data
\ No newline at end of file
+        data = cp.squeeze(data)
+        # Envelope detection
+        data = cp.abs(data)
+        # Log compression
+        data[data==0] = 10**-10
+        data = 20 * cp.log10(data)
+        return data
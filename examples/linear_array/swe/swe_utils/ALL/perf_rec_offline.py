@@ -7,6 +7,13 @@ import os
 import time
 import argparse
 from SWE_utils_cupy_standalone import *
+# Shared modules (swe_utils/, one copy for all the script directories)
+import sys
+SWE_UTILS_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if(SWE_UTILS_DIR not in sys.path):
+    sys.path.append(SWE_UTILS_DIR)
+from SWE_utils_cache import ProductCache, run_chain
+from SWE_utils_rf import open_rf
 from scipy.signal import firwin, butter, buttord, freqz
 
 from arrus.ops.us4r import *
@@ -16,78 +23,89 @@ from arrus.devices.probe import *
 from arrus.devices.us4r import Us4RDTO
 from arrus.utils.imaging import *
 
-def main(iOrder, iFactor, gridStep, shift, idx):
-
-    
-    ### General settings ################
-    dataset_id  = idx
-    #directory   = '/media/damian/8A4F-A24E/Test11/'
-    directory = "./Parametric_tests/Test_13/"
-    directory2  = "./Parametric_tests/Test_13/rec"
-
-    # Constants
-    c              = 1540.0
-    probe_elements = 128
-    probe_pitch    = 0.298e-3
-    fs             = 65e6
-    t0             = 43
-
-    # Sequence parameters
-    pwi_txFreq   = 4.4e6
-    pwi_nCycles  = 3
-    pwi_txAngles = [-4.0, 0.0, 4.0]
-    pwi_txPri    = 80e-6
-    pwi_fri      = 2* pwi_txPri
-
-    # RF Filter
-    rf_filter_band        = [4e6, 7e6]    # Desired pass band, Hz
-    rf_filter_trans_width = 1e6           # Width of transition from pass band to stop band, Hz
-    rf_filter_numtaps     = 256 #236           # Size of the FIR filter.
-
-    # Post down conversion IQ filtering
-    demod_filter_cutoff = 0.5 * 4.4e6       # Desired cutoff frequency, Hz
-    demod_filter_trans_width = 0.5 * 4.4e6  # Width of transition from pass band to stop band, Hz
-    demod_filter_numtaps = 64
-
-    # Beamforming
-    px_size = gridStep  # in [mm]
-    x_grid = np.arange(-20, 20, px_size) * 1e-3
-    z_grid = np.arange(0, 50, px_size)   * 1e-3
-    rx_tang_limits = [-0.7, 0.7]
-
-    # Shear wave detection
-    swd_mode              = 'kasai'
-    swd_zGate_length      = int(4.0*0.2/gridStep)
-    swd_ensemble_length   = 4
-
-    # Input parameters
-    df_sws_range = [0.5, 4.5];
-    df_f_range   = [40.0, 700.0];
-    df_k_range   = 0.9;
-
-    # SWS estimation
-    swse_interp_factor = iFactor
-    swse_interp_order  = iOrder
-    swse_d             = int(20*0.2/gridStep)
-    swse_frames        = [0, 90];
-    swse_SWV_range     = [0.5, 4.5];
-    swse_x_range       = [[0, 420], [0, 420]]
-    #swse_x_range       = [[90, 300], [0, 110]]
-    swse_z_clip        = [5, 10]
-
-    # Post-processing
-    median_filter_size = int(5*0.2/gridStep)
-
+### General settings ################
+#directory   = '/media/damian/8A4F-A24E/Test11/'
+directory = "./Parametric_tests/Test_13/"
+directory2  = "./Parametric_tests/Test_13/rec"
+npy_directory = None  # memory-mapped copies of the RF datasets (None - next to the .mat files)
+
+# Constants
+c              = 1540.0
+probe_elements = 128
+probe_pitch    = 0.298e-3
+fs             = 65e6
+t0             = 43
+
+# Sequence parameters
+pwi_txFreq   = 4.4e6
+pwi_nCycles  = 3
+pwi_txAngles = [-4.0, 0.0, 4.0]
+pwi_txPri    = 80e-6
+pwi_fri      = 2* pwi_txPri
+
+# RF Filter
+rf_filter_band        = [4e6, 7e6]    # Desired pass band, Hz
+rf_filter_trans_width = 1e6           # Width of transition from pass band to stop band, Hz
+rf_filter_numtaps     = 256 #236           # Size of the FIR filter.
+
+# Post down conversion IQ filtering
+demod_filter_cutoff = 0.5 * 4.4e6       # Desired cutoff frequency, Hz
+demod_filter_trans_width = 0.5 * 4.4e6  # Width of transition from pass band to stop band, Hz
+demod_filter_numtaps = 64
+
+# Beamforming
+rx_tang_limits = [-0.7, 0.7]
+bf_x_range     = [-20, 20]   # [mm]
+bf_z_range     = [0, 50]     # [mm]
+
+# Shear wave detection
+swd_mode              = 'kasai'
+swd_ensemble_length   = 4
+swd_frame_pri         = 200e-6
+swd_fs                = 65e6
+
+# B-mode
+bmode_frame = 5
+
+# Shear wave SNR
+swsnr_signal_frames = [1, 80]
+swsnr_noise_frames  = [100, 114]
+
+# Input parameters
+df_sws_range = [0.5, 4.5];
+df_f_range   = [40.0, 700.0];
+df_k_range   = 0.9;
+
+# SWS estimation
+swse_frames        = [0, 90];
+swse_SWV_range     = [0.5, 4.5];
+swse_x_range       = [[0, 420], [0, 420]]
+#swse_x_range       = [[90, 300], [0, 110]]
+swse_z_clip        = [5, 10]
+
+
+### Processing stages ###################
+# The reconstruction is split into stages, each one depending on a subset of the parameters only:
+#   load_rf(idx, shift) -> beamform(+gridStep) -> compound -> detect(+gridStep) -> dir_filter -> estimate(+iFactor, iOrder)
+# STAGES lists them in order with the parameters (and settings) they depend on, perf_rec_sweep.py runs each stage once
+# per distinct tuple of these parameters. Stages exchange products: dicts of host (numpy) arrays, so that they can be passed between
+# processes and cached on disk (SWE_utils_cache.ProductCache, memory-mapped when read back).
+def rf_path(idx, shift):
+    return directory + 'rf_id_' + str(idx) + '_shift_' + str(shift) + '.mat'
+
+def rec_name(prefix, gridStep, iFactor, iOrder, idx, shift):
+    return directory2 + prefix + '_grid' + str(gridStep) + '_iFactor' + str(iFactor) + '_iOrder' + str(iOrder) + '_id_' + str(idx) + '_shift_' + str(shift) + '.mat'
+
+# Loads a dataset, crops the time zero and filters the RF channel data
+def load_rf(idx, shift):
     ### LOAD the dataset and crop data ###################
-    # Load a dataset
-    data = sp.io.loadmat(directory + 'rf_id_' + str(dataset_id) + '_shift_' + str(shift) + '.mat')
-    rf = data["data"]
+    # Load a dataset, memory-mapped and already transposed (converted to .npy on the first use)
+    rf = open_rf(rf_path(idx, shift), npy_dir=npy_directory)
     print("Input RF data shape:")
     print(rf.shape)
-    rf = np.transpose(rf, [0,1,3,2])
     Nframes = rf.shape[1]
 
-    # Crop the data (time zero, # of frames)
+    # Crop the data (time zero, # of frames), a view of the memory-mapped data
     rf = rf[:, :, t0:, ...]
     Nframes = rf.shape[1]
 
@@ -100,15 +118,24 @@ def main(iOrder, iFactor, gridStep, shift, idx):
     edges = [0, band[0] - trans_width, band[0], band[1], band[1] + trans_width, 0.5*fs]
     rf_fir_taps = signal.remez(numtaps, edges, [0, 1, 0], Hz=fs)
 
+    ## Perform FIR filtering
+    rf = sp.signal.lfilter(rf_fir_taps, 1, rf, axis=2)
+    return dict(rf=rf)
+
+# Demodulation and beamforming of the filtered RF data on the gridStep [mm] grid, returns the LRI frames
+def beamform(products, gridStep):
+    rf = products['rf']
+    # Beamforming
+    px_size = gridStep  # in [mm]
+    x_grid = np.arange(bf_x_range[0], bf_x_range[1], px_size) * 1e-3
+    z_grid = np.arange(bf_z_range[0], bf_z_range[1], px_size) * 1e-3
+
     ## Design a low-pass FIR filter for filtering of down-conversion products
     # Specify the filter parameters    
     cutoff = demod_filter_cutoff            # Desired cutoff frequency, Hz
     trans_width = demod_filter_trans_width  # Width of transition from pass band to stop band, Hz
     numtaps = demod_filter_numtaps          # Size of the FIR filter.
     iq_fir_taps = signal.remez(numtaps, [0, cutoff, cutoff + trans_width, 0.5*fs], [1, 0], Hz=fs)
-    
-    ## Perform FIR filtering
-    rf = sp.signal.lfilter(rf_fir_taps, 1, rf, axis=2)
 
     ## Create meatadata
     tx_angles = np.tile(pwi_txAngles, int(np.ceil(rf.shape[1]/len(pwi_txAngles))))*np.pi/180
@@ -172,14 +199,18 @@ def main(iOrder, iFactor, gridStep, shift, idx):
     ## Run the pipeline
     output = processing.process(din)
     lri_data_gpu = output[0]
+    return dict(lri=lri_data_gpu.get())
 
+# Angle compounding of the LRI frames and the B-mode of a compounded frame
+def compound(products):
     ## Compounding ################
+    lri_data_gpu = cp.asarray(products['lri'])
     AngleCompounder = AngleCompounding(nAngles=len(pwi_txAngles))
     AngleCompounder.prepare()
     hri_data_gpu = AngleCompounder.process(data=lri_data_gpu)
 
     ## Display B-mode ################
-    data = cp.squeeze(hri_data_gpu[5, ...])
+    data = cp.squeeze(hri_data_gpu[bmode_frame, ...])
     # Envelope detection
     data = cp.abs(data)
     # Log compression
@@ -188,53 +219,53 @@ def main(iOrder, iFactor, gridStep, shift, idx):
     data_dim = data.shape
     if(data_dim[1] > data_dim[0] ):
         data = np.transpose(data, [1,0])
+    return dict(hri=hri_data_gpu.get(), bmode=data.get())
 
-    # Save B-mode
-    data_cpu = data.get()
-    scipy.io.savemat(directory2 + 'bmode'   + '_grid' + str(gridStep) + '_iFactor' + str(iFactor) + '_iOrder' + str(iOrder) + '_id_' + str(idx) + '_shift_' + str(shift) + '.mat', dict(data=data_cpu)) 
-
+# Shear wave detection and SW SNR of the HRI frames
+def detect(products, gridStep):
+    # Shear wave detection
+    swd_zGate_length      = int(4.0*0.2/gridStep)
+    hri_data_gpu = cp.asarray(products['hri'])
 
     ## Shear wave detection ################
     ShearDetector = ShearwaveDetection(mode=swd_mode, packet_size=swd_ensemble_length, z_gate=swd_zGate_length, frame_pri=pwi_fri, c=c, fc=pwi_txFreq, fs=fs)
-    ShearDetector.prepare(c=c, frame_pri=200e-6, fs=65e6)
+    ShearDetector.prepare(c=c, frame_pri=swd_frame_pri, fs=swd_fs)
     ddata = ShearDetector.process(data=hri_data_gpu)
     
     ## Find SW SNR ################
-    # Get noise energy map from swd data
-    ddataE_N = ddata[:, :, 100:114]
-    m = cp.mean(ddataE_N, axis=2)
-    ddataE_N = cp.transpose(ddataE_N, [2,0,1])
-    ddataE_N = cp.subtract(ddataE_N, m)
-    ddataE_N = cp.transpose(ddataE_N, [1,2,0])
-    E_N = cp.power(ddataE_N, 2)
-    E_N = cp.squeeze(np.sum(E_N, 2))
-    E_N = E_N / ddataE_N.shape[2]
-
-    # Get signal energy map from swd data
-    ddataE_S = ddata[:, :, 1:80]
-    m = np.mean(ddataE_S, axis=2)
-    ddataE_S = np.transpose(ddataE_S, [2,0,1])
-    ddataE_S = np.subtract(ddataE_S, m)
-    ddataE_S = np.transpose(ddataE_S, [1,2,0])
-    E_S = np.power(ddataE_S, 2)
-    E_S = np.squeeze(np.sum(E_S, 2))
-    E_S = E_S / ddataE_S.shape[2]
-
-    SNR = E_S/E_N
-    SNR[SNR==0] = 10**-10
-    SNRi = 20 * cp.log10(SNR)
-
-    # Save
-    data_cpu = SNRi.get()
-    scipy.io.savemat(directory2 + 'swSNR'   + '_grid' + str(gridStep) + '_iFactor' + str(iFactor) + '_iOrder' + str(iOrder) + '_id_' + str(idx) + '_shift_' + str(shift) +'.mat', dict(data=data_cpu)) 
+    # Signal and noise energies over the swsnr frame windows of the swd data
+    SNREstimator = ShearwaveSNR(signal_frames=swsnr_signal_frames, noise_frames=swsnr_noise_frames)
+    SNREstimator.prepare(input_shape = ddata.shape)
+    SNRi = SNREstimator.process(data=ddata)
+
+    return dict(ddata=ddata.get(), snr=SNRi.get(), bmode=products['bmode'])
+
+# Directional filtering of the motion data
+def dir_filter(products):
+    ddata = cp.asarray(products['ddata'])
 
     ## Dir filtering ################
     # Shear wave motion data filtering in Fourier domain
     DirFilter = ShearwaveMotionDataFiltering(sws_range=df_sws_range, f_range=df_f_range, k_range=df_k_range)
     DirFilter.prepare(input_shape = ddata.shape, fs=1.0/pwi_fri)
     ddata_f = DirFilter.process(data=ddata)
+    return dict(ddata_f=ddata_f.get(), snr=products['snr'], bmode=products['bmode'])
+
+# SWS estimation of the filtered motion data, saves the B-mode, SNR and SWS maps of the (iFactor, iOrder) point
+def estimate(products, gridStep, iFactor, iOrder, idx, shift):
+    px_size = gridStep  # in [mm]
+
+    # SWS estimation
+    swse_interp_factor = iFactor
+    swse_interp_order  = iOrder
+    swse_d             = int(20*0.2/gridStep)
+
+    # Save B-mode and SW SNR
+    scipy.io.savemat(rec_name('bmode', gridStep, iFactor, iOrder, idx, shift), dict(data=products['bmode'])) 
+    scipy.io.savemat(rec_name('swSNR', gridStep, iFactor, iOrder, idx, shift), dict(data=products['snr'])) 
 
     ## SWS estimation ################
+    ddata_f = cp.asarray(products['ddata_f'])
     dim = ddata_f.shape
     SWS_Estimator = SWS_Estimation(x_range=swse_x_range, z_clip = swse_z_clip, frames_range = swse_frames,
                                    d=swse_d, fri = pwi_fri, interp_factor=swse_interp_factor, interp_order=swse_interp_order, 
@@ -242,7 +273,39 @@ def main(iOrder, iFactor, gridStep, shift, idx):
     SWS_Estimator.prepare(input_shape = ddata_f.shape)
     SWV = SWS_Estimator.process(data=ddata_f)
     data_cpu = SWV.get()
-    scipy.io.savemat(directory2 + 'sws' + '_grid' + str(gridStep) + '_iFactor' + str(iFactor) + '_iOrder' + str(iOrder) + '_id_' + str(idx) + '_shift_' + str(shift) + '.mat', dict(data=data_cpu))     
+    scipy.io.savemat(rec_name('sws', gridStep, iFactor, iOrder, idx, shift), dict(data=data_cpu))     
+    return dict(sws=data_cpu)
+
+# (name, function, parameters of the stage, cached, settings), each stage takes the products of the previous one as its
+# first argument. settings: the module-level settings the stage reads, they are part of its cache key along with the
+# parameters (and the stage's code), so editing any of them invalidates the cached products of the stage and of
+# everything downstream. The filtered RF data (a copy of the input) and the final SWS maps (saved to .mat) are not cached.
+STAGES = (
+    ('load_rf',    load_rf,    ('idx', 'shift'), False,
+     ('fs', 't0', 'rf_filter_band', 'rf_filter_trans_width', 'rf_filter_numtaps')),
+    ('beamform',   beamform,   ('gridStep',), True,
+     ('c', 'fs', 'probe_elements', 'probe_pitch', 'pwi_txFreq', 'pwi_nCycles', 'pwi_txAngles', 'pwi_txPri',
+      'demod_filter_cutoff', 'demod_filter_trans_width', 'demod_filter_numtaps', 'rx_tang_limits', 'bf_x_range',
+      'bf_z_range')),
+    ('compound',   compound,   (), True,
+     ('pwi_txAngles', 'bmode_frame')),
+    ('detect',     detect,     ('gridStep',), True,
+     ('c', 'fs', 'pwi_txFreq', 'pwi_fri', 'swd_mode', 'swd_ensemble_length', 'swd_frame_pri', 'swd_fs',
+      'swsnr_signal_frames', 'swsnr_noise_frames')),
+    ('dir_filter', dir_filter, (), True,
+     ('pwi_fri', 'df_sws_range', 'df_f_range', 'df_k_range')),
+    ('estimate',   estimate,   ('gridStep', 'iFactor', 'iOrder', 'idx', 'shift'), False,
+     ('pwi_fri', 'swse_frames', 'swse_SWV_range', 'swse_x_range', 'swse_z_clip', 'directory2')),
+)
+
+# cache_dir: runs only the stages downstream of the last cached product (e.g. SWS estimation only when only iFactor or
+# iOrder changed), cache_size [GB] bounds the cache
+def main(iOrder, iFactor, gridStep, shift, idx, cache_dir=None, cache_size=None):
+    point = dict(iOrder=iOrder, iFactor=iFactor, gridStep=gridStep, shift=shift, idx=idx)
+    cache = None
+    if(cache_dir is not None):
+        cache = ProductCache(cache_dir, max_bytes=None if cache_size is None else int(cache_size*2**30))
+    return run_chain(STAGES, point, cache=cache, input_file=rf_path(idx, shift))
 
     
 # Parser    
@@ -253,5 +316,7 @@ if __name__ == "__main__":
     parser.add_argument("--shift", dest="shift", type=int)
     parser.add_argument("--gridStep", dest="gridStep", type=float)
     parser.add_argument("--idx", dest="idx", type=int)
+    parser.add_argument("--cacheDir", dest="cacheDir", default=None, help="cache of the intermediate products")
+    parser.add_argument("--cacheSize", dest="cacheSize", type=float, default=None, help="cache size limit [GB]")
     args = parser.parse_args()
-    args = main(args.iOrder, args.iFactor, args.gridStep, args.shift, args.idx)      
\ No newline at end of file
+    args = main(args.iOrder, args.iFactor, args.gridStep, args.shift, args.idx, args.cacheDir, args.cacheSize)      
\ No newline at end of file
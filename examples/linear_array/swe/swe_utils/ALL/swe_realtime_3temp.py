@@ -16,6 +16,14 @@ from datetime import datetime
 #import argparse
 import TXPB_Configuration.device
 from SWE_utils_cupy_pipelined import *
+# Shared modules (swe_utils/, one copy for all the script directories)
+import os
+import sys
+SWE_UTILS_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if(SWE_UTILS_DIR not in sys.path):
+    sys.path.append(SWE_UTILS_DIR)
+from SWE_utils_scheduler import ShotScheduler, ArrusDevice
+from SWE_utils_display import LiveDisplay
 
 from arrus.ops.us4r import (
     Scheme,
@@ -126,6 +134,11 @@ swd_mode              = 'kasai'        # 'kasai' or 'loupas'
 swd_zGate_length      = 4              # Averaging z axis kernel size
 swd_ensemble_length   = 4              # Averaging slow-time axis kernel size
 
+# Shear wave SNR
+swsnr_signal_frames = [1, 80]          # Shear wave motion data frames with the shear wave [start, stop)
+swsnr_noise_frames  = [83, 97]         # Shear wave motion data frames after the shear wave has passed [start, stop)
+swsnr_threshold     = 0.0              # SWS is not displayed below this SNR [dB] (None - no gating)
+
 # Shear wave motion data filtering
 df_sws_range = [0.5, 4.5]              # SWS filtering pass band [m/s]
 df_f_range   = [40.0, 700.0]          # Shear wave motion frequency filtering passband [Hz]
@@ -176,6 +189,14 @@ if(acq_type != 'cpwi'):
     
 rx_conf += [(n_samples, pwi_pri), (n_samples, pwi_pri)]*pwi_frames
   
+# Display: its own process at most display_fps frames/s, forked before the session and GPU are initialized
+display_fps = 15
+display = LiveDisplay([dict(title='Bmode', cmap='gray', vmin=20, vmax=84, label='[dB]'),
+                       dict(title='Shear wave speed', cmap='jet', vmin=0, vmax=5, label='[m/s]'),
+                       dict(title='Shear wave motion', cmap='jet', vmin=-1e-3, vmax=2e-3, label='[m/s]')],
+                      grid_step=grid_step, tick_spacing=(10, 10), max_fps=display_fps, start_method='fork')
+display.start()
+
 # Here starts communication with the device.
 with arrus.Session("./us4r.prototxt") as sess:
     us4r = sess.get_device("/Us4R:0")
@@ -218,6 +239,13 @@ with arrus.Session("./us4r.prototxt") as sess:
         work_mode="MANUAL",
     )
     
+    # Output and scratch buffers of the SWE ops, allocated at the first shot and reused by all the next ones
+    buffer_pool = BufferPool(cp)
+    
+    # Shear wave SNR, passes the motion data through and gates the SWS map
+    SNREstimator = ShearwaveSNR(signal_frames=swsnr_signal_frames, noise_frames=swsnr_noise_frames,
+                                threshold=swsnr_threshold, passthrough=True, buffer_pool=buffer_pool)
+    
     processing = Pipeline(
             steps=(
                 TxpbAdapter(
@@ -230,17 +258,21 @@ with arrus.Session("./us4r.prototxt") as sess:
                 Decimation(filter_type="fir", filter_coeffs=iq_fir_taps, decimation_factor=1),
                 ReconstructLri(x_grid=x_grid, z_grid=z_grid, rx_tang_limits=rx_tang_limits),
                 Squeeze(),
-                AngleCompounding(nAngles=len(pwi_tx_angles)),
+                AngleCompounding(nAngles=len(pwi_tx_angles), buffer_pool=buffer_pool),
                 Pipeline(
                     steps=(
-                        ShearwaveDetection(mode=swd_mode, packet_size=swd_ensemble_length, z_gate=swd_zGate_length, fc=pwi_tx_freq),
+                        ShearwaveDetection(mode=swd_mode, packet_size=swd_ensemble_length, z_gate=swd_zGate_length, fc=pwi_tx_freq,
+                                           single_precision=True, buffer_pool=buffer_pool),
+                        SNREstimator,
                         #Output(),
                         ShearwaveMotionDataFiltering(sws_range=df_sws_range, f_range=df_f_range, k_range=df_k_range),
                         Output(),
                         SWS_Estimation(x_range=swse_x_range, z_clip = swse_z_clip, frames_range = swse_frames, d=swse_d, fri=pwi_pri*2*1e-6,
-                                       interp_factor=swse_interp_factor, interp_order=swse_interp_order, px_pitch=grid_step*1e-3, sws_range=swse_SWV_range),
-                        SWS_Compounding(),
-                        MedianFiltering(kernel_size=median_filter_size)
+                                       interp_factor=swse_interp_factor, interp_order=swse_interp_order, px_pitch=grid_step*1e-3, sws_range=swse_SWV_range,
+                                       buffer_pool=buffer_pool),
+                        SWS_Compounding(buffer_pool=buffer_pool),
+                        MedianFiltering(kernel_size=median_filter_size, buffer_pool=buffer_pool),
+                        Lambda(lambda data: SNREstimator.gate(data), lambda metadata: metadata)
                     ),
                     placement="/GPU:0"
                 ),
@@ -250,10 +282,10 @@ with arrus.Session("./us4r.prototxt") as sess:
         )
     
        
-    # Prepare GPU memory control utilities
-    fft_plan_cache = cp.fft.config.get_plan_cache()
+    # GPU memory: the FFT plans and the memory pool blocks of the temporaries are kept from shot to shot (freeing
+    # them every shot made each shot re-plan and re-allocate), only their growth is reported
     mempool = cp.get_default_memory_pool()
-    pinned_mempool = cp.get_default_pinned_memory_pool()    
+    n_allocs, pool_bytes = 0, 0
  
     # Configure TX
     txpb = TXPB_Configuration.device.TXPB()
@@ -316,157 +348,55 @@ with arrus.Session("./us4r.prototxt") as sess:
         print('Could not open TXPB communication link ...')
         txpb_issue = 1
         
-    # Prepare for display
-    plt.ion() 
-    dB_range = [20, 84] 
-    norm_bmode = plt.Normalize(dB_range[0], dB_range[1], True)
-    Vrange=[-1e-3, 2e-3]
-    norm_swd = plt.Normalize(Vrange[0], Vrange[1], True)
-    norm_sws = plt.Normalize(0, 5, True)
-    norm_r   = plt.Normalize(0, 2, True)
-    y_grid = 10  #[mm]
-    x_grid = 10  #[mm]    
-    
-    fig, (ax0, ax2, ax1) = plt.subplots(1, 3, figsize=(15, 4))
-    fig.canvas.draw()
-    fig.canvas.flush_events()  
-    
-    
     # Upload the scheme on the us4r-lite device.
-    from queue import Queue
-    q = Queue(maxsize=1)
     if(txpb_issue == 0):
         buffer, metadata = sess.upload(scheme)
         
-        def cbk(input_element):
-            q.put(input_element.data)
-            input_element.release()
-        
-        buffer.append_on_new_data_callback(cbk)
+        # Shot N+1 is acquired (and the TXPB reloaded) by the scheduler while shot N is processed and displayed
+        scheduler = ShotScheduler(ArrusDevice(sess, buffer, metadata, txpb=txpb), n_buffers=2)
         
         processing.prepare(metadata)
         
-        for i in range(120):
-            # Start the scheme.
+        # Display images of a shot: post-processed on the GPU, packed and copied to the host in one transfer
+        crop = (slice(swse_z_clip[0], -swse_z_clip[1]), slice(swse_d//2, -swse_d//2))
+        def bmode_db(xp, outputs, out):
+            bmode = outputs[0]
+            if(bmode.shape[1] > bmode.shape[0]):
+                bmode = bmode.T
+            return envelope_db(bmode[crop], xp=xp, out=out)
+        def motion(xp, outputs, out):
+            swdf = outputs[2] # [LR/RL, z, x, frame]
+            return xp.add(swdf[0][crop][:, :, 2], swdf[1][crop][:, :, 2], out=out)
+        packing = ResultPacking([('bmode', bmode_db),
+                                 ('sws', lambda xp, outputs, out: outputs[1][0][crop]),
+                                 ('motion', motion)])
+        packing.prepare()
+        
+        for i, rf_cpu_data in scheduler.shots(120):
             start = time.time()
-            sess.run()
 
-            # Get and save data
-            rf_cpu_data = q.get()
+            # Process the data
             cpu_data = processing.process(cp.asarray(rf_cpu_data))
             
             end = time.time()
             print(end - start)
 
-            Bmode = cpu_data[0]
-            sws   = cpu_data[1].get()
-            swdf  = cpu_data[2]
-            #swd   = cpu_data[2]
-
-            # Post-processing for Bmode
-                # Envelope detection
-            data = cp.abs(Bmode)
-                # Log compression
-            data[data==0] = 10**-10
-            data = 20 * cp.log10(data)
-            data_dim = data.shape
-            if(data_dim[1] > data_dim[0] ):
-                data = cp.transpose(data, [1,0])
-            data = data.get()    
-                
-            # Post processing for swdf
-            swdf = cp.squeeze(swdf[0, ...] + swdf[1, ...])
-            swdf = swdf.get()
-
-            # Print first frames and format  
-            if(i == 0): # only at first run
-                
-                swsIm = sws[0, swse_z_clip[0]:-swse_z_clip[1], swse_d//2:-swse_d//2]
-                
-                axim0 = ax0.imshow(data[swse_z_clip[0]:-swse_z_clip[1], swse_d//2:-swse_d//2], cmap='gray', norm=norm_bmode) 
-                axim1 = ax1.imshow(swdf[swse_z_clip[0]:-swse_z_clip[1], swse_d//2:-swse_d//2, 0], cmap='jet', norm=norm_swd) 
-                axim2 = ax2.imshow(swsIm, cmap='jet', norm=norm_sws) 
-                #axim3 = ax3.imshow(sws[1], cmap='jet', norm=norm_r)
-                
-                fig.colorbar(axim0, ax=ax0, label='[dB]')
-                fig.colorbar(axim1, ax=ax1, label='[m/s]')
-                fig.colorbar(axim2, ax=ax2, label='[m/s]')
-                
-                # Assign ticks
-                sws_dim = swsIm.shape
-
-                yticks  = np.arange(0, sws_dim[0]-1, int(np.ceil(y_grid / grid_step))) 
-                yticks_labels = yticks * grid_step
-                yticks_labels = [str(int(x)) for x in yticks_labels]
-
-                m = int(sws_dim[1]//2)
-                a = np.arange(m, 0, -int(np.ceil(x_grid / grid_step)))
-                b = np.arange(m, sws_dim[1]-1, int(np.ceil(x_grid / grid_step)))
-                xticks = np.concatenate((a[1:], b))
-                xticks_labels = (xticks - m) * grid_step
-                xticks_labels = [str(int(x)) for x in xticks_labels]
-                
-                ax0.set_xticks(xticks)
-                ax0.set_xticklabels(xticks_labels) 
-                ax0.set_yticks(yticks)
-                ax0.set_yticklabels(yticks_labels)
-                
-                ax1.set_xticks(xticks)
-                ax1.set_xticklabels(xticks_labels) 
-                ax1.set_yticks(yticks)
-                ax1.set_yticklabels(yticks_labels)
-                
-                ax2.set_xticks(xticks)
-                ax2.set_xticklabels(xticks_labels) 
-                ax2.set_yticks(yticks)
-                ax2.set_yticklabels(yticks_labels)
-                
-                # Set labels
-                ax0.set_title('Bmode')
-                ax0.set_xlabel('x [mm]')
-                ax0.set_ylabel('z [mm]')
-                ax1.set_title('Shear wave motion')
-                ax1.set_xlabel('x [mm]')
-                ax1.set_ylabel('z [mm]')                   
-                ax2.set_title('Shear wave speed')
-                ax2.set_xlabel('x [mm]')
-                ax2.set_ylabel('z [mm]')                
-                #ax3.set_title('r [0..1]')
-
-            
-            # Update images display
-            axim0.set_data(data[swse_z_clip[0]:-swse_z_clip[1], swse_d//2:-swse_d//2])
-            axim2.set_data(sws[0, swse_z_clip[0]:-swse_z_clip[1], swse_d//2:-swse_d//2])
-            #axim3.set_data(sws[1])
-            
-            swdf = swdf[swse_z_clip[0]:-swse_z_clip[1], swse_d//2:-swse_d//2, :]
-            axim1.set_data(swdf[:, :, 2])
-            fig.canvas.flush_events()
-            fig.canvas.flush_events()
-            
-            #for j in range(3): # FPS defined here!
-                #axim1.set_data(swdf[:, :, j*10])
-                #fig.canvas.flush_events()
+            # Hand the images over to the display (does not wait for it)
+            images = packing.process(cpu_data)
+            display.show(images['bmode'], images['sws'], images['motion'])
                 
             # Dump some data  
-            #scipy.io.savemat(path + 'swd' + str(i) + '.mat', dict(data=swdf[:, :, 2]))  
-            #scipy.io.savemat(path + 'sws' + str(i) + '.mat', dict(data=sws))  
+            #scipy.io.savemat(path + 'swd' + str(i) + '.mat', dict(data=images['motion']))  
+            #scipy.io.savemat(path + 'sws' + str(i) + '.mat', dict(data=images['sws']))  
 
-            # Reload TXPB
-            txpb.reset_scan_table_index()
-            time.sleep(0.01)
-            txpb.preload_req()
-            
             # Delete variables
             del cpu_data
-            del Bmode
-            #del sws
-            del swdf
                 
-            # Clear GPU memory
-            fft_plan_cache.clear()
-            mempool.free_all_blocks()
-            pinned_mempool.free_all_blocks()
+            # GPU memory growth after the first shot
+            if(i > 0 and (buffer_pool.n_allocs != n_allocs or mempool.total_bytes() != pool_bytes)):
+                print("GPU memory grew: " + str(buffer_pool.n_allocs - n_allocs) + " buffer(s), "
+                      + str(mempool.total_bytes() - pool_bytes) + " bytes in the memory pool")
+            n_allocs, pool_bytes = buffer_pool.n_allocs, mempool.total_bytes()
 
      
     else:
@@ -476,6 +406,7 @@ with arrus.Session("./us4r.prototxt") as sess:
 txpb.set_hw_trigger_enable(enable=0) 
 time.sleep(0.1)
 txpb.close()
+display.close()
 
 print("Stopping the example.")
 
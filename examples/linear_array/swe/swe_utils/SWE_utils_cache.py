@@ -0,0 +1,151 @@
+import os
+import json
+import time
+import shutil
+import inspect
+import hashlib
+import numpy as np
+
+# On-disk cache of intermediate SWE products (LRI/HRI cubes, displacement data, ...).
+# An entry is a directory of .npy files, one per product of a stage (dict name -> array), loaded memory-mapped.
+# Entries are content-addressed: the key is a hash of the stage name, the stage parameters (including its
+# configuration, see chain_keys) and the key of the upstream entry (or the input file identity for the first stage), so
+# a change of any parameter invalidates everything downstream of it only. The cache is bounded to max_bytes, the least recently used entries are evicted first.
+#
+# Example:
+#   cache = ProductCache('./swe_cache', max_bytes=20*2**30)
+#   key = cache.key('beamform', dict(gridStep=0.2), input_file='rf_id_0_shift_0.mat')
+#   if(key not in cache):
+#       cache.put(key, dict(lri=lri_data))
+#   lri_data = cache.get(key)['lri']
+
+class ProductCache():
+
+    def __init__(self, directory, max_bytes=None):
+        self.directory = directory
+        self.max_bytes = max_bytes # None - unbounded
+        os.makedirs(directory, exist_ok=True)
+
+    # Input files are identified by their path, size and modification time (hashing the contents of the raw
+    # recordings would cost as much as reading them)
+    def key(self, stage, params, upstream_key=None, input_file=None):
+        desc = dict(stage=stage, params=params, upstream=upstream_key)
+        if(input_file is not None):
+            st = os.stat(input_file)
+            desc['input'] = [os.path.abspath(input_file), st.st_size, st.st_mtime_ns]
+        return hashlib.sha1(json.dumps(desc, sort_keys=True, default=str).encode()).hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.directory, key)
+
+    def __contains__(self, key):
+        return os.path.isdir(self.path(key))
+
+    # Products of an entry as memory-mapped arrays (mmap_mode=None loads them), None if not cached
+    def get(self, key, mmap_mode='r'):
+        path = self.path(key)
+        try:
+            names = os.listdir(path)
+            products = {name[:-4]: np.load(os.path.join(path, name), mmap_mode=mmap_mode) for name in names}
+        except FileNotFoundError:
+            return None
+        # Mark as recently used
+        os.utime(path)
+        return products
+
+    # Writes the products (dict name -> array, cupy arrays are copied to the host) of an entry, then evicts the least
+    # recently used entries above max_bytes. The entry is written aside and renamed, concurrent writers of the same key
+    # (e.g. sweep workers) keep the first one.
+    def put(self, key, products):
+        path = self.path(key)
+        tmp = path + '.tmp-' + str(os.getpid())
+        os.makedirs(tmp, exist_ok=True)
+        for name, data in products.items():
+            if(hasattr(data, 'get')):
+                data = data.get()
+            np.save(os.path.join(tmp, name + '.npy'), data)
+        try:
+            os.rename(tmp, path)
+        except OSError:
+            shutil.rmtree(tmp, ignore_errors=True)
+        self.evict(keep=key)
+
+    def entry_size(self, key):
+        path = self.path(key)
+        return sum(os.path.getsize(os.path.join(path, name)) for name in os.listdir(path))
+
+    # (last use, size, key) of the entries, least recently used first
+    def entries(self):
+        entries = []
+        for key in os.listdir(self.directory):
+            path = self.path(key)
+            if('.tmp-' in key or not os.path.isdir(path)):
+                continue
+            try:
+                entries.append((os.path.getmtime(path), self.entry_size(key), key))
+            except FileNotFoundError:
+                continue # evicted by another process
+        return sorted(entries)
+
+    def size(self):
+        return sum(size for _, size, _ in self.entries())
+
+    def evict(self, keep=None):
+        if(self.max_bytes is None):
+            return
+        entries = self.entries()
+        total = sum(size for _, size, _ in entries)
+        for _, size, key in entries:
+            if(total <= self.max_bytes):
+                break
+            if(key == keep):
+                continue
+            shutil.rmtree(self.path(key), ignore_errors=True)
+            total -= size
+
+
+## Stage chains ################################################
+# A chain is a sequence of stages (name, function, parameter names, cached, setting names), the first stage is called
+# with its parameters only, the next ones with the products (dict) of the previous one and their parameters.
+# Settings are the module-level globals of the stage function it reads (e.g. filter designs, frame windows): their
+# current values and the source code of the function go into the cache key along with the parameters, so that editing
+# a setting or the stage misses the cache.
+def stage_config(fn, settings):
+    return dict(settings={name: fn.__globals__[name] for name in settings},
+                code=hashlib.sha1(inspect.getsource(fn).encode()).hexdigest())
+
+# The cache keys of the stages of one parameter point, input_file is the input of the first stage.
+def chain_keys(cache, stages, point, input_file=None):
+    keys = []
+    upstream = None
+    for i, (name, fn, params, cached, settings) in enumerate(stages):
+        params = dict({p: point[p] for p in params}, config=stage_config(fn, settings))
+        upstream = cache.key(name, params, upstream, input_file if i == 0 else None)
+        keys.append(upstream)
+    return keys
+
+def run_stage(fn, products, params):
+    return fn(**params) if products is None else fn(products, **params)
+
+# Runs the chain for one parameter point, starting after the last stage whose products are cached.
+# Returns the products of the last stage.
+def run_chain(stages, point, cache=None, input_file=None):
+    start = 0
+    products = None
+    if(cache is not None):
+        keys = chain_keys(cache, stages, point, input_file)
+        for i in reversed(range(len(stages))):
+            if(stages[i][3] and keys[i] in cache):
+                products = cache.get(keys[i])
+                if(products is not None):
+                    start = i + 1
+                    break
+
+    for i in range(start, len(stages)):
+        name, fn, params, cached, settings = stages[i]
+        t = time.time()
+        products = run_stage(fn, products, {p: point[p] for p in params})
+        print("{:10s} done in {:.1f} s".format(name, time.time() - t))
+        if(cache is not None and cached):
+            cache.put(keys[i], products)
+    return products
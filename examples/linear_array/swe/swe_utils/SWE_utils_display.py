@@ -0,0 +1,201 @@
+import time
+import queue
+import threading
+import multiprocessing
+import numpy as np
+
+# Realtime display of the SWE results, decoupled from the processing.
+# The processing loop hands the images of the last shot over to a single-slot mailbox (show() never waits, an image
+# set the display has not picked up yet is replaced by the newer one) and a display loop renders the latest one at
+# most max_fps times per second. The layout (images, colorbars, ticks) is built once on the first images, then only
+# the image artists are redrawn over a cached background (blitting).
+# mode='process': the display loop runs in its own process with its own GUI event loop, so the GUI cost does not
+# share the interpreter with the processing. A spawned process imports the main module again: scripts without a
+# __main__ guard use start_method='fork' and start the display before opening the session (and before any GPU use).
+# mode='thread': a thread of this process, for non-interactive backends only (e.g. Agg, matplotlib GUIs have to run
+# on the main thread of their process).
+#
+# Example:
+#   display = LiveDisplay([dict(title='Bmode', cmap='gray', vmin=20, vmax=84, label='[dB]'),
+#                          dict(title='Shear wave speed', cmap='jet', vmin=0, vmax=5, label='[m/s]')],
+#                         grid_step=0.25, max_fps=15)
+#   display.start()
+#   for ...:
+#       display.show(bmode, sws) # 2D images [z, x]
+#   display.close()
+
+
+# Single-slot mailbox (one producer): put() replaces an item not yet taken and never waits, get() waits for the next one.
+# ctx: multiprocessing context for a consumer in another process, None - threads of this process.
+class Mailbox():
+
+    def __init__(self, ctx=None):
+        self.queue = queue.Queue(maxsize=1) if ctx is None else ctx.Queue(maxsize=1)
+        self.n_dropped = 0
+
+    def put(self, item):
+        try:
+            self.queue.put_nowait(item)
+            return
+        except queue.Full:
+            pass
+        try:
+            self.queue.get_nowait()
+            self.n_dropped += 1
+        except queue.Empty:
+            pass # taken meanwhile
+        try:
+            self.queue.put_nowait(item)
+        except queue.Full:
+            # Slot neither taken nor freed (a consumer process died while holding the queue lock): item dropped
+            self.n_dropped += 1
+
+    def get(self, timeout=None):
+        return self.queue.get(timeout=timeout)
+
+
+# Ticks every spacing [mm] of an image [z, x] on a grid_step [mm] grid, (z, x) steps for a grid decimated in depth
+# (e.g. ShearwaveDetection z_stride): depth from the top row, lateral from the centre column.
+# Returns (xticks, xlabels, yticks, ylabels).
+def grid_ticks(shape, grid_step, spacing=(10, 10)):
+    z_step, x_step = np.broadcast_to(grid_step, (2,))
+    yticks = np.arange(0, shape[0]-1, int(np.ceil(spacing[0] / z_step)))
+    m = int(shape[1]//2)
+    a = np.arange(m, 0, -int(np.ceil(spacing[1] / x_step)))
+    b = np.arange(m, shape[1]-1, int(np.ceil(spacing[1] / x_step)))
+    xticks = np.concatenate((a[1:], b))
+    return (xticks, [str(int(x)) for x in (xticks - m) * x_step],
+            yticks, [str(int(y)) for y in yticks * z_step])
+
+
+# Display loop (module level: the target of the display process). Renders the latest images until a None item.
+def display_loop(mailbox, panels, grid_step, tick_spacing, max_fps, figsize, backend=None):
+    import matplotlib
+    if(backend is not None):
+        matplotlib.use(backend)
+    import matplotlib.pyplot as plt
+
+    fig, axes, artists, background = None, None, None, None
+    period = 1 / max_fps
+    while(True):
+        # Waiting for the next images keeps the GUI event loop running (redraws, resizes, close events)
+        try:
+            images = mailbox.get(timeout=period)
+        except queue.Empty:
+            if(fig is not None):
+                fig.canvas.flush_events()
+            continue
+        if(images is None):
+            break
+        t0 = time.perf_counter()
+
+        # Layout, once
+        if(fig is None):
+            plt.ion()
+            fig, axes = plt.subplots(1, len(panels), figsize=figsize, squeeze=False)
+            axes = axes[0]
+            xticks, xlabels, yticks, ylabels = grid_ticks(images[0].shape, grid_step, tick_spacing)
+            z_step, x_step = np.broadcast_to(grid_step, (2,))
+            aspect = z_step / x_step # pixels of the grid steps
+            artists = []
+            for ax, panel, image in zip(axes, panels, images):
+                im = ax.imshow(image, cmap=panel.get('cmap', 'gray'), vmin=panel.get('vmin'), vmax=panel.get('vmax'),
+                               aspect=aspect, animated=True)
+                fig.colorbar(im, ax=ax, label=panel.get('label', ''))
+                ax.set_xticks(xticks)
+                ax.set_xticklabels(xlabels)
+                ax.set_yticks(yticks)
+                ax.set_yticklabels(ylabels)
+                ax.set_title(panel.get('title', ''))
+                ax.set_xlabel('x [mm]')
+                ax.set_ylabel('z [mm]')
+                artists.append(im)
+
+            # Background without the images, captured again after every full redraw (e.g. a window resize)
+            def capture(event=None):
+                nonlocal background
+                background = fig.canvas.copy_from_bbox(fig.bbox)
+                for ax, im in zip(axes, artists):
+                    ax.draw_artist(im)
+            fig.canvas.mpl_connect('draw_event', capture)
+            fig.canvas.draw()
+
+        # Blit the new images
+        fig.canvas.restore_region(background)
+        for ax, im, image in zip(axes, artists, images):
+            im.set_data(image)
+            ax.draw_artist(im)
+        fig.canvas.blit(fig.bbox)
+        fig.canvas.flush_events()
+
+        # Frame rate limit, the images arriving meanwhile replace each other in the mailbox. The GUI event loop runs
+        # during the wait, the window stays responsive between frames
+        wait = period - (time.perf_counter() - t0)
+        if(wait > 0):
+            fig.canvas.start_event_loop(wait)
+    if(fig is not None):
+        plt.close(fig)
+
+
+class LiveDisplay():
+
+    # panels: per image dict(title, cmap, vmin, vmax, label), grid_step [mm] (or (z, x)), tick_spacing [mm] (z, x)
+    def __init__(self, panels, grid_step, tick_spacing=(10, 10), max_fps=20, mode='process', start_method='spawn',
+                 figsize=(15, 4), backend=None):
+        if(mode not in ('process', 'thread')):
+            raise ValueError("Unknown mode: " + str(mode))
+        self.start_method = start_method
+        self.panels = panels
+        self.grid_step = grid_step
+        self.tick_spacing = tick_spacing
+        self.max_fps = max_fps
+        self.mode = mode
+        self.figsize = figsize
+        self.backend = backend # matplotlib backend of the display loop (None - default)
+        self.worker = None
+        self.n_shown = 0
+
+    def start(self):
+        args = (self.panels, self.grid_step, self.tick_spacing, self.max_fps, self.figsize, self.backend)
+        if(self.mode == 'process'):
+            ctx = multiprocessing.get_context(self.start_method)
+            self.mailbox = Mailbox(ctx)
+            self.worker = ctx.Process(target=display_loop, args=(self.mailbox,) + args, daemon=True)
+        else:
+            self.mailbox = Mailbox()
+            self.worker = threading.Thread(target=display_loop, args=(self.mailbox,) + args, daemon=True)
+        self.worker.start()
+
+    # Images of one shot (host arrays, one per panel), never waits for the display. The images are copied, the
+    # caller can reuse its buffers.
+    def show(self, *images):
+        self.mailbox.put(tuple(np.array(image, copy=True) for image in images))
+        self.n_shown += 1
+
+    # Ends the display loop, waiting at most timeout [s] for the last images to be taken and for the loop to end.
+    # A display process that does not end (dead or stuck) is terminated, a display thread is left behind (daemon).
+    def close(self, timeout=5.0):
+        if(self.worker is None):
+            return
+        try:
+            self.mailbox.queue.put(None, timeout=timeout)
+            self.worker.join(timeout)
+        except queue.Full:
+            pass # the display does not take its images (dead or stuck)
+        if(self.worker.is_alive()):
+            if(self.mode == 'process'):
+                self.worker.terminate()
+                self.worker.join(timeout)
+                if(self.worker.is_alive()):
+                    self.worker.kill() # e.g. a stopped process, deaf to SIGTERM
+                    self.worker.join()
+                # Do not wait at exit for the queue to flush to the terminated process
+                self.mailbox.queue.cancel_join_thread()
+            else:
+                print("LiveDisplay: the display thread did not end within " + str(timeout) + " s")
+        self.worker = None
+
+    # Image sets replaced in the mailbox before being displayed
+    @property
+    def n_dropped(self):
+        return self.mailbox.n_dropped
@@ -0,0 +1,1135 @@
+# Backend-agnostic SWE processing operations.
+#
+# Every op computes with the array package given by num_pkg (numpy or cupy) and the matching ndimage package
+# given by filter_pkg (scipy.ndimage or cupyx.scipy.ndimage), the same hook arrus Pipeline uses (set_pkgs).
+# Without them the ops run on numpy/scipy, so the whole chain can be run and checked on CPU-only machines.
+# The prepare() methods take plain parameters (standalone API); SWE_utils_cupy_pipelined.py adapts them to
+# arrus const_metadata, SWE_utils_numpy_standalone.py and SWE_utils_cupy_standalone.py bind the packages.
+import numpy as np
+import scipy as sp
+import scipy.fft
+import scipy.ndimage
+import scipy.signal
+import matplotlib.pyplot as plt
+import functools
+import hashlib
+import os
+
+try:
+    from arrus.utils.imaging import Operation
+except ImportError:
+    # arrus is only needed to run the ops inside an arrus Pipeline
+    class Operation:
+        pass
+
+
+## Backend packages ############################################
+# (array, ndimage, fft) packages of an op. num_pkg/filter_pkg are the ones set by arrus Pipeline.set_pkgs
+# (numpy + scipy.ndimage or cupy + cupyx.scipy.ndimage), None selects numpy/scipy.
+def get_pkgs(num_pkg=None, filter_pkg=None):
+    xp = np if num_pkg is None else num_pkg
+    if(xp is np):
+        return xp, (sp.ndimage if filter_pkg is None else filter_pkg), sp.fft
+    import cupyx.scipy.fft
+    import cupyx.scipy.ndimage
+    return xp, (cupyx.scipy.ndimage if filter_pkg is None else filter_pkg), cupyx.scipy.fft
+
+# Subclass of an op whose instances default to the given packages instead of numpy/scipy
+def with_default_pkgs(op_class, num_pkg, filter_pkg):
+    class Op(op_class):
+        def __init__(self, *args, num_pkg=num_pkg, filter_pkg=filter_pkg, **kwargs):
+            super().__init__(*args, num_pkg=num_pkg, filter_pkg=filter_pkg, **kwargs)
+    Op.__name__ = op_class.__name__
+    Op.__qualname__ = op_class.__qualname__
+    return Op
+
+# numpy copy of a numpy or cupy array
+def to_host(data):
+    return data.get() if hasattr(data, 'get') else np.asarray(data)
+
+
+## Buffer pool #################################################
+# Persistent, size-bucketed buffers shared by the ops of a chain, so that a realtime loop allocates nothing per shot.
+# The ops declare their output and scratch buffers in prepare() (see op_buffer): each (op, name) slot keeps its
+# block as long as it is large enough, blocks released by an op go to a free list per size bucket (powers of two)
+# and are handed out again before anything new is allocated. n_allocs counts the actual allocations, it stays
+# constant after a warm-up call of the chain.
+class BufferPool():
+
+    def __init__(self, xp=np, min_bucket=256):
+        self.xp = xp
+        self.min_bucket = min_bucket
+        self.slots = {} # (id(op), name) -> block
+        self.free  = {} # bucket size -> [block]
+        self.n_allocs = 0
+        self.n_bytes  = 0
+    
+    def bucket(self, nbytes):
+        return max(self.min_bucket, 1 << (int(nbytes) - 1).bit_length())
+    
+    def acquire(self, nbytes):
+        bucket = self.bucket(nbytes)
+        if(self.free.get(bucket)):
+            return self.free[bucket].pop()
+        self.n_allocs += 1
+        self.n_bytes  += bucket
+        return self.xp.empty(bucket, dtype=np.uint8)
+    
+    # Array of the given shape and dtype in the (op, name) slot, uninitialized
+    def empty(self, op, name, shape, dtype):
+        dtype = np.dtype(dtype)
+        shape = (int(shape),) if np.isscalar(shape) else tuple(int(n) for n in shape)
+        nbytes = int(np.prod(shape)) * dtype.itemsize
+        key = (id(op), name)
+        block = self.slots.get(key)
+        if(block is None or block.nbytes < nbytes):
+            if(block is not None):
+                self.free.setdefault(block.nbytes, []).append(block)
+            block = self.acquire(nbytes)
+            self.slots[key] = block
+        return block[:nbytes].view(dtype).reshape(shape)
+    
+    # Returns the blocks of an op to the free lists (e.g. before it is prepared again or dropped)
+    def release(self, op):
+        for key in [key for key in self.slots if key[0] == id(op)]:
+            block = self.slots.pop(key)
+            self.free.setdefault(block.nbytes, []).append(block)
+
+# Output/scratch buffer of an op: from its buffer_pool if it has one, a new array otherwise
+def op_buffer(op, name, shape, dtype):
+    if(getattr(op, 'buffer_pool', None) is None):
+        return op.xp.empty(shape, dtype=dtype)
+    return op.buffer_pool.empty(op, name, shape, dtype)
+
+
+## k-omega filter masks ########################################
+# Experimental slopes of the filter sigmoid functions: (a_w1, a_w2, a_k, a_v1, a_v2)
+KW_MASK_SLOPES = (2, 0.2, 0.1, 10, 4)
+
+def _sigmoid(x, a, x0):
+    with np.errstate(over='ignore'):
+        return 1 / (1 + np.exp(-a * (x - x0)))
+
+def _kw_mask_key(kX, fs, sws_range, f_range, k_range, slopes):
+    # Hashable cache key, lists are not hashable
+    return (tuple(int(k) for k in kX), float(fs), tuple(float(v) for v in sws_range),
+            tuple(float(f) for f in f_range), float(k_range), tuple(float(a) for a in slopes))
+
+@functools.lru_cache(maxsize=16)
+def _build_kw_mask(kX, fs, sws_range, f_range, k_range, slopes):
+    a_w1, a_w2, a_k, a_v1, a_v2 = slopes
+    vmin, vmax = sws_range
+
+    # Precalc values
+    w_s_max = np.ceil(f_range[1] * kX[1] / fs)
+    w_s_min = np.ceil(f_range[0] * kX[1] / fs)
+    k_s_max = np.ceil(k_range * kX[0]/2)
+
+    # Distances from the center of the (shifted) k-omega plane
+    w_s = np.abs(np.arange(kX[1]) - kX[1] / 2)[np.newaxis, :]
+    k_s = np.abs(np.arange(kX[0]) - kX[0] / 2)[:, np.newaxis]
+    k_s = np.where(k_s == 0, 1e-6, k_s)
+    v = np.abs(w_s / k_s)
+
+    # Calc filter coefficients
+    fw = np.minimum(_sigmoid(w_s, a_w1, w_s_min), 1 - _sigmoid(w_s, a_w2, w_s_max))
+    fk = 1 - _sigmoid(k_s, a_k, k_s_max)
+    fv = np.minimum(_sigmoid(v, a_v1, vmin), 1 - _sigmoid(v, a_v2, vmax))
+    mask = fw * fk * fv
+
+    # Basic directional mask
+    mask[:int(np.floor(kX[0]/2)), :int(np.floor(kX[1]/2))] = 0
+    mask[int(np.floor(kX[0]/2)):, int(np.floor(kX[1]/2)):] = 0
+    mask[int(np.floor(kX[0]/2)), int(np.floor(kX[1]/2))] = 0
+
+    # Shared between all callers of the cache
+    mask.flags.writeable = False
+    return mask
+
+# Returns the R->L k-omega filter mask (fftshift'ed layout, shape kX = [nX_padded, nFrames_padded]),
+# the L->R mask is np.flipud of it. Masks are cached in-process (LRU) and, if cache_dir is given,
+# also on disk as .npy files. The returned array is read-only.
+def get_kw_mask(kX, fs, sws_range, f_range, k_range, slopes=KW_MASK_SLOPES, cache_dir=None):
+    key = _kw_mask_key(kX, fs, sws_range, f_range, k_range, slopes)
+    if cache_dir is None:
+        return _build_kw_mask(*key)
+
+    path = os.path.join(cache_dir, "kw_mask_" + hashlib.sha1(repr(key).encode()).hexdigest() + ".npy")
+    if os.path.exists(path):
+        mask = np.load(path)
+        mask.flags.writeable = False
+        return mask
+    mask = _build_kw_mask(*key)
+    os.makedirs(cache_dir, exist_ok=True)
+    np.save(path, mask)
+    return mask
+
+
+# Converts a (fftshift'ed, full-spectrum) k-omega mask into the unshifted rfft2 layout [kX0, kX1//2+1].
+# Only the Hermitian-symmetric part of the mask acts on a real signal, so
+# irfft2(rfft2(x) * kw_mask_to_rfft2(mask)) == real(ifft2(ifftshift(fftshift(fft2(x)) * mask))).
+def kw_mask_to_rfft2(mask):
+    mask_ref = np.roll(mask[::-1, ::-1], 1, axis=(0, 1)) # M(-k, -w)
+    mask_sym = (mask + mask_ref) / 2
+    mask_sym = np.fft.ifftshift(mask_sym, axes=(0, 1))
+    return mask_sym[:, :mask.shape[1]//2+1]
+
+
+# Splits rows [z0, z1) into slabs of tile_z rows for the depth-tiled modes. All slabs have the same height,
+# the last one is moved up to end at z1 (overlapping the previous one), so buffers and FFT plans have a single size.
+def depth_tiles(z0, z1, tile_z):
+    tile_z = min(int(tile_z), z1 - z0)
+    return list(range(z0, z1 - tile_z, tile_z)) + [z1 - tile_z], tile_z
+
+# Gather index of the symmetric ('reflect') extension of n samples by (size-1)//2 before and size//2 after
+@functools.lru_cache(maxsize=32)
+def _reflect_index(n, size):
+    i = np.mod(np.arange(-((size-1)//2), n + size//2), 2*n)
+    i = np.where(i < n, i, 2*n - 1 - i)
+    i.flags.writeable = False
+    return i
+
+# Moving sum of `size` samples along `axis`, same output as ndimage.convolve1d(x, ones(size), axis=axis) with its
+# default 'reflect' boundary (mode='valid': the n-size+1 windows within x only), evaluated every `step` samples.
+# Computed as a difference of cumulative sums, so the cost does not depend on size. The sums are accumulated in the
+# dtype of x, block by block (BOX_FILTER_BLOCK outputs) and, for floating point data, relative to the mean of the
+# block: the running sum then only grows with the deviations over one block instead of with the whole axis, which
+# keeps single precision data accurate. The work buffer (box_filter_work_shape) and the output (not overlapping x)
+# can be preallocated.
+BOX_FILTER_BLOCK = 32
+
+def box_filter1d(x, size, axis, xp=np, step=1, work=None, out=None, mode='reflect'):
+    size = int(size)
+    n = x.shape[axis]
+    if(mode == 'reflect'):
+        before, n_out = (size-1)//2, n
+    elif(mode == 'valid'):
+        before, n_out = 0, n - size + 1
+    else:
+        raise ValueError("Unknown mode: " + str(mode))
+    x = xp.moveaxis(x, axis, 0)
+    if(work is None):
+        work = xp.empty(box_filter_work_shape(x.shape, size, 0, step), dtype=x.dtype)
+    else:
+        work = xp.moveaxis(work, axis, 0)
+    if(out is None):
+        out = xp.empty((len(range(0, n_out, step)),) + x.shape[1:], dtype=x.dtype)
+    else:
+        out = xp.moveaxis(out, axis, 0)
+
+    # work[0]: mean of the block, work[1]: 0, work[2:]: samples of the block
+    anchor = work[0] if np.dtype(x.dtype).kind not in 'biu' else None
+    block = box_filter_block(step)
+    for j0 in range(0, n_out, block):
+        j1 = min(j0 + block, n_out)
+        w = work[1:j1-j0+size+1]
+        # Samples j0-before .. j1+size-2-before of x, reflected at the borders
+        k0, k1 = j0 - before, j1 + size - 1 - before
+        if(k0 >= 0 and k1 <= n):
+            w[1:] = x[k0:k1]
+        else:
+            w[1:] = x[xp.asarray(_reflect_index(n, size)[j0:j1+size-1])]
+        if(anchor is not None):
+            xp.mean(w[1:], axis=0, out=anchor)
+            w[1:] -= anchor
+        w[0] = 0
+        xp.cumsum(w, axis=0, out=w)
+        o = out[j0//step:j0//step + len(range(0, j1-j0, step))]
+        xp.subtract(w[size:size+j1-j0:step], w[:j1-j0:step], out=o)
+        if(anchor is not None):
+            o += anchor * size
+    return xp.moveaxis(out, 0, axis)
+
+# Outputs per block of box_filter1d, a multiple of step so that every block starts on an output sample
+def box_filter_block(step):
+    return max(BOX_FILTER_BLOCK // step, 1) * step
+
+# Shape of the work buffer of box_filter1d for data of the given shape
+def box_filter_work_shape(shape, size, axis, step=1):
+    shape = list(shape)
+    shape[axis] = min(box_filter_block(step), shape[axis]) + int(size) + 1
+    return tuple(shape)
+
+# Median over size x size windows (placed as in ndimage.median_filter) of the valid pixels only, from sliding-window
+# histograms: the counts of valid values in bins <= b are box filtered with cumulative sums, so the cost per pixel
+# depends on n_bins and not on size. Values are quantized to n_bins bins over value_range and the result is the
+# centre of the bin holding rank n//2 of the n valid values of the window. Pixels without valid neighbours are 0.
+def masked_median_filter(image, valid, size, value_range, n_bins=256, xp=np, bins_per_pass=32):
+    lo, hi = value_range
+    width = (hi - lo) / n_bins
+    q = xp.clip(xp.floor((image - lo) / width), 0, n_bins-1).astype(xp.int32)
+    q[~valid] = n_bins # above every bin, never counted
+    
+    # Box sums over axes 1, 2 of a [bins, z, x] stack, windows [i - size//2, i + (size-1)//2]
+    def box2(c):
+        c = box_filter1d(c[:, ::-1], size, 1, xp)[:, ::-1]
+        return box_filter1d(c[:, :, ::-1], size, 2, xp)[:, :, ::-1]
+    
+    n = box2(valid[np.newaxis].astype(xp.int32))[0]
+    rank = xp.zeros(image.shape, dtype=xp.int32)
+    for b0 in range(0, n_bins, bins_per_pass):
+        b = xp.arange(b0, min(b0 + bins_per_pass, n_bins), dtype=xp.int32)[:, np.newaxis, np.newaxis]
+        counts = box2((q[np.newaxis] <= b).astype(xp.int32))
+        rank += xp.sum(counts <= n // 2, axis=0, dtype=xp.int32)
+    
+    out = (lo + (rank + 0.5) * width).astype(image.dtype)
+    out[n == 0] = 0
+    return out
+
+# Log-compressed envelope [dB] of IQ data, 20*log10(max(|iq|, floor)), written into out if given
+def envelope_db(iq, xp=np, floor=1e-10, out=None):
+    out = xp.abs(iq, out=out)
+    xp.maximum(out, floor, out=out)
+    xp.log10(out, out=out)
+    out *= 20
+    return out
+
+
+## TXPB data layout ############################################
+# Flat indices into the TXPB data [rows, 32] (us4oem0 rows, then us4oem1 rows: n_push push frames then n_pwi PWI frames
+# of two RX halves each, n_samples rows per frame) of the TxpbAdapter output [1, n_pwi, n_samples, 128]:
+# channels 0-31 us4oem0 first half, 32-63 us4oem1 first half reversed, 64-95 us4oem0 second half, 96-127 us4oem1
+# second half reversed, with the two center channels of every 32 swapped.
+def txpb_gather_index(n_push, n_pwi, n_samples):
+    module_n_samples = n_samples*n_push + n_samples*n_pwi*2
+    index = np.arange(2*module_n_samples*32).reshape((2, module_n_samples, 32))
+    index = index[:, n_push*n_samples:, :].reshape((2, n_pwi, 2, n_samples, 32))
+    us4oem0, us4oem1 = index
+    index = np.concatenate((us4oem0[:, 0], us4oem1[:, 0, :, ::-1], us4oem0[:, 1], us4oem1[:, 1, :, ::-1]), axis=-1)
+    # swap data centers of the second module
+    centers = np.array([15, 47, 79, 111])
+    index[..., np.concatenate((centers, centers+1))] = index[..., np.concatenate((centers+1, centers))]
+    dtype = np.int32 if index.size < 2**31 else np.int64
+    return index[np.newaxis].astype(dtype)
+
+
+# Operation classes ###############################################  
+    
+class AngleCompounding(Operation):
+    # Expected input data format: 3D array [frame, x, z]
+    # Output data format: 3D array [frame, x, z]
+    
+    def __init__(self, nAngles, buffer_pool=None, num_pkg=None, filter_pkg=None, **kwargs):
+        self.nAngles = nAngles
+        self.buffer_pool = buffer_pool # optional BufferPool of the output and scratch buffers
+        
+        self.set_pkgs(num_pkg, filter_pkg)
+        self.kwargs = kwargs
+        
+    def set_pkgs(self, num_pkg, filter_pkg, **kwargs):
+        self.xp, self.filter_pkg, self.fft = get_pkgs(num_pkg, filter_pkg)
+    
+    def prepare(self, n_frames=None):
+        # n_frames is only used by the streaming mode (see reset())
+        self.reset(n_frames=n_frames)
+        return
+        
+    def process(self, data): 
+        xp = self.xp
+        N = self.nAngles
+        if(N==1):
+            return data
+        
+        # Mean over N consecutive frames, only the windows kept by the former convolve1d + crop are computed:
+        # output frame j averages data[j+N//2 : j+N//2+N]. Running sum as a cumsum difference (box_filter1d)
+        nOut = data.shape[0] - 2*N + 2
+        src = data[N//2 : N//2+nOut+N-1]
+        work = op_buffer(self, 'work', box_filter_work_shape(src.shape, N, 0), src.dtype)
+        out = box_filter1d(src, N, 0, xp, work=work, out=op_buffer(self, 'out', (nOut,) + src.shape[1:], src.dtype),
+                           mode='valid')
+        out *= 1/N
+        return out
+    
+    # Streaming mode: frames [x, z] are pushed one at a time as they are acquired, push() returns the next
+    # compounded frame as soon as its window is complete (None otherwise). The emitted frames are the ones
+    # process() returns for the whole stack; n_frames (stack length) stops the emission after the last of them.
+    def reset(self, n_frames=None):
+        self.n_pushed  = 0
+        self.n_emitted = 0
+        self.n_out  = None if n_frames is None else n_frames - 2*self.nAngles + 2
+        self.window = None # ring buffer of the last nAngles frames
+        self.acc    = None # running sum over the ring buffer
+        
+    def push(self, frame):
+        xp = self.xp
+        N = self.nAngles
+        i = self.n_pushed - N//2 # index of the frame within the compounded sequence
+        self.n_pushed += 1
+        if(i < 0 or (self.n_out is not None and self.n_emitted >= self.n_out)):
+            return None
+        
+        if(self.window is None):
+            self.window = op_buffer(self, 'window', (N,) + frame.shape, frame.dtype)
+            self.acc    = op_buffer(self, 'acc', frame.shape, frame.dtype)
+            self.window.fill(0)
+            self.acc.fill(0)
+        
+        # Replace the oldest frame of the window: one subtract, one add
+        slot = self.window[i % N]
+        xp.subtract(self.acc, slot, out=self.acc)
+        xp.add(self.acc, frame, out=self.acc)
+        slot[...] = frame
+        # Re-sum the ring buffer once per turn so the rounding errors of the running sum do not accumulate
+        if(i % N == N-1):
+            xp.sum(self.window, axis=0, out=self.acc)
+        
+        if(i < N-1):
+            return None
+        self.n_emitted += 1
+        return self.acc * (1/N)
+    
+    
+class ShearwaveDetection(Operation):
+    # Expected input data format: 3D array [frame, x, z]
+    # Output data format: 3D array [z, x, frame]
+    def __init__(self, mode='kasai', packet_size=4, z_gate=4, fc=4.4e6, z_stride=1, single_precision=False,
+                 buffer_pool=None, num_pkg=None, filter_pkg=None, **kwargs):
+        # Capture params
+        self.packet_size = packet_size
+        self.mode = mode
+        self.z_gate = z_gate 
+        self.fc = fc
+        # Axial output stride (depth decimation after the z_gate smoothing), 1 - all rows. Output row k is the input
+        # depth row k*z_stride, so the output depth pitch is z_stride grid steps: the depth parameters of the later
+        # stages (SWS_Estimation z_clip, MedianFiltering kernel_size, the display grid) are in output rows, the
+        # callers scale them. The lateral pitch (SWS_Estimation px_pitch) is unchanged.
+        self.z_stride = z_stride
+        self.single_precision = single_precision # complex64/float32 only, written into buffers allocated in prepare()
+        self.buffer_pool = buffer_pool # optional BufferPool of these buffers
+        self.set_pkgs(num_pkg, filter_pkg)
+        self.kwargs = kwargs 
+        
+    def set_pkgs(self, num_pkg, filter_pkg, **kwargs):
+        self.xp, self.filter_pkg, self.fft = get_pkgs(num_pkg, filter_pkg)
+    
+    def prepare(self, c, frame_pri, fs, input_shape=None):
+        self.c  = c
+        self.frame_pri = frame_pri
+        self.fs = fs
+        
+        # The single precision mode preallocates its buffers, input_shape = [frame, x, z]
+        if(self.single_precision):
+            if(input_shape is None):
+                raise ValueError("single_precision mode requires input_shape")
+            self.alloc_buffers(input_shape)
+        return
+
+    def process(self, data):   
+        xp = self.xp
+        if(self.single_precision):
+            return self.process_single(data)
+        
+        # Rearrange data
+        data = xp.moveaxis(data, [0,1], [2,1])
+        data_conj = xp.conj(data)
+        
+        # Shear wave detection
+        P0 = self.smooth(data[:-1,:,:-1] * data_conj[:-1,:,1:])
+        f_d = xp.angle(P0) / (2*xp.pi)
+        
+        if(self.mode=='loupas'):
+            P1 = self.smooth(data[:-1,:,:] * data_conj[1:,:,:])
+            # Estimated centeral frequency map
+            fc_shift = xp.abs(xp.angle(P1) / (2*xp.pi/self.fs))
+            fc_shift = fc_shift[:, :, 1:]
+            fc_shift[fc_shift == 0] = 1e-9
+            # Displacement
+            ddata = self.c * f_d / (2*fc_shift*self.frame_pri)
+        else:    
+            ddata = self.c * f_d / (2*self.fc*self.frame_pri )  
+        
+        return ddata
+
+    # Box filtering of a lag-one product over the gate (depth, axis 0, decimated by z_stride)
+    # and the packet (slow time, axis 2). The two filters commute, depth goes first to filter fewer rows in slow time.
+    def smooth(self, P):
+        xp = self.xp
+        P = box_filter1d(P, self.z_gate, 0, xp, step=self.z_stride)
+        return box_filter1d(P, self.packet_size, 2, xp)
+    
+    # Buffers of the single precision mode, input_shape = [frame, x, z]
+    def alloc_buffers(self, input_shape):
+        xp = self.xp
+        nF, nX, nZ = input_shape
+        nZo = len(range(0, nZ-1, self.z_stride))
+        self.P0_bufs = self.product_buffers('P0', nZ, nX, nF-1, nZo)
+        if(self.mode=='loupas'):
+            self.P1_bufs = self.product_buffers('P1', nZ, nX, nF, nZo)
+            self.fc_shift = op_buffer(self, 'fc_shift', (nZo, nX, nF-1), xp.float32)
+            self.fc_zero  = op_buffer(self, 'fc_zero', (nZo, nX, nF-1), bool)
+        self.ddata = op_buffer(self, 'ddata', (nZo, nX, nF-1), xp.float32) # reused across calls
+    
+    # (product, depth cumsum work, depth filtered product, slow-time cumsum work) for a product with nF frames
+    def product_buffers(self, name, nZ, nX, nF, nZo):
+        xp = self.xp
+        return (op_buffer(self, name, (nZ-1, nX, nF), xp.complex64),
+                op_buffer(self, name + '_z_work', box_filter_work_shape((nZ-1, nX, nF), self.z_gate, 0, self.z_stride),
+                          xp.complex64),
+                op_buffer(self, name + '_z', (nZo, nX, nF), xp.complex64),
+                op_buffer(self, name + '_f_work', box_filter_work_shape((nZo, nX, nF), self.packet_size, 2), xp.complex64))
+    
+    # a * conj(b) written into the product buffer, then smoothed in place of the preallocated buffers
+    def smooth_into(self, a, b, bufs):
+        xp = self.xp
+        P, z_work, Pz, f_work = bufs
+        xp.conj(b, out=P)
+        xp.multiply(P, a, out=P)
+        box_filter1d(P, self.z_gate, 0, xp, step=self.z_stride, work=z_work, out=Pz)
+        # The product is no longer needed, its first rows take the output
+        return box_filter1d(Pz, self.packet_size, 2, xp, work=f_work, out=P[0:Pz.shape[0]])
+    
+    # Same estimators as process(), complex64/float32 only and without per-call allocations of full-size arrays
+    def process_single(self, data):
+        xp = self.xp
+        # [frame, x, z] -> [z, x, frame] view, products are written straight into the buffers
+        data = xp.moveaxis(data, [0,1], [2,1])
+        
+        # Phase of the slow-time lag-one product (2*pi * f_d)
+        P0 = self.smooth_into(data[:-1,:,:-1], data[:-1,:,1:], self.P0_bufs)
+        ddata = xp.arctan2(P0.imag, P0.real, out=self.ddata)
+        
+        if(self.mode=='loupas'):
+            # |Phase| of the depth lag-one product (2*pi * fc_shift / fs), zeros are replaced as in process()
+            P1 = self.smooth_into(data[:-1,:,:], data[1:,:,:], self.P1_bufs)[:, :, 1:]
+            fc_shift = xp.arctan2(P1.imag, P1.real, out=self.fc_shift)
+            xp.abs(fc_shift, out=fc_shift)
+            xp.equal(fc_shift, 0, out=self.fc_zero)
+            xp.copyto(fc_shift, xp.float32(1e-9*2*np.pi/self.fs), where=self.fc_zero)
+            # Displacement
+            xp.divide(ddata, fc_shift, out=ddata)
+            xp.multiply(ddata, xp.float32(self.c/(2*self.fs*self.frame_pri)), out=ddata)
+        else:
+            xp.multiply(ddata, xp.float32(self.c/(4*np.pi*self.fc*self.frame_pri)), out=ddata)
+        
+        return ddata
+            
+
+class ShearwaveSNR(Operation):
+    # Expected input data format: 3D array [z, x, frame] (shear wave motion data, ShearwaveDetection output)
+    # Output data format: 2D array [z, x], SNR [dB] = 20*log10(E_S/E_N), E_S and E_N - variance of the motion over
+    # the signal and noise frame windows [start, stop)
+    # passthrough=True: the input is returned unchanged (the op can sit in the middle of a pipeline), the last map is
+    # kept in self.snr. With a threshold [dB], gate() blanks the SWS pixels of a lower SNR.
+    def __init__(self, signal_frames=(1, 80), noise_frames=(100, 114), threshold=None, passthrough=False,
+                 buffer_pool=None, num_pkg=None, filter_pkg=None, **kwargs):
+        self.signal_frames = signal_frames
+        self.noise_frames = noise_frames
+        self.threshold = threshold
+        self.passthrough = passthrough
+        self.buffer_pool = buffer_pool # optional BufferPool of the buffers
+        self.snr = None
+        self.set_pkgs(num_pkg, filter_pkg)
+        self.kwargs = kwargs
+        
+    def set_pkgs(self, num_pkg, filter_pkg, **kwargs):
+        self.xp, self.filter_pkg, self.fft = get_pkgs(num_pkg, filter_pkg)
+    
+    def prepare(self, input_shape):
+        nZ, nX, nF = input_shape
+        for name, (start, stop) in (('signal_frames', self.signal_frames), ('noise_frames', self.noise_frames)):
+            if(not 0 <= start < stop <= nF):
+                raise ValueError(name + " " + str([start, stop]) + " out of the " + str(nF) + " frames of the data")
+        
+        # Window weights: the means over the signal (column 0) and noise (column 1) windows are one matrix product
+        self.weights = np.zeros((nF, 2))
+        self.weights[self.signal_frames[0]:self.signal_frames[1], 0] = 1 / (self.signal_frames[1] - self.signal_frames[0])
+        self.weights[self.noise_frames[0]:self.noise_frames[1], 1]   = 1 / (self.noise_frames[1] - self.noise_frames[0])
+        # Buffers are allocated on the first call (on the input dtype)
+        self.snr = None
+        return
+    
+    def alloc_buffers(self, nZ, nX, nF, dtype):
+        xp = self.xp
+        self.W   = op_buffer(self, 'W', (nF, 2), dtype)
+        self.W[...] = xp.asarray(self.weights, dtype=dtype)
+        self.dev = op_buffer(self, 'dev', (nZ*nX, nF), dtype)
+        self.m1  = op_buffer(self, 'm1', (nZ*nX, 2), dtype)
+        self.var = op_buffer(self, 'var', (2, nZ*nX), dtype)
+        self.snr = op_buffer(self, 'snr', (nZ, nX), dtype) # reused across calls
+        self.low = op_buffer(self, 'low', (nZ, nX), bool)
+    
+    def process(self, data):
+        xp = self.xp
+        nZ, nX, nF = data.shape
+        if(self.snr is None or self.dev.shape != (nZ*nX, nF) or self.dev.dtype != data.dtype):
+            self.alloc_buffers(nZ, nX, nF, data.dtype)
+        X = xp.reshape(data, (nZ*nX, nF))
+        
+        # Means over both windows in one pass: E[x] = X @ W
+        xp.matmul(X, self.W, out=self.m1)
+        # Energies (variances): mean squared deviation from the window mean. Not E[x^2] - E[x]^2, which cancels
+        # catastrophically in single precision when the mean is large compared to the motion
+        for k, (start, stop) in enumerate((self.signal_frames, self.noise_frames)):
+            dev = self.dev[:, start:stop]
+            xp.subtract(X[:, start:stop], self.m1[:, k:k+1], out=dev)
+            xp.multiply(dev, dev, out=dev)
+            xp.mean(dev, axis=1, out=self.var[k])
+        
+        # SNR [dB]
+        snr = xp.reshape(self.snr, (nZ*nX,))
+        xp.divide(self.var[0], self.var[1], out=snr)
+        xp.less_equal(self.snr, 0, out=self.low)
+        xp.copyto(self.snr, 10**-10, where=self.low)
+        xp.log10(self.snr, out=self.snr)
+        self.snr *= 20
+        
+        if(self.threshold is not None):
+            xp.less(self.snr, self.threshold, out=self.low)
+        return data if self.passthrough else self.snr
+    
+    # Sets the SWS of the pixels below the SNR threshold to fill, in place. data: [SWS/r, z, x] maps of the last
+    # processed motion data (SWS_Compounding / MedianFiltering output)
+    def gate(self, data, fill=0):
+        if(self.threshold is not None):
+            self.xp.copyto(data[0], fill, where=self.low)
+        return data
+    
+    
+class ShearwaveMotionDataFiltering(Operation):
+    # Expected data format:  3D array [z, x, frame], float32
+    # Output data format: 2x 3D array [2, z, x, frame]
+    def __init__(self, sws_range, f_range, k_range, mask_slopes=KW_MASK_SLOPES, mask_cache_dir=None, fft_mode='c2c',
+                 tile_z=None, buffer_pool=None, num_pkg=None, filter_pkg=None, **kwargs):
+        self.sws_range = sws_range
+        self.f_range   = f_range
+        self.k_range   = k_range
+        self.fft_mode  = fft_mode # 'c2c' - complex fft2/ifft2, 'r2c' - real rfft2/irfft2, LR and RL in one batch
+        self.mask_slopes = mask_slopes
+        self.mask_cache_dir = mask_cache_dir # optional on-disk mask cache
+        self.tile_z = tile_z # depth slab height for the tiled mode (None - all rows at once)
+        self.buffer_pool = buffer_pool # optional BufferPool of the output of the tiled mode
+        
+        self.set_pkgs(num_pkg, filter_pkg)
+        self.kwargs = kwargs 
+
+    def set_pkgs(self, num_pkg, filter_pkg, **kwargs):
+        self.xp, self.filter_pkg, self.fft = get_pkgs(num_pkg, filter_pkg)
+        
+    def prepare(self, input_shape, fs):
+        xp = self.xp
+        self.fs = fs
+        
+        # Get input data shape
+        self.data_shape = input_shape
+         
+        # Obtain buffer sizes
+        def nextpow2(x):
+            return int(np.ceil(np.log2(x)))
+        
+        self.nZ, self.nX, self.nFrames = self.data_shape
+        nX_padded = 2**nextpow2(self.nX)
+        nFrames_padded = 2**nextpow2(self.nFrames)
+        self.kX = [nX_padded, nFrames_padded]
+        
+        ## Create masks for filtering (cached)
+        mask_f = get_kw_mask(self.kX, self.fs, self.sws_range, self.f_range, self.k_range,
+                             slopes=self.mask_slopes, cache_dir=self.mask_cache_dir)
+        self.mask_RL = xp.asarray(mask_f)
+        self.mask_LR = xp.asarray(np.flipud(mask_f))
+
+        # Pre-shifted, stacked masks for the real-to-complex mode: [RL/LR, 1, kX0, kX1//2+1]
+        if(self.fft_mode == 'r2c'):
+            masks = np.stack((kw_mask_to_rfft2(mask_f), kw_mask_to_rfft2(np.flipud(mask_f))))
+            self.masks_r2c = xp.asarray(masks[:, np.newaxis, ...], dtype=np.float32)
+        elif(self.fft_mode != 'c2c'):
+            raise ValueError("Unknown fft_mode: " + str(self.fft_mode))
+
+        # Depth slabs for the tiled mode, rows are filtered independently so the slabs need no overlap
+        if(self.tile_z is not None):
+            self.tiles, self.tile_h = depth_tiles(0, self.nZ, self.tile_z)
+            out_dtype = np.float32 if self.fft_mode == 'r2c' else np.float64
+            self.out = op_buffer(self, 'out', (2, self.nZ, self.nX, self.nFrames), out_dtype) # reused across calls
+        return
+    
+    def process(self, data):
+        xp = self.xp
+        if(self.tile_z is None):
+            return xp.ascontiguousarray(self.filter(data))
+
+        # Depth-tiled mode, peak memory depends on the slab height only
+        for z0 in self.tiles:
+            self.out[:, z0:z0+self.tile_h] = self.filter(data[z0:z0+self.tile_h])
+        return self.out
+
+    def filter(self, data):
+        xp = self.xp
+        if(self.fft_mode == 'r2c'):
+            return self.filter_r2c(data)
+
+        # Perform the 2-D FFT
+        X = self.fft.fft2(data, s=self.kX, axes=(1, 2), overwrite_x=True)
+        X = self.fft.fftshift(X, axes=(1, 2))
+        
+        # Filtering in k-omega space
+        X1 = X * self.mask_RL
+        X2 = X * self.mask_LR
+        # Perform the Inverse 2-D FFT
+        X1 = self.fft.ifftshift(X1, axes=(1, 2))
+        X2 = self.fft.ifftshift(X2, axes=(1, 2))
+        X1 = xp.real(self.fft.ifft2(X1, axes=(1, 2), overwrite_x=True))
+        X2 = xp.real(self.fft.ifft2(X2, axes=(1, 2), overwrite_x=True))
+        X1 = X1[:, 0:self.nX, 0:self.nFrames] # L->R
+        X2 = X2[:, 0:self.nX, 0:self.nFrames] # R->L
+        
+        # Pack data
+        X1 = X1[np.newaxis, ...]
+        X2 = X2[np.newaxis, ...]
+        X1 = xp.real(X1)
+        X2 = xp.real(X2)
+        return xp.concatenate((X1, X2), axis=0)
+        
+        
+    def filter_r2c(self, data):
+        # Real-to-complex 2-D FFT, masks are already in the rfft2 layout
+        X = self.fft.rfft2(data, s=self.kX, axes=(1, 2), overwrite_x=True)
+
+        # Filtering in k-omega space, both directions stacked: [RL/LR, z, kx, w]
+        X = X[np.newaxis, ...] * self.masks_r2c
+
+        # Single batched inverse transform for both directions
+        X = self.fft.irfft2(X, s=self.kX, axes=(2, 3), overwrite_x=True)
+        return X[:, :, 0:self.nX, 0:self.nFrames]
+
+    def plotFilterMasks(self):
+        mask_RL_cpu = to_host(self.mask_RL)
+        mask_LR_cpu = to_host(self.mask_LR)
+        fig, (ax0, ax1) = plt.subplots(1, 2, figsize=(7, 3))
+        ax0.imshow(np.squeeze(mask_RL_cpu),   cmap='gray', aspect=0.5)
+        ax1.imshow(np.squeeze(mask_LR_cpu),   cmap='gray', aspect=0.5)
+        return
+     
+        
+              
+class SWS_Estimation(Operation):
+    # Expected data format: 2x 3D array [2, z, x, frame]
+    # Output format: 4D data: 2x 3D array: SWS: 3D array [dataset, z, x], SWS_r: 3D array [dataset, z, x]. Arrays concat'd along axis=0
+    # For example: [SWV/r, LR/RL, z, x]
+    # If d is a list of separations the output gets an extra leading axis: [n_d, SWV/r, LR/RL, z, x]
+
+    def __init__(self, x_range, z_clip, frames_range, d, fri, interp_factor=5, interp_order=2, px_pitch=0.1e-3, sws_range=[0.5, 4.0],
+                interp_mode='zoom', correlator='fft', tile_z=None, buffer_pool=None, num_pkg=None, filter_pkg=None, **kwargs):
+        # Params capture
+        self.x_range = x_range # for example [[0, 200], [250, 400]], so x_ranges for LR and RL datasets: [[xL_LR, xR_LR], [xL_RL, xR_RL]]
+        self.frames_range = frames_range # for example [0, 99]
+        self.z_clip = z_clip # for example [10, 30] - how many rows (of the input, see ShearwaveDetection z_stride) to clip from top and bottom
+        self.d = d # lateral separation [px], or a list of separations
+        self.interp_factor = interp_factor
+        self.interp_order = interp_order
+        self.interp_mode = interp_mode # 'zoom' - upsample the data, 'fft' - zero-pad the cross-spectrum, 'parabolic' - refine the peak
+        self.correlator = correlator # 'fft' - all lags via rfft/irfft, 'direct' - only the lags admissible for sws_range
+        self.px_pitch = px_pitch # lateral pixel pitch [m]
+        self.sws_range = sws_range
+        self.FRI = fri
+        self.tile_z = tile_z # depth slab height for the tiled mode (None - all rows at once)
+        self.buffer_pool = buffer_pool # optional BufferPool of the scratch and output buffers
+        
+        self.set_pkgs(num_pkg, filter_pkg)
+        self.kwargs = kwargs 
+    
+    def set_pkgs(self, num_pkg, filter_pkg, **kwargs):
+        self.xp, self.filter_pkg, self.fft = get_pkgs(num_pkg, filter_pkg)
+    
+    def prepare(self, input_shape):
+        xp = self.xp
+        
+        # Get input data shape
+        data_shape = input_shape
+        self.out_dim = [data_shape[1], data_shape[2], data_shape[3]] # of one sub-dataset
+
+        if(self.interp_mode not in ('zoom', 'fft', 'parabolic')):
+            raise ValueError("Unknown interp_mode: " + str(self.interp_mode))
+        if(self.correlator not in ('fft', 'direct')):
+            raise ValueError("Unknown correlator: " + str(self.correlator))
+        if(self.correlator == 'direct' and self.interp_mode == 'fft'):
+            raise ValueError("The direct correlator does not support interp_mode='fft'")
+
+        # Lateral separations
+        self.multi_d = np.ndim(self.d) > 0
+        self.d_list = [int(d) for d in np.atleast_1d(self.d)]
+        
+        # Process column ranges, [separation][LR/RL]
+        self.xL = []
+        self.xR = []
+        for d in self.d_list:
+            self.xL.append([max(self.x_range[i][0] - int(np.ceil(d/2)), 0) for i in range(2)])
+            self.xR.append([min(self.x_range[i][1] + int(np.ceil(d/2)), self.out_dim[1]) for i in range(2)])
+
+        # Common column range of LR and RL (and of all separations), the correlation is computed in one batch
+        self.xLc = min(min(xL) for xL in self.xL)
+        self.xRc = max(max(xR) for xR in self.xR)
+        # Columns of each dataset within the common range, only these are interpolated (the others are left zero)
+        self.x_slabs = [(min(xL[i] for xL in self.xL) - self.xLc, max(xR[i] for xR in self.xR) - self.xLc) for i in range(2)]
+            
+        # Get window function (only the 'zoom' mode upsamples the data)
+        N = self.frames_range[1] - self.frames_range[0]
+        if(self.interp_mode == 'zoom'):
+            # Spline zoom along the slow-time dim as a matrix [t, t_new]: the same for every (z, x) signal
+            self.interp = xp.asarray(np.stack([sp.ndimage.zoom(e, self.interp_factor, order=self.interp_order)
+                                               for e in np.eye(N)]), dtype=np.float32)
+            N = N * self.interp_factor
+        self.w = xp.asarray(sp.signal.windows.tukey(N, alpha=0.2, sym=True), dtype=np.float32)
+        
+        # Signed lag of each correlation sample, in correlation samples
+        n_c = N * self.interp_factor if self.interp_mode == 'fft' else N
+        lags_fft = np.arange(n_c)
+        lags_fft = np.where(lags_fft > n_c//2, lags_fft - n_c, lags_fft)
+
+        # Per-separation parameters
+        self.ds = []
+        self.nXc = []     # number of estimated columns
+        self.xo = []      # first output column
+        self.x_valid = [] # columns estimated from pairs within the dataset's own range: [LR/RL, 1, x]
+        self.lags = []
+        self.lags_direct = []
+        for k, d in enumerate(self.d_list):
+            ds = self.px_pitch * d
+            nXc = self.xRc - self.xLc - d
+            x_valid = np.zeros((2, 1, nXc), dtype=bool)
+            for i in range(2):
+                x_valid[i, :, self.xL[k][i]-self.xLc : self.xR[k][i]-self.xLc-d] = True
+            self.ds.append(ds)
+            self.nXc.append(nXc)
+            self.xo.append(int(np.ceil(self.xLc + d/2)))
+            self.x_valid.append(xp.asarray(x_valid))
+
+            if(self.correlator == 'direct'):
+                # Lags admissible for sws_range (with a margin of one sample for the peak search/fit)
+                step = self.FRI if self.interp_mode == 'parabolic' else self.FRI / self.interp_factor
+                l_min = max(int(np.floor(ds / (self.sws_range[1] * step))) - 1, 0)
+                l_max = min(int(np.ceil(ds / (self.sws_range[0] * step))) + 1, N - 1)
+                lags = np.arange(l_min, l_max + 1)
+                lags = np.unique(np.concatenate((-lags, lags)))
+                self.lags_direct.append([int(l) for l in lags])
+                self.lags.append(xp.asarray(lags))
+            else:
+                self.lags.append(xp.asarray(lags_fft))
+
+        # Depth slabs of the estimated rows, rows are estimated independently so the slabs need no overlap
+        z0, z1 = self.z_clip[0], self.out_dim[0] - self.z_clip[1]
+        self.tiles, self.tile_h = depth_tiles(z0, z1, z1 - z0 if self.tile_z is None else self.tile_z)
+
+        # Scratch buffer for the (interpolated) slow-time signals of one slab [LR/RL, z, x, t]
+        self.y_buf = op_buffer(self, 'y_buf', (2, self.tile_h, self.xRc - self.xLc, N), np.float32)
+        self.y_buf.fill(0)
+        if(self.interp_mode == 'zoom'):
+            # Interpolated signals of one dataset, contiguous (matmul output) [z, x, t]
+            self.i_buf = op_buffer(self, 'i_buf', self.tile_h * max(b - a for a, b in self.x_slabs) * N, np.float32)
+
+        # Output buffer [separation, SWV/r, LR/RL, z, x], reused across calls
+        self.SWV = op_buffer(self, 'SWV', (len(self.d_list), 2, 2, self.out_dim[0], self.out_dim[1]), np.float32)
+        self.SWV.fill(0)
+        
+        return
+    
+    def process(self, data):
+        for z0 in self.tiles:
+            self.estimate(data, z0, z0 + self.tile_h)
+
+        if(self.multi_d):
+            return self.SWV
+        return self.SWV[0]
+
+    def estimate(self, data, z0, z1):
+        xp = self.xp
+        # Data interpolation along slow-time dimension, each dataset over its own columns: [LR/RL, z, x, t]
+        ynew = self.y_buf
+        for i, (a, b) in enumerate(self.x_slabs):
+            ddata = data[i, z0:z1, self.xLc+a:self.xLc+b, self.frames_range[0]:self.frames_range[1]]
+            ddata = xp.where(xp.isnan(ddata), 0, ddata)
+            if(self.interp_mode == 'zoom'):
+                out = self.i_buf[0:ddata.shape[0]*(b-a)*ynew.shape[3]].reshape(ddata.shape[0], b-a, ynew.shape[3])
+                xp.matmul(ddata, self.interp, out=out)
+                xp.copyto(ynew[i, :, a:b], out)
+            else:
+                xp.copyto(ynew[i, :, a:b], ddata)
+
+        # DC offset cancellation
+        ynew -= xp.mean(ynew, axis=3, keepdims=True)
+
+        # Apply window function
+        ynew *= self.w
+
+        # Find normalization values
+        Rx = xp.sqrt(xp.sum(ynew * ynew, axis=3))
+
+        # Compute the FFT along the slow-time dim, once for all separations
+        n = ynew.shape[3]
+        if(self.correlator == 'fft'):
+            X = self.fft.rfft(ynew, axis=3)
+
+        for k, d in enumerate(self.d_list):
+            nXc = self.nXc[k]
+            Rxab = Rx[:, :, 0:nXc] * Rx[:, :, d:d+nXc]
+
+            # Correlation along the slow-time dim
+            if(self.correlator == 'direct'):
+                c = self.correlate_direct(ynew, k)
+            else:
+                c = self.correlate_fft(X, n, k)
+                if(self.interp_mode == 'fft'):
+                    Rxab /= self.interp_factor # irfft scales by 1/n_c
+
+            ## SWS estimation post-processing
+            # find lag of max correlation (normalization does not move the maximum)
+            rmax_idx, rmax = self.find_peak(c, self.lags[k])
+            r = rmax / xp.where(self.x_valid[k], Rxab, 1) # the zero columns between the datasets are not used
+            rmax_idx[rmax_idx==0] = 1
+
+            # Calc SWS
+            dt = self.FRI * rmax_idx / self.interp_factor
+            sws_map = self.ds[k] / dt
+
+            # Limit the values
+            sws_map = xp.clip(sws_map, self.sws_range[0], self.sws_range[1])
+
+            # Aggregate the results, columns outside of each dataset's x_range are left zero
+            SWV = self.SWV[k]
+            xo = self.xo[k]
+            xp.copyto(SWV[0, :, z0:z1, xo:xo+nXc], sws_map, where=self.x_valid[k])
+            xp.copyto(SWV[1, :, z0:z1, xo:xo+nXc], r, where=self.x_valid[k])
+        return
+
+    def correlate_fft(self, X, n, k):
+        xp = self.xp
+        # Correlation in frequency domain and back to time-domain
+        d = self.d_list[k]
+        Xa = X[:, :, 0:self.nXc[k], :]
+        Xb = X[:, :, d:d+self.nXc[k], :]
+        C = Xa * xp.conj(Xb)
+        if(self.interp_mode == 'fft'):
+            # Zero-padded cross-spectrum: band-limited interpolation of the correlation, lag step FRI/interp_factor
+            if(n % 2 == 0):
+                C[..., -1] *= 0.5
+            return self.fft.irfft(C, n=n*self.interp_factor, axis=3, overwrite_x=True)
+        return self.fft.irfft(C, n=n, axis=3, overwrite_x=True)
+
+    def correlate_direct(self, ynew, k):
+        xp = self.xp
+        # Time-domain correlation, only for the admissible lags: c[l] = sum_t a[t+l] * b[t]
+        d = self.d_list[k]
+        n = ynew.shape[3]
+        a = ynew[:, :, 0:self.nXc[k], :]
+        b = ynew[:, :, d:d+self.nXc[k], :]
+        c = xp.empty(a.shape[:3] + (len(self.lags_direct[k]),), dtype=ynew.dtype)
+        for j, l in enumerate(self.lags_direct[k]):
+            if(l >= 0):
+                c[..., j] = xp.sum(a[..., l:] * b[..., :n-l], axis=3)
+            else:
+                c[..., j] = xp.sum(a[..., :n+l] * b[..., -l:], axis=3)
+        return c
+
+    def find_peak(self, c, lags):
+        xp = self.xp
+        # Returns the absolute lag of the maximum in FRI/interp_factor units and the (unnormalized) maximum
+        n_c = c.shape[3]
+        idx = xp.argmax(c, axis=3)
+        rmax = xp.take_along_axis(c, idx[..., np.newaxis], axis=3)[..., 0]
+        lag = lags[idx]
+        if(self.interp_mode != 'parabolic'):
+            # 'zoom' and 'fft' correlations are already sampled every FRI/interp_factor
+            return xp.abs(lag), rmax
+
+        # Parabolic fit around the integer-lag maximum, lag quantized to FRI/interp_factor
+        idx_m = (idx-1) % n_c
+        idx_p = (idx+1) % n_c
+        rm = xp.take_along_axis(c, idx_m[..., np.newaxis], axis=3)[..., 0]
+        rp = xp.take_along_axis(c, idx_p[..., np.newaxis], axis=3)[..., 0]
+        den = rm - 2*rmax + rp
+        # no refinement at improper maxima or at the edges of the evaluated lag set
+        den[(den >= 0) | (lags[idx_m] != lag-1) | (lags[idx_p] != lag+1)] = -np.inf
+        delta = 0.5 * (rm - rp) / den
+        rmax = rmax - 0.25 * (rm - rp) * delta
+        return xp.rint(xp.abs(lag + delta) * self.interp_factor).astype(np.int64), rmax    
+        
+                 
+class SWS_Compounding(Operation):
+    # Input data format: 4D data: 2x 3D array: SWS: 3D array [dataset, z, x], SWS_r: 3D array [dataset, z, x]. Arrays concat'd along axis=0
+    # For example: [SWV/r, LR/RL, z, x], any number of push directions (datasets)
+    # Output data format: 3D data: 2x 2D array: SWS: 3D array [z, x], SWS_r: 3D array [z, x]. Arrays concat'd along axis=0
+    # For example: [SWV/r, z, x], with confidence=True a third map: the mean correlation over the directions [SWV/r/conf, z, x]
+    def __init__(self, confidence=False, buffer_pool=None, num_pkg=None, filter_pkg=None, **kwargs):
+        self.confidence = confidence
+        self.buffer_pool = buffer_pool # optional BufferPool of the buffers
+        self.out = None
+        self.set_pkgs(num_pkg, filter_pkg)
+        self.kwargs = kwargs 
+    
+    def prepare(self):
+        # Buffers are allocated on the first call (and on a change of the map size)
+        self.out = None
+        return 
+    
+    def set_pkgs(self, num_pkg, filter_pkg, **kwargs):
+        self.xp, self.filter_pkg, self.fft = get_pkgs(num_pkg, filter_pkg)
+    
+    def alloc_buffers(self, nZ, nX, dtype):
+        xp = self.xp
+        self.out  = op_buffer(self, 'out', (3 if self.confidence else 2, nZ, nX), dtype) # reused across calls
+        self.prod = op_buffer(self, 'prod', (nZ, nX), dtype)
+        self.zero = op_buffer(self, 'zero', (nZ, nX), bool)
+    
+    def process(self, data):
+        xp = self.xp
+        # Unpack data
+        SWS   = data[0]
+        SWS_r = data[1]
+        if(self.out is None or self.out.shape[1:] != SWS.shape[1:]):
+            self.alloc_buffers(SWS.shape[1], SWS.shape[2], SWS.dtype)
+        SWSc  = self.out[0]
+        SWScr = self.out[1]
+        
+        # Correlation-weighted sum and sum of the weights, accumulated direction by direction into the output
+        xp.multiply(SWS[0], SWS_r[0], out=SWSc)
+        SWScr[...] = SWS_r[0]
+        for i in range(1, SWS.shape[0]):
+            xp.multiply(SWS[i], SWS_r[i], out=self.prod)
+            SWSc  += self.prod
+            SWScr += SWS_r[i]
+        
+        # Mean correlation, from the sum of the weights
+        if(self.confidence):
+            xp.multiply(SWScr, 1 / SWS.shape[0], out=self.out[2])
+        
+        # Weighted average
+        xp.equal(SWScr, 0, out=self.zero)
+        xp.copyto(SWScr, 10e-6, where=self.zero)
+        SWSc /= SWScr
+        return self.out
+    
+    
+class MedianFiltering(Operation):
+    # Expected data format: 3D data: 2x 2D array: SWS: 3D array [z, x], SWS_r: 3D array [z, x]. Arrays concat'd along axis=0
+    # mode: 'exact' - ndimage.median_filter over the whole map,
+    #       'histogram' - masked_median_filter, only valid pixels (SWS > 0, SWS_r >= r_threshold, inside mask) are
+    #                     used and filtered, the others are set to 0. Values are quantized to n_bins over value_range.
+    def __init__(self, kernel_size, mode='exact', r_threshold=None, mask=None, value_range=(0.0, 5.0), n_bins=256,
+                 buffer_pool=None, num_pkg=None, filter_pkg=None, **kwargs):
+        self.kernel_size=kernel_size
+        self.buffer_pool = buffer_pool # optional BufferPool of the filtered image ('exact' mode)
+        self.mode = mode
+        self.r_threshold = r_threshold
+        self.mask = mask # optional static validity mask [z, x]
+        self.value_range = value_range
+        self.n_bins = n_bins
+        self.set_pkgs(num_pkg, filter_pkg)
+        self.kwargs = kwargs 
+        
+    def set_pkgs(self, num_pkg, filter_pkg, **kwargs):
+        self.xp, self.filter_pkg, self.fft = get_pkgs(num_pkg, filter_pkg)
+    
+    def prepare(self):
+        self.check_mode()
+        return
+    
+    def check_mode(self):
+        xp = self.xp
+        if(self.mode == 'histogram'):
+            if(self.mask is not None):
+                self.mask = xp.asarray(self.mask, dtype=bool)
+        elif(self.mode != 'exact'):
+            raise ValueError("Unknown mode: " + str(self.mode))
+        elif(self.r_threshold is not None or self.mask is not None):
+            raise ValueError("r_threshold and mask require mode='histogram'")
+    
+    def process(self, data):
+        xp = self.xp
+        if(self.mode == 'histogram'):
+            return self.process_masked(data)
+        
+        # Unpack data
+        image = xp.squeeze(data[0])
+        #Filter image
+        image = self.filter_pkg.median_filter(image, size=(self.kernel_size, self.kernel_size),
+                                              output=op_buffer(self, 'image', image.shape, image.dtype))
+        # Pack data
+        data[0, :, :] = image
+        return data
+    
+    def process_masked(self, data):
+        xp = self.xp
+        image = data[0]
+        valid = image > 0
+        if(self.r_threshold is not None):
+            valid &= data[1] >= self.r_threshold
+        if(self.mask is not None):
+            valid &= self.mask
+        
+        # Skip the empty regions: filter only the bounding box of the valid pixels plus a kernel-sized margin,
+        # pixels further away neither contribute nor are filtered so the result is the same as on the whole map
+        rows = xp.nonzero(xp.any(valid, axis=1))[0]
+        cols = xp.nonzero(xp.any(valid, axis=0))[0]
+        if(rows.size == 0):
+            data[0] = 0
+            return data
+        k = int(self.kernel_size)
+        z0, z1 = max(int(rows[0]) - k, 0), min(int(rows[-1]) + k + 1, image.shape[0])
+        x0, x1 = max(int(cols[0]) - k, 0), min(int(cols[-1]) + k + 1, image.shape[1])
+        
+        out = masked_median_filter(image[z0:z1, x0:x1], valid[z0:z1, x0:x1], k, self.value_range,
+                                   n_bins=self.n_bins, xp=xp)
+        out[~valid[z0:z1, x0:x1]] = 0
+        data[0] = 0
+        data[0, z0:z1, x0:x1] = out
+        return data
+
+    
+    
+class ResultPacking(Operation):
+    # Input: outputs of a processing pipeline (e.g. the tuple returned by Pipeline.process)
+    # Output: dict name -> host array, typed views of a single (pinned, on cupy) host buffer
+    # fields: list of (name, fn), fn(xp, outputs, out) computes the field on the device (post-processing, crops, ...)
+    # and either writes it into out and returns out, or returns it (e.g. a view of an output), then it is copied into
+    # out. out is None on the first call, which sizes the buffers.
+    # The fields are written into one device staging buffer, which is copied to the host buffer in a single
+    # transfer. The host views are overwritten by the next call.
+    def __init__(self, fields, align=64, num_pkg=None, filter_pkg=None, **kwargs):
+        self.fields = fields
+        self.align = align # byte alignment of the fields
+        self.host = None
+        self.set_pkgs(num_pkg, filter_pkg)
+        self.kwargs = kwargs
+    
+    def set_pkgs(self, num_pkg, filter_pkg, **kwargs):
+        self.xp, self.filter_pkg, self.fft = get_pkgs(num_pkg, filter_pkg)
+    
+    def prepare(self):
+        # Buffers are allocated on the first call (on the shapes of the fields)
+        self.host = None
+        return
+    
+    def alloc_buffers(self, arrays):
+        xp = self.xp
+        offsets = []
+        size = 0
+        for data in arrays:
+            offsets.append(size)
+            size += -(-data.nbytes // self.align) * self.align
+        self.staging = xp.empty(size, dtype=np.uint8)
+        if(hasattr(xp, 'cuda')):
+            import cupyx
+            self.host = cupyx.empty_pinned(size, dtype=np.uint8)
+        else:
+            self.host = self.staging # already on the host
+        
+        def views(buf):
+            return [buf[o:o+data.nbytes].view(data.dtype).reshape(data.shape) for o, data in zip(offsets, arrays)]
+        self.staging_views = views(self.staging)
+        self.views = {name: view for (name, fn), view in zip(self.fields, views(self.host))}
+    
+    def process(self, outputs):
+        xp = self.xp
+        if(self.host is None):
+            arrays = [xp.asarray(fn(xp, outputs, None)) for name, fn in self.fields]
+            self.alloc_buffers(arrays)
+            for data, view in zip(arrays, self.staging_views):
+                view[...] = data
+        else:
+            for (name, fn), view in zip(self.fields, self.staging_views):
+                data = fn(xp, outputs, view)
+                if(data is not view):
+                    view[...] = data
+        
+        # Single device to host transfer
+        if(self.host is not self.staging):
+            self.staging.get(out=self.host)
+        return self.views
@@ -0,0 +1,205 @@
+import os
+import json
+import queue
+import pickle
+import threading
+import numpy as np
+import scipy as sp
+import scipy.io
+
+# Memory-mapped RF datasets.
+# A recording (.mat, RF data in the 'data' variable, [seq, frame, channel, sample]) is converted once to an
+# uncompressed .npy file in the order used by the processing ([seq, frame, sample, channel], the input of the
+# reconstruction pipeline), which is then opened memory-mapped: only the samples actually used are read and
+# crops / frame subsets are views, not copies.
+#
+# Example:
+#   rf = open_rf('rf_id_0_shift_0.mat')  # converts on the first call
+#   rf = rf[:, 10:50, t0:, :]             # view, nothing read yet
+
+# .npy file of a recording, next to it or in npy_dir
+def rf_npy_path(mat_path, npy_dir=None):
+    directory, name = os.path.split(mat_path)
+    return os.path.join(directory if npy_dir is None else npy_dir, os.path.splitext(name)[0] + '.npy')
+
+def convert_rf(mat_path, npy_path=None, variable='data'):
+    if(npy_path is None):
+        npy_path = rf_npy_path(mat_path)
+    rf = sp.io.loadmat(mat_path, variable_names=[variable])[variable]
+    # Written sequence by sequence, straight into the file in the target order
+    out = np.lib.format.open_memmap(npy_path + '.tmp', mode='w+', dtype=rf.dtype,
+                                    shape=(rf.shape[0], rf.shape[1], rf.shape[3], rf.shape[2]))
+    for i in range(rf.shape[0]):
+        out[i] = np.transpose(rf[i], [0, 2, 1])
+    out.flush()
+    del out
+    os.replace(npy_path + '.tmp', npy_path)
+    return npy_path
+
+# Memory-mapped RF data [seq, frame, sample, channel] of a recording, (re)converted if the .npy file is missing or
+# older than the recording
+def open_rf(mat_path, npy_dir=None, mmap_mode='r', variable='data'):
+    npy_path = rf_npy_path(mat_path, npy_dir)
+    if(not os.path.exists(npy_path) or os.path.getmtime(npy_path) < os.path.getmtime(mat_path)):
+        convert_rf(mat_path, npy_path, variable)
+    return np.load(npy_path, mmap_mode=mmap_mode)
+
+
+## Recordings ##################################################
+# Streaming recorder of acquired frames (e.g. RF data [seq, sample, channel] after RemapToLogicalOrder).
+# Frames are appended to a raw file (path + '.rf') by a background writer thread through a memory map. The file is
+# preallocated chunk_frames frames at a time, so appending never rewrites it and the recording never sits in RAM.
+# At most max_pending frames wait for the writer (append() blocks beyond that). With max_frames the recording stops
+# after that many frames, the later ones are counted (n_skipped) but not written, e.g. for open-ended live sessions.
+# The layout (dtype, frame shape, number of frames) is kept in path + '.json', the acquisition metadata (e.g. the arrus
+# const metadata) is stored once in path + '.metadata.pkl'. open_recording() maps any frame range without reading
+# the rest of the file.
+#
+# Example:
+#   with RfRecorder('push_test', metadata=metadata) as recorder:
+#       recorder.append(buffer.get()[0])
+#   # or in an arrus pipeline: Lambda(recorder.record, recorder.set_metadata)
+#   frames, metadata = open_recording('push_test')
+#   frames[100:110]   # reads these frames only
+
+class RfRecorder():
+
+    def __init__(self, path, metadata=None, chunk_frames=16, max_pending=4, max_frames=None):
+        self.path = path
+        self.chunk_frames = chunk_frames if max_frames is None else max(min(chunk_frames, max_frames), 1)
+        self.max_frames = max_frames
+        self.n_frames = 0
+        self.n_appended = 0
+        self.n_skipped = 0
+        self.capacity = 0
+        self.frame_shape = None
+        self.dtype = None
+        self.frames = None
+        self.error = None
+        # A previous recording of the same path is replaced
+        for ext in ('.rf', '.json', '.metadata.pkl'):
+            if(os.path.exists(path + ext)):
+                os.remove(path + ext)
+        self.pending = queue.Queue(maxsize=max_pending)
+        self.writer = threading.Thread(target=self.write_loop, daemon=True)
+        self.writer.start()
+        if(metadata is not None):
+            self.set_metadata(metadata)
+
+    # Stores the metadata (once), returns it (arrus Lambda prepare function)
+    def set_metadata(self, metadata):
+        with open(self.path + '.metadata.pkl', 'wb') as f:
+            pickle.dump(metadata, f)
+        return metadata
+
+    # Appends a host frame, copied unless the caller hands it over (copy=False)
+    def append(self, frame, copy=True):
+        if(self.error is not None):
+            raise self.error
+        if(self.full):
+            self.n_skipped += 1
+            return
+        self.n_appended += 1
+        frame = np.array(frame, copy=True) if copy else np.asarray(frame)
+        if(self.frame_shape is None):
+            self.frame_shape = frame.shape
+            self.dtype = frame.dtype
+            self.write_layout()
+        elif(frame.shape != self.frame_shape or frame.dtype != self.dtype):
+            raise ValueError("Frame " + str(frame.shape) + " " + str(frame.dtype) + " does not match the recording "
+                             + str(self.frame_shape) + " " + str(self.dtype))
+        self.pending.put(frame)
+
+    # Appends a (numpy or cupy) frame and returns it unchanged (arrus Lambda function)
+    def record(self, data):
+        if(self.full):
+            self.n_skipped += 1 # not copied to the host either
+        elif(hasattr(data, 'get')):
+            self.append(data.get(), copy=False)
+        else:
+            self.append(data)
+        return data
+
+    # max_frames frames appended, the next ones are skipped
+    @property
+    def full(self):
+        return self.max_frames is not None and self.n_appended >= self.max_frames
+
+    def write_layout(self):
+        layout = dict(dtype=self.dtype.str, frame_shape=list(self.frame_shape), n_frames=self.n_frames)
+        with open(self.path + '.json.tmp', 'w') as f:
+            json.dump(layout, f)
+        os.replace(self.path + '.json.tmp', self.path + '.json')
+
+    # Extends the file (and its memory map) by one chunk
+    def grow(self):
+        frame_bytes = int(np.prod(self.frame_shape)) * self.dtype.itemsize
+        self.capacity += self.chunk_frames
+        if(self.frames is not None):
+            self.frames.flush()
+            del self.frames
+        with open(self.path + '.rf', 'ab') as f:
+            f.truncate(self.capacity * frame_bytes)
+        self.frames = np.memmap(self.path + '.rf', dtype=self.dtype, mode='r+',
+                                shape=(self.capacity,) + tuple(self.frame_shape))
+        # Frames readable so far, should the recording not be closed
+        self.write_layout()
+
+    def write_loop(self):
+        while(True):
+            frame = self.pending.get()
+            if(frame is None):
+                break
+            if(self.error is not None):
+                continue # drain after an error
+            try:
+                if(self.n_frames == self.capacity):
+                    self.grow()
+                self.frames[self.n_frames] = frame
+                self.n_frames += 1
+            except Exception as e:
+                self.error = e
+
+    # Waits for the pending frames, trims the file to the recorded frames and writes the final layout.
+    # Returns the number of frames.
+    def close(self):
+        if(self.writer is None):
+            return self.n_frames
+        self.pending.put(None)
+        self.writer.join()
+        self.writer = None
+        if(self.frames is not None):
+            self.frames.flush()
+            del self.frames
+            self.frames = None
+            with open(self.path + '.rf', 'ab') as f:
+                f.truncate(self.n_frames * int(np.prod(self.frame_shape)) * self.dtype.itemsize)
+        if(self.frame_shape is not None):
+            self.write_layout()
+        if(self.error is not None):
+            raise self.error
+        return self.n_frames
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+# Frames of a recording, memory-mapped [frame, ...] (mmap_mode=None loads them), and its metadata (None if not stored)
+def open_recording(path, mmap_mode='r'):
+    with open(path + '.json') as f:
+        layout = json.load(f)
+    shape = (layout['n_frames'],) + tuple(layout['frame_shape'])
+    if(layout['n_frames'] == 0):
+        frames = np.empty(shape, dtype=layout['dtype'])
+    elif(mmap_mode is None):
+        frames = np.fromfile(path + '.rf', dtype=layout['dtype']).reshape(shape)
+    else:
+        frames = np.memmap(path + '.rf', dtype=layout['dtype'], mode=mmap_mode, shape=shape)
+    metadata = None
+    if(os.path.exists(path + '.metadata.pkl')):
+        with open(path + '.metadata.pkl', 'rb') as f:
+            metadata = pickle.load(f)
+    return frames, metadata
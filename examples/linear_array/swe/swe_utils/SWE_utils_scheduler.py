@@ -0,0 +1,173 @@
+import time
+import queue
+import threading
+import numpy as np
+
+# Overlapped acquisition and processing of MANUAL-mode SWE shots.
+# A worker thread triggers the shots, reads their RF data into a small ring of host buffers and re-arms the device
+# (TXPB scan table reload) while the caller processes the previous shot. The buffers circulate in two bounded queues:
+# free -> acquisition -> full -> processing -> free, so with n_buffers=2 shot N+1 is acquired during the processing
+# of shot N and the acquisition stalls (instead of overwriting data) when the processing falls behind.
+#
+# Example:
+#   scheduler = ShotScheduler(ArrusDevice(sess, buffer, metadata, txpb=txpb), n_buffers=2)
+#   for i, rf in scheduler.shots(120):
+#       result = processing.process(cp.asarray(rf)) # rf is handed back to the acquisition at the next iteration
+
+
+## Devices #####################################################
+# Device interface of the scheduler: shape and dtype of the RF data of one shot, trigger() starts a shot, read(out)
+# waits for its RF data and copies them into out, rearm() prepares the device for the next shot.
+# read() gives up when the stop event (threading.Event, optional) is set, it returns False then and True otherwise.
+class Device():
+    shape = None
+    dtype = None
+
+    def trigger(self):
+        raise NotImplementedError
+
+    def read(self, out, stop=None):
+        raise NotImplementedError
+
+    def rearm(self):
+        return
+
+
+# us4R session in MANUAL work mode (sess.run() per shot) with an optional TXPB to reload after each shot.
+# buffer, metadata: sess.upload(scheme) results.
+class ArrusDevice(Device):
+
+    def __init__(self, sess, buffer, metadata, txpb=None, rearm_delay=0.01, poll_interval=0.1):
+        self.sess = sess
+        self.txpb = txpb
+        self.rearm_delay = rearm_delay # between the scan table reset and the preload request [s]
+        self.poll_interval = poll_interval # of the stop event while waiting for the data [s]
+        self.shape = tuple(metadata.input_shape)
+        self.dtype = metadata.dtype
+        # The elements are kept (not released) until their data are copied by read()
+        self.elements = queue.Queue()
+        buffer.append_on_new_data_callback(self.elements.put)
+
+    def trigger(self):
+        self.sess.run()
+
+    def read(self, out, stop=None):
+        while(True):
+            try:
+                element = self.elements.get(timeout=self.poll_interval)
+                break
+            except queue.Empty:
+                if(stop is not None and stop.is_set()):
+                    return False
+        np.copyto(out, element.data)
+        element.release()
+        return True
+
+    def rearm(self):
+        if(self.txpb is not None):
+            self.txpb.reset_scan_table_index()
+            time.sleep(self.rearm_delay)
+            self.txpb.preload_req()
+
+
+# Replays recorded RF data (e.g. open_rf() memmap or a synthetic stack), rf[i % len(rf)] for the i-th shot, with the
+# timing of a real device: the data are available acquisition_time [s] after trigger(), rearm() takes rearm_time [s].
+class SimulatedDevice(Device):
+
+    def __init__(self, rf, acquisition_time=0.0, rearm_time=0.01):
+        self.rf = rf
+        self.acquisition_time = acquisition_time
+        self.rearm_time = rearm_time
+        self.shape = tuple(rf.shape[1:])
+        self.dtype = rf.dtype
+        self.n_shots = 0
+        self.t_trigger = None
+
+    def trigger(self):
+        self.t_trigger = time.perf_counter()
+
+    def read(self, out, stop=None):
+        wait = self.t_trigger + self.acquisition_time - time.perf_counter()
+        if(wait > 0):
+            if(stop is None):
+                time.sleep(wait)
+            elif(stop.wait(wait)):
+                return False
+        np.copyto(out, self.rf[self.n_shots % len(self.rf)])
+        self.n_shots += 1
+        return True
+
+    def rearm(self):
+        if(self.rearm_time > 0):
+            time.sleep(self.rearm_time)
+
+
+## Scheduler ###################################################
+class ShotScheduler():
+
+    # alloc: host buffer allocator, e.g. cupyx.empty_pinned for faster uploads to the GPU
+    # join_timeout: how long an early exit waits for the acquisition worker [s]
+    def __init__(self, device, n_buffers=2, alloc=np.empty, join_timeout=5.0):
+        if(n_buffers < 1):
+            raise ValueError("n_buffers must be >= 1")
+        self.device = device
+        self.join_timeout = join_timeout
+        self.buffers = [alloc(device.shape, dtype=device.dtype) for _ in range(n_buffers)]
+        self.times = [] # per shot: acquisition (trigger + read), rearm and processing wait [s]
+
+    # Acquisition worker: one shot per free buffer, the errors are handed over to the consumer
+    def acquire(self, n_shots, free, full, stop):
+        try:
+            for i in range(n_shots):
+                buf = free.get()
+                if(stop.is_set()):
+                    return
+                t0 = time.perf_counter()
+                self.device.trigger()
+                if(not self.device.read(buf, stop)):
+                    return
+                t1 = time.perf_counter()
+                full.put((i, buf))
+                self.device.rearm()
+                self.times[i]['acquisition'] = t1 - t0
+                self.times[i]['rearm'] = time.perf_counter() - t1
+        except BaseException as e:
+            full.put((None, e))
+            return
+        full.put((None, None))
+
+    # Yields (shot index, RF buffer) for n_shots shots, the buffer is reused once the loop body returns
+    def shots(self, n_shots):
+        # Bounded by the buffers in circulation, plus the stop/end marker
+        free = queue.Queue(maxsize=len(self.buffers) + 1)
+        full = queue.Queue(maxsize=len(self.buffers) + 1)
+        for buf in self.buffers:
+            free.put(buf)
+        stop = threading.Event()
+        self.times = [dict(acquisition=None, rearm=None, wait=None) for _ in range(n_shots)]
+        worker = threading.Thread(target=self.acquire, args=(n_shots, free, full, stop), daemon=True)
+        worker.start()
+        try:
+            while(True):
+                t0 = time.perf_counter()
+                i, buf = full.get()
+                if(i is None):
+                    if(buf is not None):
+                        raise buf
+                    return
+                self.times[i]['wait'] = time.perf_counter() - t0
+                yield i, buf
+                free.put(buf)
+        finally:
+            # Early exit of the loop: wake the worker up, a pending read gives up on the stop event. A worker stuck
+            # in the device (e.g. in sess.run()) is left behind (daemon thread) instead of blocking the exit
+            stop.set()
+            free.put(None)
+            worker.join(self.join_timeout)
+            if(worker.is_alive()):
+                print("ShotScheduler: the acquisition worker did not stop within " + str(self.join_timeout) + " s")
+
+    # Median times over the shots [s]
+    def summary(self):
+        return {name: float(np.median([t[name] for t in self.times if t[name] is not None] or [np.nan]))
+                for name in ('acquisition', 'rearm', 'wait')}
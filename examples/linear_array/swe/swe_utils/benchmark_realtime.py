@@ -0,0 +1,125 @@
+import numpy as np
+import scipy as sp
+import scipy.ndimage
+import sys
+import time
+import argparse
+import benchmark_swe
+from SWE_utils_ops import *
+from SWE_utils_rf import open_rf
+from SWE_utils_scheduler import ShotScheduler, SimulatedDevice
+from SWE_utils_display import LiveDisplay
+
+# Shot rate of the realtime SWE loop without hardware: a SimulatedDevice replays recorded RF data (--rf, .mat
+# recording, one shot per sequence) or synthetic shear wave IQ stacks, and the shots are processed either serially
+# (trigger, read, process, rearm, as the former realtime loop) or overlapped by the ShotScheduler.
+# Processing: 'swe' - the SWE chain of benchmark_swe.py on the synthetic IQ stacks, 'sleep' - a fixed processing time
+# (--processTime, e.g. the measured GPU time of a shot), the only one available for recorded RF.
+# With --displayFps the 'swe' SWS maps are also shown by a LiveDisplay (own process, Agg backend), so that the
+# rate of both modes includes the display hand-over. The per-shot results of both modes are compared, the exit code
+# is 1 if they differ.
+#
+# Example:
+#   python benchmark_realtime.py --shots 20 --acquisitionTime 0.05 --rearmTime 0.01 --buffers 2
+#   python benchmark_realtime.py --rf rf_id_0_shift_0.mat --process sleep --processTime 0.08
+
+
+def serial(device, process, n_shots):
+    buf = np.empty(device.shape, dtype=device.dtype)
+    results = []
+    for i in range(n_shots):
+        device.trigger()
+        device.read(buf)
+        results.append(process(buf))
+        device.rearm()
+    return results
+
+def overlapped(device, process, n_shots, n_buffers):
+    scheduler = ShotScheduler(device, n_buffers=n_buffers)
+    results = [process(rf) for i, rf in scheduler.shots(n_shots)]
+    return results, scheduler.summary()
+
+# Synthetic shots: IQ stacks [frame, x, z] of different shear wave speeds, and the SWE chain run on them
+def swe_shots(args, n):
+    cfg = dict(gridStep=args.gridStep, frames=args.frames, iFactor=args.iFactor, iOrder=2, d_mm=4.0, sws=2.0,
+               width=30.0, depth=20.0, fri=160e-6, snr_db=30.0, seed=0, push_exclusion_mm=2.0, swd_mode='kasai',
+               z_stride=1, single_precision=True, fft_mode='r2c', tile_z=None, interp_mode='zoom', correlator='fft',
+               median_mode='exact', buffer_pool=True)
+    iq = np.stack([benchmark_swe.synthesize_iq(sws, cfg['gridStep'], cfg['width'], cfg['depth'],
+                                               cfg['frames'] + 2*benchmark_swe.N_ANGLES - 2, cfg['fri'], seed=k)
+                   for k, sws in enumerate(np.linspace(1.5, 3.0, n))])
+    chain = benchmark_swe.build_chain(cfg, np, sp.ndimage, buffer_pool=BufferPool(np))
+    x = iq[0]
+    for name in benchmark_swe.STAGES:
+        benchmark_swe.prepare_stage(name, chain[name], x, cfg)
+        x = chain[name].process(x)
+
+    def process(rf):
+        x = rf
+        for name in benchmark_swe.STAGES:
+            x = chain[name].process(x)
+        return np.array(x[0], copy=True)
+    return iq, process
+
+
+def main(args):
+    if(args.rf is not None):
+        if(args.process != 'sleep'):
+            raise ValueError("recorded RF data can only be processed with --process sleep")
+        shots = open_rf(args.rf)
+    elif(args.process == 'swe'):
+        shots, process = swe_shots(args, 3)
+    else:
+        shots = np.random.default_rng(0).standard_normal((3, args.frames, 128, 1024), dtype=np.float32)
+
+    if(args.process == 'sleep'):
+        def process(rf):
+            time.sleep(args.processTime)
+            return float(np.sum(rf[..., ::64]))
+    elif(args.displayFps is not None):
+        display = LiveDisplay([dict(title='Shear wave speed', cmap='jet', vmin=0, vmax=5, label='[m/s]')],
+                              grid_step=args.gridStep, max_fps=args.displayFps, backend='Agg')
+        display.start()
+        process_swe = process
+        def process(rf):
+            sws = process_swe(rf)
+            display.show(sws)
+            return sws
+
+    rates = {}
+    results = {}
+    for mode in ('serial', 'overlapped'):
+        device = SimulatedDevice(shots, acquisition_time=args.acquisitionTime, rearm_time=args.rearmTime)
+        t = time.perf_counter()
+        if(mode == 'serial'):
+            results[mode] = serial(device, process, args.shots)
+        else:
+            results[mode], summary = overlapped(device, process, args.shots, args.buffers)
+        rates[mode] = args.shots / (time.perf_counter() - t)
+        print("{:10s} {:6.2f} shots/s".format(mode, rates[mode]))
+    print("acquisition {acquisition:.4f} s, rearm {rearm:.4f} s, processing wait {wait:.4f} s (median per shot)".format(**summary))
+    print("speedup x{:.2f}".format(rates['overlapped'] / rates['serial']))
+    if(args.process == 'swe' and args.displayFps is not None):
+        display.close()
+        print("display: {} image sets, {} dropped".format(display.n_shown, display.n_dropped))
+
+    ok = all(np.array_equal(a, b) for a, b in zip(results['serial'], results['overlapped']))
+    print("results " + ("identical" if ok else "DIFFERENT"))
+    return 0 if ok else 1
+
+# Parser
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Realtime SWE loop benchmark on a simulated device.")
+    parser.add_argument("--rf", dest="rf", default=None, help="RF recording (.mat) to replay")
+    parser.add_argument("--process", dest="process", choices=['swe', 'sleep'], default='swe')
+    parser.add_argument("--processTime", dest="processTime", type=float, default=0.05, help="'sleep' processing time [s]")
+    parser.add_argument("--shots", dest="shots", type=int, default=10)
+    parser.add_argument("--buffers", dest="buffers", type=int, default=2)
+    parser.add_argument("--acquisitionTime", dest="acquisitionTime", type=float, default=0.05, help="[s]")
+    parser.add_argument("--rearmTime", dest="rearmTime", type=float, default=0.01, help="TXPB reload [s]")
+    parser.add_argument("--displayFps", dest="displayFps", type=float, default=None, help="'swe' display rate limit")
+    parser.add_argument("--gridStep", dest="gridStep", type=float, default=0.4, help="'swe' grid step [mm]")
+    parser.add_argument("--frames", dest="frames", type=int, default=60, help="'swe' compounded frames")
+    parser.add_argument("--iFactor", dest="iFactor", type=int, default=2, help="'swe' SWS interpolation factor")
+    args = parser.parse_args()
+    sys.exit(main(args))
@@ -0,0 +1,323 @@
+import numpy as np
+import scipy as sp
+import scipy.ndimage
+import os
+import sys
+import json
+import time
+import platform
+import argparse
+import itertools
+import tracemalloc
+from SWE_utils_ops import *
+
+# End-to-end benchmark of the SWE processing chain on synthetic data:
+# AngleCompounding -> ShearwaveDetection -> ShearwaveMotionDataFiltering -> SWS_Estimation -> SWS_Compounding -> MedianFiltering
+# Every stage is timed separately (median of the repeats) and its peak memory recorded, the recovered SWS is checked
+# against the simulated one and the results are written to a JSON report. With --baseline the stage times are compared
+# with a previous report. With --parity the checks of parity_swe.py are run on the first configuration as well.
+# The exit code is 1 if any check or comparison fails.
+#
+# Example:
+#   python benchmark_swe.py --gridStep 0.2 0.1 --frames 100 --iFactor 5 --report swe_bench.json --parity
+
+STAGES = ['AngleCompounding', 'ShearwaveDetection', 'ShearwaveMotionDataFiltering', 'SWS_Estimation',
+          'SWS_Compounding', 'MedianFiltering']
+
+# Constants of the synthetic acquisition
+C          = 1540.0  # speed of sound [m/s]
+FC         = 4.4e6   # transmit frequency [Hz]
+FS         = 65e6    # RF sampling frequency [Hz]
+N_ANGLES   = 3       # PWI angles, compounded by a sliding mean over frames
+
+
+## Synthetic data ##############################################
+# Shear wave displacement of a push along the line x = 0: Ricker pulses of centre frequency f_sw leaving the push line
+# in both directions at speed sws, with cylindrical spreading. t [s], x [m], returns [t, x] in [m].
+def shear_wave_displacement(t, x, sws, f_sw=300.0, amplitude=5e-6, t0=2e-3):
+    r = np.abs(x)[np.newaxis, :]
+    a = (np.pi * f_sw * (t[:, np.newaxis] - t0 - r/sws))**2
+    return amplitude * (1 - 2*a) * np.exp(-a) / np.sqrt(np.maximum(r, 1e-3) / 1e-3)
+
+# IQ frames [frame, x, z] (complex64) of a homogeneous speckle medium moved axially by the shear wave.
+# grid_step, width, depth in [mm], the push is at the lateral centre of the grid.
+def synthesize_iq(sws, grid_step, width, depth, n_frames, fri, f_sw=300.0, amplitude=5e-6, snr_db=30.0, seed=0):
+    rng = np.random.default_rng(seed)
+    x = np.arange(-width/2, width/2, grid_step) * 1e-3
+    z = np.arange(0, depth, grid_step) * 1e-3
+    t = np.arange(n_frames) * fri
+
+    # Fully developed speckle, PSF ~0.3 mm laterally and ~0.15 mm axially
+    sigma = (0.3/grid_step, 0.15/grid_step)
+    speckle = (sp.ndimage.gaussian_filter(rng.standard_normal((x.size, z.size)), sigma)
+               + 1j*sp.ndimage.gaussian_filter(rng.standard_normal((x.size, z.size)), sigma))
+    speckle /= np.sqrt(np.mean(np.abs(speckle)**2))
+
+    # Axial displacement -> phase of the IQ data
+    u = shear_wave_displacement(t, x, sws, f_sw=f_sw, amplitude=amplitude)
+    phase = np.exp(1j * 4*np.pi*FC/C * u)
+    iq = speckle[np.newaxis, :, :] * phase[:, :, np.newaxis]
+
+    noise = 10**(-snr_db/20) / np.sqrt(2)
+    iq += noise * (rng.standard_normal(iq.shape) + 1j*rng.standard_normal(iq.shape))
+    return iq.astype(np.complex64)
+
+
+## Backends ####################################################
+def get_backend(name):
+    if(name == 'numpy'):
+        return np, sp.ndimage
+    import cupy as cp
+    import cupyx.scipy.ndimage
+    return cp, cupyx.scipy.ndimage
+
+def synchronize(xp):
+    if(hasattr(xp, 'cuda')):
+        xp.cuda.get_current_stream().synchronize()
+
+def to_device(xp, data):
+    return xp.asarray(data)
+
+
+## Processing chain ############################################
+# Chain parameters for one benchmark configuration, scaled with the grid step as in perf_rec_offline.py
+def chain_params(cfg):
+    gs = cfg['gridStep']
+    nx = len(np.arange(-cfg['width']/2, cfg['width']/2, gs))
+    d = max(int(round(cfg['d_mm'] / gs)), 1)
+    x_excl = int(np.ceil(cfg['push_exclusion_mm'] / gs))
+    z_stride = cfg.get('z_stride', 1) # depth rows after ShearwaveDetection are z_stride grid steps apart
+    return dict(
+        z_gate = max(int(4.0*0.2/gs), 1),
+        d = d,
+        # L->R waves right of the push, R->L left of it
+        x_range = [[nx//2 + x_excl, nx], [0, nx//2 - x_excl]],
+        z_clip = [int(np.ceil(5 / z_stride)), int(np.ceil(10 / z_stride))], # 5 and 10 grid steps, in output rows
+        frames_range = [0, min(90, cfg['frames'] - 2)],
+        median_size = max(int(5*0.2/gs), 1),
+        nx = nx,
+        x_excl = x_excl,
+    )
+
+def build_chain(cfg, xp, ndi, buffer_pool=None):
+    p = chain_params(cfg)
+    pkgs = dict(num_pkg=xp, filter_pkg=ndi, buffer_pool=buffer_pool)
+    return dict(
+        AngleCompounding = AngleCompounding(nAngles=N_ANGLES, **pkgs),
+        ShearwaveDetection = ShearwaveDetection(mode=cfg['swd_mode'], packet_size=4, z_gate=p['z_gate'], fc=FC,
+                                                z_stride=cfg['z_stride'], single_precision=cfg['single_precision'], **pkgs),
+        ShearwaveMotionDataFiltering = ShearwaveMotionDataFiltering(sws_range=[0.5, 4.5], f_range=[40.0, 700.0], k_range=0.9,
+                                                                    fft_mode=cfg['fft_mode'], tile_z=cfg['tile_z'], **pkgs),
+        SWS_Estimation = SWS_Estimation(x_range=p['x_range'], z_clip=p['z_clip'], frames_range=p['frames_range'], d=p['d'],
+                                        fri=cfg['fri'], interp_factor=cfg['iFactor'], interp_order=cfg['iOrder'],
+                                        px_pitch=cfg['gridStep']*1e-3, sws_range=[0.5, 4.5], interp_mode=cfg['interp_mode'],
+                                        correlator=cfg['correlator'], tile_z=cfg['tile_z'], **pkgs),
+        SWS_Compounding = SWS_Compounding(**pkgs),
+        MedianFiltering = MedianFiltering(kernel_size=p['median_size'], mode=cfg['median_mode'], **pkgs),
+    )
+
+def prepare_stage(name, op, data, cfg):
+    if(name == 'AngleCompounding'):
+        op.prepare(n_frames=data.shape[0])
+    elif(name == 'ShearwaveDetection'):
+        op.prepare(c=C, frame_pri=cfg['fri'], fs=FS, input_shape=data.shape)
+    elif(name == 'ShearwaveMotionDataFiltering'):
+        op.prepare(input_shape=data.shape, fs=1.0/cfg['fri'])
+    elif(name == 'SWS_Estimation'):
+        op.prepare(input_shape=data.shape)
+    else:
+        op.prepare()
+
+# Runs the prepared chain once, returns the output of every stage and the stage times [s].
+# The ops reuse their output buffers, so the outputs are copied before being kept.
+def run_chain(chain, data, xp, keep_outputs=False, track_memory=False):
+    times = {}
+    peaks = {}
+    outputs = {}
+    for name in STAGES:
+        if(track_memory):
+            start_memory(xp)
+        synchronize(xp)
+        t0 = time.perf_counter()
+        data = chain[name].process(data)
+        synchronize(xp)
+        times[name] = time.perf_counter() - t0
+        if(track_memory):
+            peaks[name] = stop_memory(xp)
+        if(keep_outputs):
+            outputs[name] = xp.array(data, copy=True)
+    return outputs, times, peaks
+
+
+## Peak memory #################################################
+# numpy: tracemalloc peak of the stage. cupy: size of the default memory pool after the stage, with the pool emptied
+# before it (the pool keeps every block it allocated, so this is the peak of the stage).
+def start_memory(xp):
+    if(hasattr(xp, 'cuda')):
+        xp.get_default_memory_pool().free_all_blocks()
+        start_memory.base = xp.get_default_memory_pool().total_bytes()
+    else:
+        tracemalloc.start()
+
+def stop_memory(xp):
+    if(hasattr(xp, 'cuda')):
+        return int(xp.get_default_memory_pool().total_bytes() - start_memory.base)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return int(peak)
+
+
+## SWS check ###################################################
+# Median of the final SWS map over the estimated rows, away from the push and from the lateral edges
+def check_sws(sws_map, cfg, tolerance):
+    p = chain_params(cfg)
+    z0, z1 = p['z_clip'][0], sws_map.shape[0] - p['z_clip'][1]
+    margin = p['x_excl'] + p['d']
+    cols = np.r_[margin:p['nx']//2 - margin, p['nx']//2 + margin:p['nx'] - margin]
+    roi = sws_map[z0:z1][:, cols]
+    roi = roi[roi > 0]
+    median = float(np.median(roi)) if roi.size else float('nan')
+    rel_error = abs(median - cfg['sws']) / cfg['sws']
+    return dict(true=cfg['sws'], median=median, iqr=[float(v) for v in np.percentile(roi, [25, 75])] if roi.size else None,
+                rel_error=rel_error, ok=bool(rel_error <= tolerance))
+
+def benchmark(cfg, xp, ndi, repeats, tolerance):
+    iq = synthesize_iq(cfg['sws'], cfg['gridStep'], cfg['width'], cfg['depth'], cfg['frames'] + 2*N_ANGLES - 2, cfg['fri'],
+                       snr_db=cfg['snr_db'], seed=cfg['seed'])
+    data = to_device(xp, iq)
+
+    # Prepare every stage on the shape of its input, optionally with the buffers of all the ops in one pool
+    pool = BufferPool(xp) if cfg['buffer_pool'] else None
+    chain = build_chain(cfg, xp, ndi, buffer_pool=pool)
+    x = data
+    for name in STAGES:
+        prepare_stage(name, chain[name], x, cfg)
+        x = chain[name].process(x)
+    warm_allocs = None if pool is None else pool.n_allocs
+
+    # Timed runs (the first one above is the warm-up), then one run with memory tracking
+    times = {name: [] for name in STAGES}
+    for _ in range(repeats):
+        _, t, _ = run_chain(chain, data, xp)
+        for name in STAGES:
+            times[name].append(t[name])
+    _, _, peaks = run_chain(chain, data, xp, track_memory=True)
+    final = to_host(chain['MedianFiltering'].process(chain['SWS_Compounding'].process(
+        chain['SWS_Estimation'].process(chain['ShearwaveMotionDataFiltering'].process(
+        chain['ShearwaveDetection'].process(chain['AngleCompounding'].process(data)))))))
+
+    stages = {name: dict(time_s=float(np.median(times[name])), times_s=[float(v) for v in times[name]],
+                         peak_bytes=peaks[name]) for name in STAGES}
+    run = dict(config=cfg, input_shape=list(iq.shape), stages=stages,
+               total_time_s=float(sum(s['time_s'] for s in stages.values())),
+               sws=check_sws(final[0], cfg, tolerance))
+    # Pool allocations after the warm-up run: none expected
+    if(pool is not None):
+        run['buffer_pool'] = dict(bytes=pool.n_bytes, warm_up_allocs=warm_allocs, steady_allocs=pool.n_allocs - warm_allocs,
+                                  ok=pool.n_allocs == warm_allocs)
+    return run
+
+
+## Baseline comparison #########################################
+# Stage times slower than max_slowdown x the baseline, for the configurations present in both reports
+def compare_with_baseline(report, baseline, max_slowdown):
+    regressions = []
+    base_runs = {json.dumps(r['config'], sort_keys=True): r for r in baseline['runs']}
+    for run in report['runs']:
+        base = base_runs.get(json.dumps(run['config'], sort_keys=True))
+        if(base is None):
+            continue
+        for name in STAGES:
+            t, t_base = run['stages'][name]['time_s'], base['stages'][name]['time_s']
+            if(t > max_slowdown * t_base):
+                regressions.append(dict(config=run['config'], stage=name, time_s=t, baseline_time_s=t_base,
+                                        ratio=t / t_base))
+    return regressions
+
+
+def main(args):
+    xp, ndi = get_backend(args.backend)
+
+    configs = []
+    for gridStep, frames, iFactor, d_mm, sws in itertools.product(args.gridStep, args.frames, args.iFactor, args.d, args.sws):
+        configs.append(dict(gridStep=gridStep, frames=frames, iFactor=iFactor, iOrder=args.iOrder, d_mm=d_mm, sws=sws,
+                            width=args.width, depth=args.depth, fri=args.fri, snr_db=args.snr, seed=args.seed,
+                            push_exclusion_mm=2.0, swd_mode=args.swdMode, z_stride=args.zStride,
+                            single_precision=args.singlePrecision, fft_mode=args.fftMode, tile_z=args.tileZ,
+                            interp_mode=args.interpMode, correlator=args.correlator, median_mode=args.medianMode,
+                            buffer_pool=args.bufferPool))
+
+    report = dict(meta=dict(backend=args.backend, numpy=np.__version__, scipy=sp.__version__, python=platform.python_version(),
+                            machine=platform.machine(), processor=platform.processor(), repeats=args.repeats,
+                            argv=sys.argv[1:], time=time.strftime('%Y-%m-%dT%H:%M:%S')),
+                  runs=[])
+    ok = True
+    for cfg in configs:
+        run = benchmark(cfg, xp, ndi, args.repeats, args.swsTolerance)
+        report['runs'].append(run)
+        ok &= run['sws']['ok']
+        print("gridStep {gridStep} mm, {frames} frames, iFactor {iFactor}, d {d_mm} mm:".format(**cfg),
+              "total {:.3f} s,".format(run['total_time_s']),
+              "SWS {:.3f} m/s (true {:.2f}) {}".format(run['sws']['median'], cfg['sws'], 'ok' if run['sws']['ok'] else 'FAILED'))
+        for name in STAGES:
+            s = run['stages'][name]
+            print("    {:30s} {:9.4f} s {:9.1f} MB".format(name, s['time_s'], s['peak_bytes'] / 2**20))
+        if('buffer_pool' in run):
+            r = run['buffer_pool']
+            print("    buffer pool: {:.1f} MB in {} buffers, {} allocations after the warm-up {}".format(
+                  r['bytes'] / 2**20, r['warm_up_allocs'], r['steady_allocs'], 'ok' if r['ok'] else 'FAILED'))
+            ok &= r['ok']
+
+    if(args.parity):
+        from parity_swe import check_parity
+        report['parity'] = check_parity(configs[0], xp, ndi)
+        for name, r in report['parity'].items():
+            print("parity {:40s} {:.2e} {}".format(name, r['rel_error'], 'ok' if r['ok'] else 'FAILED'))
+            ok &= r['ok']
+
+    if(args.baseline is not None):
+        with open(args.baseline) as f:
+            report['regressions'] = compare_with_baseline(report, json.load(f), args.maxSlowdown)
+        for r in report['regressions']:
+            print("regression: {} {:.4f} s vs {:.4f} s (x{:.2f})".format(r['stage'], r['time_s'], r['baseline_time_s'], r['ratio']))
+        ok &= not report['regressions']
+
+    report['ok'] = bool(ok)
+    if(args.report is not None):
+        with open(args.report, 'w') as f:
+            json.dump(report, f, indent=2)
+    return 0 if ok else 1
+
+
+# Parser
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="SWE processing chain benchmark on synthetic shear waves.")
+    parser.add_argument("--backend", dest="backend", choices=['numpy', 'cupy'], default='numpy')
+    parser.add_argument("--gridStep", dest="gridStep", type=float, nargs='+', default=[0.2], help="grid step(s) [mm]")
+    parser.add_argument("--frames", dest="frames", type=int, nargs='+', default=[100], help="compounded frame count(s)")
+    parser.add_argument("--iFactor", dest="iFactor", type=int, nargs='+', default=[5], help="SWS interpolation factor(s)")
+    parser.add_argument("--iOrder", dest="iOrder", type=int, default=2)
+    parser.add_argument("--d", dest="d", type=float, nargs='+', default=[4.0], help="SWS lateral separation(s) [mm]")
+    parser.add_argument("--sws", dest="sws", type=float, nargs='+', default=[2.0], help="simulated shear wave speed(s) [m/s]")
+    parser.add_argument("--width", dest="width", type=float, default=30.0, help="lateral extent [mm]")
+    parser.add_argument("--depth", dest="depth", type=float, default=20.0, help="depth extent [mm]")
+    parser.add_argument("--fri", dest="fri", type=float, default=160e-6, help="frame repetition interval [s]")
+    parser.add_argument("--snr", dest="snr", type=float, default=30.0, help="IQ SNR [dB]")
+    parser.add_argument("--seed", dest="seed", type=int, default=0)
+    parser.add_argument("--swdMode", dest="swdMode", choices=['kasai', 'loupas'], default='kasai')
+    parser.add_argument("--zStride", dest="zStride", type=int, default=1)
+    parser.add_argument("--singlePrecision", dest="singlePrecision", action='store_true')
+    parser.add_argument("--fftMode", dest="fftMode", choices=['c2c', 'r2c'], default='c2c')
+    parser.add_argument("--tileZ", dest="tileZ", type=int, default=None)
+    parser.add_argument("--interpMode", dest="interpMode", choices=['zoom', 'fft', 'parabolic'], default='zoom')
+    parser.add_argument("--correlator", dest="correlator", choices=['fft', 'direct'], default='fft')
+    parser.add_argument("--medianMode", dest="medianMode", choices=['exact', 'histogram'], default='exact')
+    parser.add_argument("--bufferPool", dest="bufferPool", action='store_true', help="op buffers from a shared BufferPool")
+    parser.add_argument("--repeats", dest="repeats", type=int, default=3)
+    parser.add_argument("--swsTolerance", dest="swsTolerance", type=float, default=0.1, help="max relative SWS error")
+    parser.add_argument("--parity", dest="parity", action='store_true', help="check the ops against reference implementations")
+    parser.add_argument("--report", dest="report", default=None, help="JSON report path")
+    parser.add_argument("--baseline", dest="baseline", default=None, help="JSON report to compare the stage times with")
+    parser.add_argument("--maxSlowdown", dest="maxSlowdown", type=float, default=1.25)
+    args = parser.parse_args()
+    sys.exit(main(args))
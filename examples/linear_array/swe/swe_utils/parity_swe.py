@@ -0,0 +1,310 @@
+import numpy as np
+import scipy as sp
+import scipy.ndimage
+import sys
+import json
+import argparse
+from SWE_utils_ops import *
+from benchmark_swe import (STAGES, C, FC, FS, N_ANGLES, synthesize_iq, get_backend, to_device, chain_params, build_chain,
+                           prepare_stage)
+
+# Parity checks of the SWE ops (SWE_utils_ops.py) on synthetic shear wave data, runnable on CPU-only machines.
+# Every op and mode is compared with a straightforward reference implementation (the formulation the op was optimized
+# from) or with its default mode, and the whole chain with the numpy backend when run on cupy. The exit code is 1 if
+# any check fails.
+#
+# Example:
+#   python parity_swe.py
+#   python parity_swe.py --backend cupy --gridStep 0.1 --report parity.json
+
+
+## Reference implementations ###################################
+def reference_angle_compounding(data, n):
+    data = sp.ndimage.convolve1d(data, np.ones(n) / n, axis=0)
+    return data[n-1:-n+1]
+
+def reference_shearwave_detection(data, mode, packet_size, z_gate, fc, c, frame_pri, fs):
+    data = np.moveaxis(data, [0,1], [2,1])
+    P0 = data[:-1,:,:-1] * np.conj(data[:-1,:,1:])
+    P0 = sp.ndimage.convolve1d(P0, np.ones(packet_size), axis=2)
+    P0 = sp.ndimage.convolve1d(P0, np.ones(z_gate), axis=0)
+    f_d = np.angle(P0) / (2*np.pi)
+    if(mode == 'loupas'):
+        P1 = data[:-1,:,:] * np.conj(data[1:,:,:])
+        P1 = sp.ndimage.convolve1d(P1, np.ones(packet_size), axis=2)
+        P1 = sp.ndimage.convolve1d(P1, np.ones(z_gate), axis=0)
+        fc_shift = np.abs(np.angle(P1) / (2*np.pi/fs))[:, :, 1:]
+        fc_shift[fc_shift == 0] = 1e-9
+        return c * f_d / (2*fc_shift*frame_pri)
+    return c * f_d / (2*fc*frame_pri)
+
+# Per-direction loop of the former SWS_Estimation: zoom interpolation, FFT cross-correlation of each column pair,
+# LR and RL one after the other. data [LR/RL, z, x, frame], returns [SWV/r, LR/RL, z, x].
+# linear=True: zero-padded FFTs, the linear correlation evaluated by the 'direct' correlator instead of the circular one
+# Also returns the pixels [LR/RL, z, x] whose two largest correlation values are tied within single precision: the
+# lag (SWS) found there by a single precision estimator is arbitrary.
+def reference_sws_estimation(data, x_range, z_clip, frames_range, d, fri, interp_factor, interp_order, px_pitch, sws_range,
+                             linear=False):
+    SWV = np.zeros((2, 2, data.shape[1], data.shape[2]))
+    ties = np.zeros((2, data.shape[1], data.shape[2]), dtype=bool)
+    N = (frames_range[1] - frames_range[0]) * interp_factor
+    w = sp.signal.windows.tukey(N, alpha=0.2, sym=True)
+    for i in range(2):
+        xL = max(x_range[i][0] - int(np.ceil(d/2)), 0)
+        xR = min(x_range[i][1] + int(np.ceil(d/2)), data.shape[2])
+        ddata = np.array(data[i, z_clip[0]:-z_clip[1], xL:xR, frames_range[0]:frames_range[1]])
+        ddata[np.isnan(ddata)] = 0
+        ynew = sp.ndimage.zoom(input=ddata, zoom=(1, 1, interp_factor), output=data.dtype, order=interp_order)
+        ynew = (ynew - np.mean(ynew, axis=2, keepdims=True)) * w
+        Rxa = np.sum(ynew[:, :-d] * ynew[:, :-d], axis=2)
+        Rxb = np.sum(ynew[:, d:] * ynew[:, d:], axis=2)
+        n = 2*N if linear else N
+        X = sp.fft.rfft(ynew, n=n, axis=2)
+        c = sp.fft.irfft(X[:, :-d] * np.conj(X[:, d:]), n=n, axis=2)
+        c = np.concatenate((c[:, :, n//2:], c[:, :, :n//2]), axis=2) / (np.sqrt(Rxa) * np.sqrt(Rxb))[:, :, np.newaxis]
+        lag = np.abs(np.argmax(c, axis=2) - n//2)
+        lag[lag == 0] = 1
+        x0, x1 = int(np.ceil(xL + d/2)), int(np.ceil(xR - d/2))
+        SWV[0, i, z_clip[0]:-z_clip[1], x0:x1] = np.clip(px_pitch * d / (fri * lag / interp_factor), *sws_range)
+        SWV[1, i, z_clip[0]:-z_clip[1], x0:x1] = np.amax(c, axis=2)
+        top = np.sort(c, axis=2)[:, :, -2:]
+        ties[i, z_clip[0]:-z_clip[1], x0:x1] = top[:, :, 1] - top[:, :, 0] <= 1e-6 * np.abs(top[:, :, 1])
+    return SWV, ties
+
+# Relative error of SWS_Estimation maps, the SWS of the tied pixels is not compared
+def sws_error(out, ref, ties):
+    out = np.array(out, copy=True)
+    out[0][ties] = ref[0][ties]
+    return rel_error(out, ref)
+
+def reference_sws_compounding(data):
+    SWScr = np.sum(data[1], axis=0)
+    SWScr[SWScr == 0] = 10e-6
+    return np.stack((np.sum(data[0] * data[1] / SWScr, axis=0), SWScr))
+
+# Per-frame channel mapping of the former TxpbAdapter.process(), data [rows, 32] of both modules
+# -> [1, n_pwi, n_samples, 128]
+def reference_txpb_adapter(data, n_push, n_pwi, n_samples):
+    output = np.zeros((1, n_pwi, n_samples, 128), dtype=data.dtype)
+    module_n_samples = n_samples*n_push + n_samples*n_pwi*2
+    us4oem0_data = data[:module_n_samples, :][n_push*n_samples:, :].reshape((n_pwi, 2, n_samples, 32))
+    us4oem1_data = data[module_n_samples:, :][n_push*n_samples:, :].reshape((n_pwi, 2, n_samples, 32))
+    for i in range(n_pwi):
+        output[0, i, :,   0:32] = us4oem0_data[i, 0, :, :]
+        output[0, i, :,  32:64] = us4oem1_data[i, 0, :, ::-1]
+        output[0, i, :,  64:96] = us4oem0_data[i, 1, :, :]
+        output[0, i, :, 96:128] = us4oem1_data[i, 1, :, ::-1]
+        # swap data centers of the second module
+        output[0, i, :, [15, 16]] = output[0, i, :, [16, 15]]
+        output[0, i, :, [47, 48]] = output[0, i, :, [48, 47]]
+        output[0, i, :, [79, 80]] = output[0, i, :, [80, 79]]
+        output[0, i, :, [111, 112]] = output[0, i, :, [112, 111]]
+    return output
+
+# Max abs difference relative to the max of the reference, or its q-th percentile (for the estimators that are
+# ill-conditioned on a few pixels, e.g. Loupas on complex64 data at the speckle nulls). Complex data are compared
+# as complex numbers.
+def rel_error(a, b, q=None):
+    err = np.abs(np.asarray(a) - np.asarray(b)).astype(np.float64)
+    err = err if q is None else np.percentile(err, q)
+    return float(np.max(err) / max(np.max(np.abs(np.asarray(b))), 1e-30))
+
+# Runs all the checks on one benchmark configuration (benchmark_swe.py), returns {check: dict(rel_error, tolerance, ok)}
+def check_parity(cfg, xp, ndi, tolerance=1e-4):
+    results = {}
+    def record(name, err, tol=tolerance):
+        results[name] = dict(rel_error=err, tolerance=tol, ok=bool(err <= tol))
+
+    iq = synthesize_iq(cfg['sws'], cfg['gridStep'], cfg['width'], cfg['depth'], cfg['frames'] + 2*N_ANGLES - 2, cfg['fri'],
+                       snr_db=cfg['snr_db'], seed=cfg['seed'])
+    pkgs = dict(num_pkg=xp, filter_pkg=ndi)
+    p = chain_params(cfg)
+
+    # AngleCompounding: running sum vs convolution, batch vs streaming
+    op = AngleCompounding(N_ANGLES, **pkgs)
+    op.prepare(n_frames=iq.shape[0])
+    hri = to_host(op.process(to_device(xp, iq)))
+    record('AngleCompounding', rel_error(hri, reference_angle_compounding(iq, N_ANGLES)))
+    streamed = [to_host(f) for f in (op.push(frame) for frame in to_device(xp, iq)) if f is not None]
+    record('AngleCompounding.push', rel_error(np.stack(streamed), hri))
+
+    # Cumulative-sum box filter on complex64 data vs the convolution in double precision, along the depth and
+    # the slow-time axes (a few complex64 roundings expected, the running sums are re-anchored per block)
+    for axis, size, step in ((2, p['z_gate'], 1), (2, p['z_gate'], 2), (0, 4, 1)):
+        ref = sp.ndimage.convolve1d(hri.astype(np.complex128), np.ones(size), axis=axis)
+        ref = ref[(slice(None),)*axis + (slice(None, None, step),)]
+        out = to_host(box_filter1d(to_device(xp, hri), size, axis, xp, step=step))
+        record('box_filter1d.complex64.axis{}.step{}'.format(axis, step), rel_error(out, ref), tol=3e-7)
+
+    # ShearwaveDetection on complex64 data: cumulative-sum boxes (default and single precision mode) vs convolutions,
+    # in double precision.
+    # Loupas divides by the depth phase: a residual carrier along z keeps it away from 0 on the baseband speckle
+    carrier = np.exp(1j * 0.5 * np.arange(hri.shape[2]))
+    for mode in ('kasai', 'loupas'):
+        x = (hri * (carrier if mode == 'loupas' else 1)).astype(np.complex64) # as in the realtime pipeline
+        ref = reference_shearwave_detection(x.astype(np.complex128), mode, 4, p['z_gate'], FC, C, cfg['fri'], FS)
+        for single in (False, True):
+            op = ShearwaveDetection(mode=mode, packet_size=4, z_gate=p['z_gate'], fc=FC, single_precision=single, **pkgs)
+            op.prepare(c=C, frame_pri=cfg['fri'], fs=FS, input_shape=x.shape)
+            out = to_host(op.process(to_device(xp, x)))
+            q = 99.9 if mode == 'loupas' else None
+            record('ShearwaveDetection.' + mode + ('.single' if single else ''), rel_error(out, ref, q))
+    # Depth decimation: output row k is the depth row k*z_stride of the full output (shape and depth axis)
+    x = hri.astype(np.complex64)
+    for z_stride in (2, 3):
+        for single in (False, True):
+            op = ShearwaveDetection(packet_size=4, z_gate=p['z_gate'], fc=FC, z_stride=z_stride, single_precision=single,
+                                    **pkgs)
+            op.prepare(c=C, frame_pri=cfg['fri'], fs=FS, input_shape=x.shape)
+            out = to_host(op.process(to_device(xp, x)))
+            ref = reference_shearwave_detection(x.astype(np.complex128), 'kasai', 4, p['z_gate'], FC, C, cfg['fri'], FS)
+            name = 'ShearwaveDetection.z_stride{}'.format(z_stride) + ('.single' if single else '')
+            record(name, rel_error(out, ref[::z_stride]) if out.shape == ref[::z_stride].shape else np.inf)
+    ddata = reference_shearwave_detection(hri, 'kasai', 4, p['z_gate'], FC, C, cfg['fri'], FS).astype(np.float32)
+
+    # ShearwaveSNR vs the variances in double precision, on motion data with an offset large compared to the motion
+    # (the window means must not cancel the energies)
+    nF = ddata.shape[2]
+    windows = dict(signal_frames=(1, nF//2), noise_frames=(nF - nF//4, nF))
+    x = ddata + np.float32(100 * np.std(ddata))
+    op = ShearwaveSNR(**windows, **pkgs)
+    op.prepare(input_shape=x.shape)
+    out = to_host(op.process(to_device(xp, x)))
+    x = x.astype(np.float64)
+    ref = 20*np.log10(np.var(x[:, :, slice(*windows['signal_frames'])], axis=2)
+                      / np.var(x[:, :, slice(*windows['noise_frames'])], axis=2))
+    record('ShearwaveSNR', float(np.max(np.abs(out - ref))), tol=0.01) # [dB]
+
+    # ShearwaveMotionDataFiltering: r2c and depth-tiled vs c2c
+    outs = {}
+    for fft_mode, tile_z in (('c2c', None), ('r2c', None), ('r2c', 16)):
+        op = ShearwaveMotionDataFiltering(sws_range=[0.5, 4.5], f_range=[40.0, 700.0], k_range=0.9, fft_mode=fft_mode,
+                                          tile_z=tile_z, **pkgs)
+        op.prepare(input_shape=ddata.shape, fs=1.0/cfg['fri'])
+        outs[(fft_mode, tile_z)] = to_host(op.process(to_device(xp, ddata)))
+    record('ShearwaveMotionDataFiltering.r2c', rel_error(outs[('r2c', None)], outs[('c2c', None)]))
+    record('ShearwaveMotionDataFiltering.tiled', rel_error(outs[('r2c', 16)], outs[('r2c', None)]))
+
+    # SWS_Estimation vs the per-direction loop, on the filtered displacements
+    fdata = outs[('c2c', None)]
+    sws_kw = dict(x_range=p['x_range'], z_clip=p['z_clip'], frames_range=p['frames_range'], fri=cfg['fri'],
+                  interp_factor=cfg['iFactor'], interp_order=cfg['iOrder'], px_pitch=cfg['gridStep']*1e-3,
+                  sws_range=[0.5, 4.5])
+    def estimate(d, **kwargs):
+        op = SWS_Estimation(d=d, **sws_kw, **kwargs, **pkgs)
+        op.prepare(input_shape=fdata.shape)
+        return to_host(op.process(to_device(xp, fdata)))
+    refs = {linear: reference_sws_estimation(fdata, d=p['d'], linear=linear, **sws_kw) for linear in (False, True)}
+    # Batched LR/RL, depth-tiled and multi-separation runs of the same estimator: the same maps
+    record('SWS_Estimation', sws_error(estimate(p['d']), *refs[False]))
+    record('SWS_Estimation.tiled', sws_error(estimate(p['d'], tile_z=8), *refs[False]))
+    multi = estimate([p['d'], p['d'] + 2])
+    record('SWS_Estimation.multi_d', max(sws_error(multi[k], *reference_sws_estimation(fdata, d=d, **sws_kw))
+                                         for k, d in enumerate([p['d'], p['d'] + 2])))
+    # The direct correlator evaluates the linear correlation over the lags admissible for sws_range: the same maps
+    # as the zero-padded loop where its SWS is not clipped to sws_range
+    ref, ties = refs[True]
+    inside = (ref[0] > 0.5) & (ref[0] < 4.5) & ~ties
+    record('SWS_Estimation.direct', rel_error(estimate(p['d'], correlator='direct')[:, inside], ref[:, inside]))
+    # The sub-sample interpolation modes estimate other lags than the zoomed data: fraction of the pixels whose lag
+    # differs by more than one FRI/interp_factor step
+    def lag_outliers(sws, ref):
+        inside = (ref > 0.5) & (ref < 4.5)
+        lag = lambda v: cfg['gridStep']*1e-3 * p['d'] * cfg['iFactor'] / (cfg['fri'] * v[inside])
+        return float(np.mean(np.abs(lag(sws) - lag(ref)) > 1 + 1e-6))
+    for interp_mode, correlator in (('fft', 'fft'), ('parabolic', 'fft'), ('parabolic', 'direct')):
+        sws = estimate(p['d'], interp_mode=interp_mode, correlator=correlator)[0]
+        record('SWS_Estimation.' + interp_mode + ('.direct' if correlator == 'direct' else '') + '.lag_outliers',
+               lag_outliers(sws, refs[correlator == 'direct'][0][0]), tol=0.02)
+
+    # SWS_Compounding vs the original formula
+    rng = np.random.default_rng(cfg['seed'])
+    sws = rng.uniform(0.5, 4.5, (2, 2, 32, 48)).astype(np.float32)
+    sws[1, :, :4] = 0
+    op = SWS_Compounding(**pkgs)
+    op.prepare()
+    record('SWS_Compounding', rel_error(to_host(op.process(to_device(xp, sws))), reference_sws_compounding(sws)))
+
+    # MedianFiltering: histogram mode vs ndimage.median_filter, within the quantization
+    image = np.stack((sws[0, 0] + 0.1, sws[1, 0]))
+    op = MedianFiltering(kernel_size=p['median_size'], mode='histogram', **pkgs)
+    op.prepare()
+    out = to_host(op.process(to_device(xp, image.copy())))[0]
+    ref = sp.ndimage.median_filter(image[0], size=(p['median_size'], p['median_size']))
+    # away from the borders (the masked filter does not reflect the map there) and from the invalid rows
+    k = p['median_size']
+    inner = (slice(4 + k, -k), slice(k, -k))
+    record('MedianFiltering.histogram', float(np.max(np.abs(out[inner] - ref[inner]))),
+           tol=0.5 * (op.value_range[1] - op.value_range[0]) / op.n_bins + 1e-6)
+
+    # TxpbAdapter: one gather of the whole TXPB buffer vs the per-frame mapping, every sample distinct
+    for n_push, n_pwi, n_samples in ((1, 3, 16), (2, 5, 64)):
+        rows = 2 * (n_samples*n_push + n_samples*n_pwi*2)
+        data = np.arange(rows*32, dtype=np.int32).reshape((rows, 32))
+        out = to_host(xp.take(to_device(xp, data), to_device(xp, txpb_gather_index(n_push, n_pwi, n_samples))))
+        ref = reference_txpb_adapter(data, n_push, n_pwi, n_samples)
+        record('TxpbAdapter.gather.push{}.pwi{}'.format(n_push, n_pwi),
+               float(np.count_nonzero(out != ref)) if out.shape == ref.shape else float('inf'), tol=0)
+
+    # The whole chain against the numpy backend
+    if(xp is not np):
+        cfg_np = dict(cfg)
+        outs = {}
+        for backend in ((xp, ndi), (np, sp.ndimage)):
+            chain = build_chain(cfg_np, *backend)
+            x = to_device(backend[0], iq)
+            for name in STAGES:
+                prepare_stage(name, chain[name], x, cfg_np)
+                x = chain[name].process(x)
+                outs.setdefault(name, []).append(to_host(x).copy())
+        for name in STAGES:
+            record('backend.' + name, rel_error(*outs[name]), tol=1e-3)
+
+    # The whole chain with the buffers from a BufferPool against the same chain without, twice (reused buffers)
+    outs = {}
+    for buffer_pool in (None, BufferPool(xp)):
+        chain = build_chain(cfg, xp, ndi, buffer_pool=buffer_pool)
+        x = to_device(xp, iq)
+        for name in STAGES:
+            prepare_stage(name, chain[name], x, cfg)
+            x = chain[name].process(x)
+        x = to_device(xp, iq)
+        for name in STAGES:
+            x = chain[name].process(x)
+            outs.setdefault(name, []).append(to_host(x).copy())
+    for name in STAGES:
+        record('BufferPool.' + name, rel_error(*outs[name]), tol=0)
+    return results
+
+
+def main(args):
+    xp, ndi = get_backend(args.backend)
+    cfg = dict(gridStep=args.gridStep, frames=args.frames, iFactor=args.iFactor, iOrder=2, d_mm=args.d, sws=2.0,
+               width=args.width, depth=args.depth, fri=160e-6, snr_db=30.0, seed=args.seed, push_exclusion_mm=2.0,
+               swd_mode='kasai', z_stride=1, single_precision=False, fft_mode='c2c', tile_z=None, interp_mode='zoom',
+               correlator='fft', median_mode='exact', buffer_pool=False)
+    results = check_parity(cfg, xp, ndi)
+    ok = True
+    for name, r in results.items():
+        print("parity {:40s} {:.2e} {}".format(name, r['rel_error'], 'ok' if r['ok'] else 'FAILED'))
+        ok &= r['ok']
+    if(args.report is not None):
+        with open(args.report, 'w') as f:
+            json.dump(dict(backend=args.backend, config=cfg, parity=results, ok=bool(ok)), f, indent=2)
+    return 0 if ok else 1
+
+
+# Parser
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Parity checks of the SWE ops against reference implementations.")
+    parser.add_argument("--backend", dest="backend", choices=['numpy', 'cupy'], default='numpy')
+    parser.add_argument("--gridStep", dest="gridStep", type=float, default=0.4, help="grid step [mm]")
+    parser.add_argument("--frames", dest="frames", type=int, default=60, help="compounded frame count")
+    parser.add_argument("--iFactor", dest="iFactor", type=int, default=2, help="SWS interpolation factor")
+    parser.add_argument("--d", dest="d", type=float, default=4.0, help="SWS lateral separation [mm]")
+    parser.add_argument("--width", dest="width", type=float, default=30.0, help="lateral extent [mm]")
+    parser.add_argument("--depth", dest="depth", type=float, default=20.0, help="depth extent [mm]")
+    parser.add_argument("--seed", dest="seed", type=int, default=0)
+    parser.add_argument("--report", dest="report", default=None, help="JSON report path")
+    args = parser.parse_args()
+    sys.exit(main(args))
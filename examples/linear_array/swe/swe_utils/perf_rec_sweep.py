@@ -0,0 +1,124 @@
+import time
+import argparse
+import itertools
+import multiprocessing
+import concurrent.futures
+import perf_rec_offline
+from SWE_utils_cache import ProductCache, chain_keys, run_stage
+
+# Parametric sweep of perf_rec_offline.py over a grid of (iOrder, iFactor, gridStep, shift, idx).
+# The stages of perf_rec_offline.STAGES form a dependency DAG: a stage runs once per distinct tuple of its own and
+# upstream parameters (the RF data is loaded and filtered once per dataset, beamformed once per gridStep, ...), and
+# its result is handed over to all the stages depending on it. Ready stages run in parallel in a process pool.
+# With a cache (--cacheDir), the stages whose products are cached are skipped along with everything upstream of them,
+# and the workers exchange the cached products through the cache (memory-mapped) instead of pickling them.
+#
+# Example (equivalent of calling perf_rec_offline.py 2 x 3 x 2 x 2 times):
+#   python perf_rec_sweep.py --iOrder 1 2 --iFactor 1 5 10 --gridStep 0.1 0.2 --shift 0 --idx 0 1 --workers 2
+
+PARAMS = ('iOrder', 'iFactor', 'gridStep', 'shift', 'idx')
+
+
+def build_dag(stages, grid, cache=None, input_file=None):
+    # Nodes: key = (stage index, values of the parameters the stage depends on, including the upstream ones)
+    # nodes[key] = [parent key, child keys, parameters of the stage, cache key]
+    nodes = {}
+    for point in grid:
+        parent = None
+        depends = []
+        cache_keys = chain_keys(cache, stages, point, input_file(point)) if cache is not None else [None]*len(stages)
+        for i, (name, fn, params, cached, settings) in enumerate(stages):
+            depends += [p for p in params if p not in depends]
+            key = (i,) + tuple(point[p] for p in depends)
+            if(key not in nodes):
+                nodes[key] = [parent, [], {p: point[p] for p in params}, cache_keys[i] if cached else None]
+                if(parent is not None):
+                    nodes[parent][1].append(key)
+            parent = key
+    return nodes
+
+# Nodes to run: not cached and needed by a leaf (leaves first, a node is needed if any of its children runs)
+def nodes_to_run(nodes, cache):
+    run = set()
+    for key in sorted(nodes, key=lambda key: -key[0]):
+        parent, children, params, cache_key = nodes[key]
+        cached = cache is not None and cache_key is not None and cache_key in cache
+        if(not cached and (not children or any(child in run for child in children))):
+            run.add(key)
+    return run
+
+# Stage functions are module level functions of perf_rec_offline, they are pickled by name and imported by the workers.
+# upstream: products of the parent, or its cache key. Returns the products, or their cache key if the stage is cached.
+def run_node(fn, upstream, params, cache, cache_key):
+    if(isinstance(upstream, str)):
+        key, upstream = upstream, cache.get(upstream)
+        if(upstream is None):
+            raise RuntimeError("Products evicted from the cache during the sweep: " + key + ", increase the cache size")
+    t = time.time()
+    products = run_stage(fn, upstream, params)
+    elapsed = time.time() - t
+    if(cache_key is not None):
+        cache.put(cache_key, products)
+        products = cache_key
+    return products, elapsed
+
+def run_sweep(stages, grid, workers, cache=None, input_file=None):
+    nodes = build_dag(stages, grid, cache, input_file)
+    run = nodes_to_run(nodes, cache)
+    n_runs = {name: sum(1 for key in run if key[0] == i) for i, (name, fn, params, cached, settings) in enumerate(stages)}
+    print("Sweep of " + str(len(grid)) + " points, stage runs: " + str(n_runs))
+
+    # CUDA does not survive a fork, workers are spawned. workers=0: one thread in this process (debugging)
+    if(workers == 0):
+        pool = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+    else:
+        pool = concurrent.futures.ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'))
+
+    results = {}
+    with pool:
+        def submit(key, upstream):
+            cache_key = nodes[key][3] if cache is not None else None
+            return pool.submit(run_node, stages[key[0]][1], upstream, nodes[key][2], cache, cache_key)
+
+        # Starting points: the first stages and the stages after a cached product
+        running = {submit(key, None if nodes[key][0] is None else nodes[nodes[key][0]][3]): key
+                   for key in run if nodes[key][0] is None or nodes[key][0] not in run}
+        while(running):
+            done, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                key = running.pop(future)
+                result, elapsed = future.result()
+                print("{:10s} {} done in {:.1f} s".format(stages[key[0]][0], nodes[key][2], elapsed))
+                # The children get the result at submission, it is dropped here as soon as they all are submitted
+                for child in nodes[key][1]:
+                    if(child in run):
+                        running[submit(child, result)] = child
+                if(not nodes[key][1]):
+                    results[key] = result
+    return results
+
+
+def main(args):
+    grid = [dict(zip(PARAMS, values)) for values in itertools.product(*(getattr(args, p) for p in PARAMS))]
+    t = time.time()
+    cache = None
+    if(args.cacheDir is not None):
+        cache = ProductCache(args.cacheDir, max_bytes=None if args.cacheSize is None else int(args.cacheSize*2**30))
+    results = run_sweep(perf_rec_offline.STAGES, grid, args.workers, cache=cache,
+                        input_file=lambda point: perf_rec_offline.rf_path(point['idx'], point['shift']))
+    print("Sweep done in {:.1f} s, {} results".format(time.time() - t, len(results)))
+    return results
+
+# Parser
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="TXPB parametric sweep.")
+    parser.add_argument("--iOrder", dest="iOrder", type=int, nargs='+')
+    parser.add_argument("--iFactor", dest="iFactor", type=int, nargs='+')
+    parser.add_argument("--shift", dest="shift", type=int, nargs='+')
+    parser.add_argument("--gridStep", dest="gridStep", type=float, nargs='+')
+    parser.add_argument("--idx", dest="idx", type=int, nargs='+')
+    parser.add_argument("--cacheDir", dest="cacheDir", default=None, help="cache of the intermediate products")
+    parser.add_argument("--cacheSize", dest="cacheSize", type=float, default=None, help="cache size limit [GB]")
+    parser.add_argument("--workers", dest="workers", type=int, default=2, help="worker processes (0: run in this process)")
+    args = parser.parse_args()
+    main(args)